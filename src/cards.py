@@ -23,9 +23,15 @@
 scheduling etc."""
 
 import release
+import gc
 import sqlite3
+from itertools import islice, izip
+from collections import OrderedDict
 from config import gui_config as config
 import sys
+import time
+from array import array
+from contextlib import contextmanager
 from utils import nvl, log
 
 __version__ = release.version
@@ -60,14 +66,20 @@ __version__ = release.version
 #
 
 class Card(object):
-    """Basic in-memory card object. """
+    """Basic in-memory card object.
+    Texts are kept as given (str or unicode as read from database), score is
+    a number or None if the card was never scored.
+    """
+    # no per-instance __dict__, decks are held in memory by the thousands
+    __slots__ = ('id', 'question', 'answer', 'question_hint', 'answer_hint', 'score')
+
     def __init__(self, id=None, question='', answer='', question_hint='', answer_hint='', score=None):
         self.id            = int(id) if id is not None else None
-        self.question      = str(question)
-        self.answer        = str(answer)
-        self.question_hint = str(question_hint)
-        self.answer_hint   = str(answer_hint)
-        self.score         = str(score)
+        self.question      = question
+        self.answer        = answer
+        self.question_hint = question_hint
+        self.answer_hint   = answer_hint
+        self.score         = score
 
 
     def __eq__(self, other):
@@ -100,10 +112,117 @@ class Card(object):
 
 
 
+def cardFactory(cursor, row):
+    """Sqlite row factory building cards from rows of Cards.Columns."""
+    return Card(*row)
+
+
+
+# Question & answer files have lines prefixed with q: or a:
+# Consecutive lines with the same prefix make one question or answer.
+#
+def readQACards(file, read=None):
+    """Generates cards read from given question&answer file object.
+    The file is read line by line. Number of bytes read so far is kept in
+    read['bytes'] if given.
+    """
+    prefix = ''
+    last_prefix = ''
+    card = Card()
+    for line in file:
+        if read is not None:
+            read['bytes'] += len(line)
+        if line.upper().startswith('Q:') or line.upper().startswith('A:'):
+            last_prefix = prefix
+            prefix = line[:2].upper()
+            line = line[3:]
+            # if new card then recreate
+            if prefix == 'Q:' and prefix != last_prefix:
+                if not card.isEmpty():
+                    yield card
+                card = Card()
+            if line.strip() != '':
+                if prefix == 'Q:':
+                    card.question += line
+                else: # prefix == a
+                    card.answer += line
+    # add last card
+    if not card.isEmpty():
+        yield card
+
+
+def writeQACards(cards, file):
+    """Writes given cards to question&answer file object.
+    Unicode texts are written in utf-8.
+    """
+    for card in cards:
+        # question line is always written so that the card starts
+        for prefix, text in (('q:', card.question or '\n'), ('a:', card.answer or '')):
+            for line in text.splitlines():
+                if isinstance(line, unicode):
+                    line = line.encode('utf-8')
+                file.write('%s %s\n' % (prefix, line))
+        file.write('\n')
+
+
+
+class CardCache(object):
+    """Size-bounded LRU cache of card objects keyed by card id.
+    Size 0 disables the cache. Counters of hits, misses and evictions are kept
+    for tuning the size.
+    """
+    def __init__(self, size=0):
+        self.size      = size
+        self.cards     = OrderedDict()
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __contains__(self, card_id):
+        return card_id in self.cards
+
+    def get(self, card_id):
+        """Returns cached card and marks it as most recently used or None."""
+        card = self.cards.pop(card_id, None)
+        if card is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cards[card_id] = card
+        return card
+
+    def put(self, card):
+        """Caches a card, least recently used cards are evicted when full."""
+        if self.size <= 0:
+            return
+        self.cards.pop(card.id, None)
+        self.cards[card.id] = card
+        while len(self.cards) > self.size:
+            self.cards.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, card_id):
+        self.cards.pop(card_id, None)
+
+    def resize(self, size):
+        self.size = size
+        while len(self.cards) > max(size, 0):
+            self.cards.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.cards.clear()
+
+
+
 # Cards will be stored in sqlite database
 # Once opened, each operation will make a commit on the database, so in case of
 # a crash, the data is always safe.
-#
+# Operations run inside a transaction() block join it instead and are
+# committed together at the end of the block.
 #
 class Cards(object):
     """Cards storage. This is an interface for sqlite database keeping cards."""
@@ -111,33 +230,225 @@ class Cards(object):
     class CardsError(Exception) : pass
     class CannotOpenDatabaseError(CardsError) : pass
     class DataNotFoundError(CardsError) : pass
+    class CancelledError(CardsError) : pass
+
+    # card columns in the order of Card constructor params
+    Columns = ('ID', 'QUESTION', 'ANSWER', 'QUESTION_HINT', 'ANSWER_HINT', 'SCORE')
+    # sqlite performance profiles which can be used when opening database
+    # cache_size is given in pages or in KiB if negative, mmap_size in bytes,
+    # busy_timeout in miliseconds
+    Pragmas = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout')
+    Profiles = {
+        # everyday editing and browsing in GUI
+        'interactive' :      { 'journal_mode' : 'WAL',
+                               'synchronous'  : 'NORMAL',
+                               'cache_size'   : -16000,
+                               'mmap_size'    : 64 * 1024 * 1024,
+                               'temp_store'   : 'MEMORY',
+                               'busy_timeout' : 5000 },
+        # loading large decks, trades durability of last transactions for speed
+        'bulk-import' :      { 'journal_mode' : 'WAL',
+                               'synchronous'  : 'OFF',
+                               'cache_size'   : -200000,
+                               'mmap_size'    : 256 * 1024 * 1024,
+                               'temp_store'   : 'MEMORY',
+                               'busy_timeout' : 30000 },
+        # drilling, mostly reads with a few small writes
+        'read-only-review' : { 'journal_mode' : 'WAL',
+                               'synchronous'  : 'NORMAL',
+                               'cache_size'   : -64000,
+                               'mmap_size'    : 256 * 1024 * 1024,
+                               'temp_store'   : 'MEMORY',
+                               'busy_timeout' : 5000 },
+    }
+
+    # database upgrades: version -> (next version, statements upgrading to it)
+    Upgrades = {
+        # scheduling state for spaced repetitions
+        # NEXT_REVIEW is time in seconds since epoch, new cards are due at once
+        # INTERVAL is in days, EASE is the SM-2 easiness factor
+        '01' : ('02', [ 'ALTER TABLE TCARDS ADD COLUMN NEXT_REVIEW INTEGER NOT NULL DEFAULT 0',
+                        'ALTER TABLE TCARDS ADD COLUMN INTERVAL    REAL    NOT NULL DEFAULT 0',
+                        'ALTER TABLE TCARDS ADD COLUMN EASE        REAL    NOT NULL DEFAULT 2.5',
+                        'ALTER TABLE TCARDS ADD COLUMN REPETITIONS INTEGER NOT NULL DEFAULT 0',
+                        'ALTER TABLE TCARDS ADD COLUMN LAPSES      INTEGER NOT NULL DEFAULT 0',
+                        'CREATE INDEX XI_TCARDS_NEXT_REVIEW ON TCARDS ( NEXT_REVIEW, ID )' ]),
+        # cards never scored used to be saved with 'None' string as SCORE
+        '02' : ('03', [ "UPDATE TCARDS SET SCORE = NULL WHERE SCORE = 'None'" ]),
+    }
+
+    # full-text index of card texts
+    FullTextSchema = [
+        r'''CREATE VIRTUAL TABLE TCARDS_FTS USING FTS5 (
+              QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT,
+              CONTENT = 'TCARDS', CONTENT_ROWID = 'ID', PREFIX = '3 4' )''',
+        r'''CREATE TRIGGER TR_TCARDS_FTS_INSERT AFTER INSERT ON TCARDS BEGIN
+              INSERT INTO TCARDS_FTS ( ROWID, QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT )
+                VALUES ( NEW.ID, NEW.QUESTION, NEW.ANSWER, NEW.QUESTION_HINT, NEW.ANSWER_HINT );
+            END''',
+        r'''CREATE TRIGGER TR_TCARDS_FTS_DELETE AFTER DELETE ON TCARDS BEGIN
+              INSERT INTO TCARDS_FTS ( TCARDS_FTS, ROWID, QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT )
+                VALUES ( 'delete', OLD.ID, OLD.QUESTION, OLD.ANSWER, OLD.QUESTION_HINT, OLD.ANSWER_HINT );
+            END''',
+        r'''CREATE TRIGGER TR_TCARDS_FTS_UPDATE AFTER UPDATE OF QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT ON TCARDS BEGIN
+              INSERT INTO TCARDS_FTS ( TCARDS_FTS, ROWID, QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT )
+                VALUES ( 'delete', OLD.ID, OLD.QUESTION, OLD.ANSWER, OLD.QUESTION_HINT, OLD.ANSWER_HINT );
+              INSERT INTO TCARDS_FTS ( ROWID, QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT )
+                VALUES ( NEW.ID, NEW.QUESTION, NEW.ANSWER, NEW.QUESTION_HINT, NEW.ANSWER_HINT );
+            END''',
+    ]
+
+    # shortest word prefix searched for, see PREFIX option of TCARDS_FTS
+    MinPrefixLength = 3
+
+    # scheduling state of a card, SCORE keeps the last review grade
+    ScheduleColumns = ('ID', 'NEXT_REVIEW', 'INTERVAL', 'EASE', 'REPETITIONS', 'LAPSES', 'SCORE')
+    # array typecodes of schedule columns, see getScheduleArrays
+    ScheduleTypes = { 'ID' : 'l', 'NEXT_REVIEW' : 'l', 'INTERVAL' : 'd', 'EASE' : 'd',
+                      'REPETITIONS' : 'l', 'LAPSES' : 'l', 'SCORE' : 'd' }
+    # bulk updates of this many rows rebuild the NEXT_REVIEW index
+    # instead of updating it row by row
+    BulkIndexRows = 100000
 
+    # operators of getCardIds conditions, CONTAINS matches a substring
+    Operators = ('=', '!=', '<', '<=', '>', '>=', 'LIKE', 'CONTAINS', 'IS NULL', 'IS NOT NULL')
 
-    def __init__(self):
+    # max number of ids bound in a single IN (...) query
+    # sqlite allows 999 host parameters by default
+    FetchChunkSize = 500
+
+
+    def __init__(self, cache_size=0):
         self.db_path = None
         self.db = None
+        self.profile = None
+        self.fulltext = False
+        self._txdepth = 0
+        self.cache = CardCache(cache_size)
+        self.writebehind = False
+        # cards updated in write-behind mode and not written yet
+        self._pending = OrderedDict()
 
-    def open(self, dbpath):
-        """Opens or creates Card database. Use :memory: to open database in memory. """
+    def open(self, dbpath, profile=None, pragmas=None):
+        """Opens or creates Card database. Use :memory: to open database in memory.
+        Params: profile is name of one of Cards.Profiles, config.DB_PROFILE is
+        used if not given.
+        Params: pragmas is an optional dict overriding profile settings.
+        """
+        profile = nvl(profile, config.DB_PROFILE)
+        assert profile in Cards.Profiles, "Unknown database profile %s" % profile
         # close if currently open
         if self.db:
+            self.flush()
             self.db.close()
+        self.cache.clear()
         # try to open
         try:
             self.db_path = dbpath
-            self.db = sqlite3.connect(dbpath)
+            # transactions are managed explicitly, see begin()
+            self.db = sqlite3.connect(dbpath, isolation_level=None)
+            self._txdepth = 0
+            self.profile = profile
+            settings = dict(Cards.Profiles[profile])
+            settings.update(pragmas or {})
+            self.setPragmas(settings)
             self.initDb()
         except:
             log(sys.exc_info())
             self.db_path = None
             self.db = None
+            self.profile = None
             raise Cards.CannotOpenDatabaseError, "Cannot open database: %s" % dbpath
 
     def close(self):
         if self.db:
+            self.flush()
             self.db.close()
         self.db_path = None
         self.db = None
+        self.profile = None
+        self._txdepth = 0
+        self.cache.clear()
+
+
+    def setCacheSize(self, size):
+        """Sets max number of cards kept in cache, 0 disables the cache."""
+        self.cache.resize(size)
+
+
+    def setWriteBehind(self, enabled):
+        """Turns write-behind mode on or off.
+        In write-behind mode updateCard only caches the card and it is written
+        on flush(), so that many quick updates of the same card make one write.
+        Reads see pending updates. Pending cards are flushed before any query
+        which reads card texts in sql, on close and when the mode is turned off.
+        Updates made inside a transaction are always written at once.
+        """
+        if not enabled:
+            self.flush()
+        self.writebehind = enabled
+
+
+    def flush(self):
+        """Writes cards updated in write-behind mode in one transaction."""
+        if not self._pending:
+            return
+        self.checkDbOpen()
+        pending = self._pending.values()
+        self._pending = OrderedDict()
+        with self.transaction():
+            cur = self.db.cursor()
+            cur.executemany(r'''UPDATE TCARDS
+                                  SET QUESTION    =  ?
+                                  , ANSWER        =  ?
+                                  , QUESTION_HINT =  ?
+                                  , ANSWER_HINT   =  ?
+                                  , SCORE         =  ?
+                                  WHERE ID        =  ?
+                            ''', [(card.question,
+                                   card.answer,
+                                   card.question_hint,
+                                   card.answer_hint,
+                                   card.score,
+                                   card.id) for card in pending])
+            assert cur.rowcount == len(pending), "Problem when updating cards %s" % [card.id for card in pending]
+            cur.close()
+
+
+    def cacheStats(self):
+        """Returns dict of cache counters and sizes."""
+        return { 'hits'      : self.cache.hits,
+                 'misses'    : self.cache.misses,
+                 'evictions' : self.cache.evictions,
+                 'size'      : self.cache.size,
+                 'count'     : len(self.cache),
+                 'pending'   : len(self._pending) }
+
+
+    def setPragmas(self, pragmas):
+        """Applies given dict of sqlite settings to open database."""
+        self.checkDbOpen()
+        cur = self.db.cursor()
+        for name in Cards.Pragmas:
+            if name in pragmas:
+                cur.execute('PRAGMA %s = %s' % (name, pragmas[name]))
+        cur.close()
+
+
+    def getPragmas(self):
+        """Returns dict of sqlite settings active on open database.
+        Note that in-memory databases do not support WAL journal mode and
+        report MEMORY instead, mmap_size is None for them.
+        """
+        self.checkDbOpen()
+        cur = self.db.cursor()
+        result = {}
+        for name in Cards.Pragmas:
+            # some settings are not reported for in-memory databases
+            row = cur.execute('PRAGMA %s' % name).fetchone()
+            result[name] = row and row[0]
+        cur.close()
+        return result
 
 
     def isOpen(self):
@@ -151,36 +462,145 @@ class Cards(object):
         cur = self.db.cursor()
         # check if tables exist
         try:
-            result = cur.execute('SELECT VERSION FROM TVERSION')
-            row = result.fetchone()
-            assert row[0] == config.DB_VERSION, "Unknown database format."
-        except:
-            # if not supported version then we recreate the database
-            cur.execute(r'''CREATE TABLE TCARDS (
-                              ID             INTEGER PRIMARY KEY,
-                              QUESTION       TEXT,
-                              ANSWER         TEXT,
-                              QUESTION_HINT  TEXT,
-                              ANSWER_HINT    TEXT,
-                              SCORE          NUMERIC
-                              )
-                          ''')
-            cur.execute(r'''CREATE TABLE TVERSION (
-                              VERSION        TEXT
-                            )''' )
-            cur.execute('INSERT INTO TVERSION ( VERSION ) VALUES ( ? ) ', (config.DB_VERSION,))
-            self.db.commit()
+            version = cur.execute('SELECT VERSION FROM TVERSION').fetchone()[0]
+        except sqlite3.OperationalError:
+            version = None
+        cur.close()
+        with self.transaction():
+            cur = self.db.cursor()
+            if version is None:
+                # create database in first version and upgrade it
+                cur.execute(r'''CREATE TABLE TCARDS (
+                                  ID             INTEGER PRIMARY KEY,
+                                  QUESTION       TEXT,
+                                  ANSWER         TEXT,
+                                  QUESTION_HINT  TEXT,
+                                  ANSWER_HINT    TEXT,
+                                  SCORE          NUMERIC
+                                  )
+                              ''')
+                cur.execute(r'''CREATE TABLE TVERSION (
+                                  VERSION        TEXT
+                                )''' )
+                version = '01'
+                cur.execute('INSERT INTO TVERSION ( VERSION ) VALUES ( ? ) ', (version,))
+            # upgrade existing database in place
+            while version != config.DB_VERSION:
+                assert version in Cards.Upgrades, "Unknown database format."
+                version, statements = Cards.Upgrades[version]
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute('UPDATE TVERSION SET VERSION = ?', (version,))
             cur.close()
+            self.initFullText()
+
+
+    def initFullText(self):
+        """Creates full-text index of cards if it does not exist yet.
+        The index is an external content FTS5 table kept in sync with TCARDS
+        by triggers. If sqlite is built without FTS5 no index is created and
+        searchCards falls back to plain scan.
+        """
+        self.checkDbOpen()
+        cur = self.db.cursor()
+        exists = cur.execute(r'''SELECT COUNT(*) FROM SQLITE_MASTER
+                                  WHERE TYPE = 'table' AND NAME = 'TCARDS_FTS' ''').fetchone()[0]
+        self.fulltext = exists > 0
+        if not self.fulltext:
+            try:
+                with self.transaction():
+                    for statement in Cards.FullTextSchema:
+                        cur.execute(statement)
+                    # index cards which already exist
+                    cur.execute("INSERT INTO TCARDS_FTS ( TCARDS_FTS ) VALUES ( 'rebuild' )")
+                self.fulltext = True
+            except sqlite3.OperationalError:
+                log('Full-text search not available: %s' % str(sys.exc_info()[1]))
+        cur.close()
+
+
+    def begin(self):
+        """Begins a transaction or a savepoint if one is already active.
+        Each begin must be matched with commit or rollback.
+        Transaction takes the write lock at once, so that values read in it,
+        e.g. MAX(ID) used for new ids, are not changed by other connections.
+        """
+        self.checkDbOpen()
+        if self._txdepth == 0:
+            self.db.execute('BEGIN IMMEDIATE')
+        else:
+            self.db.execute('SAVEPOINT SP%d' % self._txdepth)
+        self._txdepth += 1
 
 
     def commit(self):
+        """Commits current transaction or releases current savepoint.
+        Does nothing if no transaction is active."""
+        self.checkDbOpen()
+        if self._txdepth == 0:
+            return
+        # depth is changed only if the statement succeeds, e.g. failed COMMIT
+        # leaves the transaction active
+        if self._txdepth == 1:
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('RELEASE SP%d' % (self._txdepth - 1))
+        self._txdepth -= 1
+
+
+    def rollback(self):
+        """Rolls back current transaction or current savepoint.
+        Does nothing if no transaction is active."""
         self.checkDbOpen()
-        self.db.commit()
+        if self._txdepth == 0:
+            return
+        # cached cards may hold changes which are rolled back
+        self.cache.clear()
+        if self._txdepth == 1:
+            self.db.execute('ROLLBACK')
+        else:
+            self.db.execute('ROLLBACK TO SP%d' % (self._txdepth - 1))
+            self.db.execute('RELEASE SP%d' % (self._txdepth - 1))
+        self._txdepth -= 1
+
+
+    def inTransaction(self):
+        return self._txdepth > 0
+
+
+    @contextmanager
+    def transaction(self):
+        """Context manager for a unit of work.
+        All changes made in the with block are committed at its end or rolled
+        back if it raises. Blocks may be nested, inner blocks are savepoints
+        of the outer one.
+
+        with cards.transaction():
+            cards.updateCard(card1)
+            cards.deleteCard(card2.id)
+        """
+        self.begin()
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        else:
+            self.commit()
 
 
     def addCard(self, card, commit=True):
-        """Adds a card object to database and returns it's id object."""
+        """Adds a card object to database and returns it's id object.
+        If commit is False and no transaction is active, a transaction is begun
+        and left open to be finished with commit()."""
         self.checkDbOpen()
+        if not commit and not self.inTransaction():
+            self.begin()
+        with self.transaction():
+            return self._insertCard(card)
+
+
+    def _insertCard(self, card):
         cur = self.db.cursor()
         cur.execute(r'''INSERT INTO TCARDS ( QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT, SCORE )
                           VALUES ( ? , ? , ? , ?, ? ) ''', \
@@ -199,28 +619,197 @@ class Cards(object):
         result = cur.execute('SELECT MAX(ID) FROM TCARDS').fetchone()[0]
         assert lastrowid == result, "Internal error: Lastrowid does not return MaxID!"
         cur.close()
-        if commit:
-            self.db.commit()
         return result
 
 
+    def addCards(self, cards, batch_size=1000, progress=None):
+        """Adds many card objects to database in one transaction.
+        Cards are read from given iterable in batches of batch_size and
+        inserted with executemany, so the iterable may be a generator.
+        Optional progress callback is called with number of cards added so far
+        after each batch. If it returns False adding is cancelled, the
+        transaction is rolled back and CancelledError raised.
+        Returns (first_id, last_id) range of assigned ids or None if no cards
+        were added.
+        """
+        self.checkDbOpen()
+        with self.transaction():
+            return self._insertCards(cards, batch_size, progress)
+
+
+    def _insertCards(self, cards, batch_size, progress):
+        cur = self.db.cursor()
+        # ids are assigned here instead of being read back after each insert
+        # they follow the same rule sqlite uses for INTEGER PRIMARY KEY, the
+        # transaction holds write lock so other connections can't take them
+        first_id = nvl(cur.execute('SELECT MAX(ID) FROM TCARDS').fetchone()[0], 0) + 1
+        next_id = first_id
+        cards = iter(cards)
+        try:
+            while True:
+                batch = [(next_id + i,
+                          card.question,
+                          card.answer,
+                          card.question_hint,
+                          card.answer_hint,
+                          card.score) for i, card in enumerate(islice(cards, batch_size))]
+                if not batch:
+                    break
+                cur.executemany(r'''INSERT INTO TCARDS ( ID, QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT, SCORE )
+                                     VALUES ( ?, ? , ? , ? , ?, ? ) ''', batch)
+                next_id += len(batch)
+                if progress and progress(next_id - first_id) is False:
+                    raise Cards.CancelledError, "Adding cards cancelled"
+        finally:
+            cur.close()
+        if next_id == first_id:
+            return None
+        else:
+            return first_id, next_id - 1
+
+
     def getCard(self, card_id):
-        """Retrieves a card from database given it's id or None if it does not exist."""
-        # TODO
+        """Retrieves a card from database given it's id or None if it does not exist.
+        Cards are served from cache if it is enabled. Cached card objects are
+        shared, so they should not be modified in place.
+        """
         self.checkDbOpen()
+        card = self._pending.get(card_id) or self.cache.get(card_id)
+        if card is not None:
+            return card
         cur = self.db.cursor()
+        cur.row_factory = cardFactory
         rows = cur.execute(r'''SELECT ID, QUESTION, ANSWER, QUESTION_HINT, ANSWER_HINT, SCORE
                                  FROM TCARDS
                                 WHERE ID = ?
                             ''', (card_id,))
-        row = rows.fetchone()
-        if row:
-            card = Card(*row)
-            cur.close()
+        card = rows.fetchone()
+        cur.close()
+        if card:
+            self.cache.put(card)
             return card
         else:
             raise Cards.DataNotFoundError, "Card not found = %d " % card_id
 
+    def getCards(self, card_ids, columns=None):
+        """Retrieves many cards from database given their ids.
+        Returns ordered dict of cards keyed by id, in the order of given ids.
+        Ids not found in database are omitted.
+        Params: columns is an optional list of columns to fetch (see
+        Cards.Columns); other card fields are left empty. ID is always fetched.
+        """
+        self.checkDbOpen()
+        card_ids = list(card_ids)
+        found = {}
+        if columns is None:
+            columns = Cards.Columns
+            # whole cards are taken from cache, only missing ones are queried
+            for card_id in card_ids:
+                card = self._pending.get(card_id) or self.cache.get(card_id)
+                if card is not None:
+                    found[card_id] = card
+        else:
+            self.flush()
+            columns = [c.upper() for c in columns]
+            for c in columns:
+                assert c in Cards.Columns, "Unknown card column %s" % c
+            columns = ['ID'] + [c for c in columns if c != 'ID']
+        missing = [card_id for card_id in card_ids if card_id not in found]
+        cur = self.db.cursor()
+        if columns is Cards.Columns:
+            cur.row_factory = cardFactory
+        else:
+            names = [c.lower() for c in columns]
+            cur.row_factory = lambda cursor, row: Card(**dict(zip(names, row)))
+        for i in range(0, len(missing), Cards.FetchChunkSize):
+            chunk = missing[i:i + Cards.FetchChunkSize]
+            rows = cur.execute(r'''SELECT %s
+                                     FROM TCARDS
+                                    WHERE ID IN ( %s )
+                                ''' % (', '.join(columns), ', '.join('?' * len(chunk))), chunk)
+            for card in rows:
+                found[card.id] = card
+                if columns is Cards.Columns:
+                    self.cache.put(card)
+        cur.close()
+        result = OrderedDict()
+        for card_id in card_ids:
+            if card_id in found:
+                result[card_id] = found[card_id]
+        return result
+
+
+    def getCardIds(self, after_id=None, limit=None, sortkey='ID', descending=False, conditions=None):
+        """Returns ids of cards in sort order as a compact array.
+        Params: after_id and limit give a block of ids following given id in
+        the sort order, blocks are found by seeking in an index.
+        Params: sortkey is one of Cards.Columns, cards with equal key are
+        ordered by id. Index on the key is created when first needed.
+        Params: conditions is an optional list of (column, operator, value)
+        filters, see Cards.Operators. Values are bound as query parameters.
+        """
+        self.checkDbOpen()
+        sortkey = sortkey.upper()
+        assert sortkey in Cards.Columns, "Unknown sort key %s" % sortkey
+        cur = self.db.cursor()
+        if sortkey == 'ID' and not descending and not conditions:
+            rows = cur.execute('SELECT ID FROM TCARDS WHERE ID > ? ORDER BY ID LIMIT ?',
+                               (nvl(after_id, -1), nvl(limit, -1)))
+        else:
+            # pending edits may change order or filter
+            self.flush()
+            where, params = self._whereClause(conditions)
+            anchor = self._anchor(cur, sortkey, after_id)
+            rows = self._seekRows(cur, 'ID', anchor, not descending, limit, sortkey, where, params)
+        result = array('l', (row[0] for row in rows))
+        cur.close()
+        return result
+
+
+    def seekCardIds(self, after=None, limit=None, sortkey='ID', descending=False, conditions=None):
+        """Returns block of card ids in sort order and position of its last
+        card, see getCardIds for params.
+        Params: after is None for the first block or the position returned
+        with the previous block, a (sort key value, id) tuple. Block is seeked
+        from the position itself, so it follows the previous block even if
+        that card was changed or deleted since.
+        Returns tuple (ids, position), position is after for an empty block.
+        """
+        self.checkDbOpen()
+        sortkey = sortkey.upper()
+        assert sortkey in Cards.Columns, "Unknown sort key %s" % sortkey
+        # pending edits may change order or filter
+        self.flush()
+        where, params = self._whereClause(conditions)
+        cur = self.db.cursor()
+        rows = self._seekRows(cur, 'ID, %s' % sortkey, after, not descending, limit, sortkey, where, params)
+        cur.close()
+        if rows:
+            after = (rows[-1][1], rows[-1][0])
+        return array('l', (row[0] for row in rows)), after
+
+
+    def _whereClause(self, conditions):
+        """Returns sql condition and its params for list of (column,
+        operator, value) filters."""
+        clauses = []
+        params = []
+        for column, operator, value in conditions or []:
+            column = column.upper()
+            operator = operator.upper()
+            assert column in Cards.Columns, "Unknown card column %s" % column
+            assert operator in Cards.Operators, "Unknown operator %s" % operator
+            if operator in ('IS NULL', 'IS NOT NULL'):
+                clauses.append('%s %s' % (column, operator))
+            elif operator == 'CONTAINS':
+                clauses.append("%s LIKE ? ESCAPE '\\'" % column)
+                params.append(self._likePattern(value))
+            else:
+                clauses.append('%s %s ?' % (column, operator))
+                params.append(value)
+        return ' AND '.join(clauses), tuple(params)
+
+
     def getCardHeaders(self, sqlwhere='', minrow=None, maxrow=None):
         """Returns card ids using sqlwhere and minrow, maxrow range
         Params: minrow and maxrows are both counted from 0.
@@ -241,6 +830,7 @@ class Cards(object):
         # it firsts skips OFFSET records and then the rest is limited to max
         # LIMIT records
         self.checkDbOpen()
+        self.flush()
         cur = self.db.cursor()
         if sqlwhere.strip():
             sqlwhere = 'WHERE ' + sqlwhere
@@ -261,6 +851,334 @@ class Cards(object):
         return result
 
 
+    def seekCardHeaders(self, after_id=None, before_id=None, limit=None, sortkey='ID', sqlwhere=''):
+        """Returns card headers (id, question) using keyset paging.
+        Params: after_id returns cards following card with given id in the sort
+        order, before_id returns cards preceding it. Both may be None to start
+        from the beginning.
+        Params: sortkey is one of Cards.Columns, cards with equal key are
+        ordered by id.
+        Result is always in ascending sort order.
+        Unlike getCardHeaders with minrow this does not skip rows, each page is
+        found by seeking in an index.
+        """
+        self.checkDbOpen()
+        assert after_id is None or before_id is None, "Use only one of after_id, before_id"
+        self.flush()
+        sortkey = sortkey.upper()
+        assert sortkey in Cards.Columns, "Unknown sort key %s" % sortkey
+        cur = self.db.cursor()
+        anchor = self._anchor(cur, sortkey, nvl(after_id, before_id))
+        result = self._seekRows(cur, 'ID, QUESTION', anchor, before_id is None,
+                                limit, sortkey, sqlwhere, ())
+        cur.close()
+        if before_id is not None:
+            result.reverse()
+        return result
+
+
+    def _anchor(self, cur, sortkey, card_id):
+        """Returns (sort key value, id) position of card with given id or
+        None if card_id is None."""
+        if card_id is None:
+            return None
+        if sortkey == 'ID':
+            return (card_id, card_id)
+        row = cur.execute('SELECT %s FROM TCARDS WHERE ID = ?' % sortkey, (card_id,)).fetchone()
+        if row is None:
+            cur.close()
+            raise Cards.DataNotFoundError, "Card not found = %d " % card_id
+        return (row[0], card_id)
+
+
+    def _seekRows(self, cur, columns, anchor, forward, limit, sortkey, sqlwhere, params):
+        """Returns rows of given columns following anchor position in
+        ascending sort order if forward is True, otherwise preceding it in
+        descending order. Cards are filtered with sqlwhere and its params.
+        Params: anchor is None or a (sort key value, id) tuple, the card
+        at anchor need not exist.
+        """
+        if sortkey != 'ID':
+            self._ensureIndex(sortkey)
+        if anchor is not None:
+            value, anchor_id = anchor
+        # each segment is a (where, params) condition which can be seeked in
+        # the index, segments are queried in order until limit is reached
+        # NULL keys are kept in a separate segment as they sort first
+        if anchor is None:
+            segments = [('1 = 1', ())]
+        elif sortkey == 'ID':
+            segments = [(forward and 'ID > ?' or 'ID < ?', (anchor_id,))]
+        elif forward:
+            if value is None:
+                segments = [('%s IS NULL AND ID > ?' % sortkey, (anchor_id,)),
+                            ('%s IS NOT NULL' % sortkey, ())]
+            else:
+                segments = [('%s = ? AND ID > ?' % sortkey, (value, anchor_id)),
+                            ('%s > ?' % sortkey, (value,))]
+        else:
+            if value is None:
+                segments = [('%s IS NULL AND ID < ?' % sortkey, (anchor_id,))]
+            else:
+                segments = [('%s = ? AND ID < ?' % sortkey, (value, anchor_id)),
+                            ('%s < ?' % sortkey, (value,)),
+                            ('%s IS NULL' % sortkey, ())]
+        if sortkey == 'ID':
+            orderby = 'ID'
+        else:
+            orderby = '%s, ID' % sortkey
+        if not forward:
+            orderby = ', '.join([o + ' DESC' for o in orderby.split(', ')])
+        if sqlwhere.strip():
+            sqlwhere = 'AND ( %s )' % sqlwhere
+        result = []
+        for where, segment_params in segments:
+            remaining = -1
+            if limit is not None:
+                remaining = limit - len(result)
+                if remaining <= 0:
+                    break
+            query = r'''SELECT %s FROM TCARDS
+                         WHERE %s %s
+                         ORDER BY %s
+                         LIMIT %d''' % (columns, where, sqlwhere, orderby, remaining)
+            result.extend(cur.execute(query, segment_params + params).fetchall())
+        return result
+
+
+    def _ensureIndex(self, column):
+        """Creates index used for sorting by given column if it does not exist."""
+        cur = self.db.cursor()
+        cur.execute('CREATE INDEX IF NOT EXISTS XI_TCARDS_%s ON TCARDS ( %s, ID )' % (column, column))
+        cur.close()
+
+
+    def searchCards(self, query, limit=None, offset=0):
+        """Returns card headers (id, question) of cards matching given text.
+        Each word of the query must be found in question, answer or hints of
+        the card. The last word may also be a prefix of a word if it has at
+        least Cards.MinPrefixLength chars, so that the query can be typed in
+        as the user types. Results are ranked by relevance.
+        """
+        self.checkDbOpen()
+        self.flush()
+        words = query.split()
+        if len(words) == 0:
+            return []
+        cur = self.db.cursor()
+        if self.fulltext:
+            rows = cur.execute(r'''SELECT TCARDS.ID, TCARDS.QUESTION
+                                     FROM TCARDS_FTS JOIN TCARDS ON TCARDS.ID = TCARDS_FTS.ROWID
+                                    WHERE TCARDS_FTS MATCH ?
+                                    ORDER BY TCARDS_FTS.RANK
+                                    LIMIT ? OFFSET ?''', (self._matchQuery(words), nvl(limit, -1), offset))
+        else:
+            where, params = self._likeClause(words)
+            rows = cur.execute(r'''SELECT ID, QUESTION FROM TCARDS
+                                    WHERE %s
+                                    ORDER BY ID
+                                    LIMIT ? OFFSET ?''' % where, params + [nvl(limit, -1), offset])
+        result = rows.fetchall()
+        cur.close()
+        return result
+
+
+    def searchCardIds(self, query, after_id=None, limit=None, card_ids=None):
+        """Returns ids of cards matching given text in ascending order as
+        a compact array. Cards are matched as in searchCards, but results are
+        not ranked, so a block of ids following after_id is read from the
+        index without finding all matches first.
+        Params: card_ids is an optional list of ids to which search is
+        restricted, e.g. results of a shorter query, given in ascending order.
+        """
+        self.checkDbOpen()
+        self.flush()
+        words = query.split()
+        result = array('l')
+        if len(words) == 0:
+            return result
+        # negative limit means no limit in sqlite
+        limit = max(nvl(limit, -1), -1)
+        cur = self.db.cursor()
+        if self.fulltext:
+            select = r'''SELECT ROWID FROM TCARDS_FTS
+                         WHERE TCARDS_FTS MATCH ? AND ROWID > ? %s
+                         ORDER BY ROWID
+                         LIMIT ?'''
+            params = [self._matchQuery(words)]
+        else:
+            where, params = self._likeClause(words)
+            select = r'''SELECT ID FROM TCARDS
+                         WHERE %s AND ID > ? %%s
+                         ORDER BY ID
+                         LIMIT ?''' % where
+        if card_ids is None:
+            rows = cur.execute(select % '', params + [nvl(after_id, -1), limit])
+            result.extend(row[0] for row in rows)
+        else:
+            card_ids = [card_id for card_id in card_ids if card_id > nvl(after_id, -1)]
+            idcolumn = self.fulltext and 'ROWID' or 'ID'
+            for i in range(0, len(card_ids), Cards.FetchChunkSize):
+                remaining = limit
+                if limit >= 0:
+                    remaining = limit - len(result)
+                    if remaining <= 0:
+                        break
+                chunk = card_ids[i:i + Cards.FetchChunkSize]
+                where = 'AND %s IN (%s)' % (idcolumn, ', '.join(['?'] * len(chunk)))
+                rows = cur.execute(select % where, params + [-1] + chunk + [remaining])
+                result.extend(row[0] for row in rows)
+        cur.close()
+        return result
+
+
+    def _matchQuery(self, words):
+        """Returns full-text query matching all given words."""
+        # quote words so that they are not taken as FTS5 query syntax
+        terms = ['"%s"' % w.replace('"', '""') for w in words]
+        # shorter prefixes match too many words to rank them quickly
+        if len(words[-1]) >= Cards.MinPrefixLength:
+            terms[-1] += '*'
+        return ' '.join(terms)
+
+
+    def _likeClause(self, words):
+        """Returns sql condition and its params for plain scan matching all
+        given words."""
+        where = ' AND '.join(["( QUESTION LIKE ? ESCAPE '\\' OR ANSWER LIKE ? ESCAPE '\\'"
+                              " OR QUESTION_HINT LIKE ? ESCAPE '\\' OR ANSWER_HINT LIKE ? ESCAPE '\\' )"] * len(words))
+        params = []
+        for w in words:
+            params.extend([self._likePattern(w)] * 4)
+        return where, params
+
+
+    def _likePattern(self, text):
+        """Returns LIKE pattern matching given text anywhere, wildcards in
+        text are escaped with backslash."""
+        text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return '%%%s%%' % text
+
+
+    def getDueCards(self, now=None, limit=None):
+        """Returns ids of cards due for review at given time, most overdue first.
+        Params: now is time in seconds since epoch, current time if not given.
+        The query is a range scan of the NEXT_REVIEW index, so it only reads
+        the rows it returns.
+        """
+        self.checkDbOpen()
+        if now is None:
+            now = int(time.time())
+        cur = self.db.cursor()
+        rows = cur.execute(r'''SELECT ID FROM TCARDS
+                                WHERE NEXT_REVIEW <= ?
+                                ORDER BY NEXT_REVIEW, ID
+                                LIMIT ?''', (now, nvl(limit, -1)))
+        result = [row[0] for row in rows]
+        cur.close()
+        return result
+
+
+    def getSchedules(self, card_ids=None):
+        """Returns scheduling state of cards with given ids or of all cards.
+        Each row is a tuple in order of Cards.ScheduleColumns.
+        """
+        self.checkDbOpen()
+        self.flush()
+        query = 'SELECT %s FROM TCARDS' % ', '.join(Cards.ScheduleColumns)
+        cur = self.db.cursor()
+        if card_ids is None:
+            result = cur.execute(query + ' ORDER BY ID').fetchall()
+        else:
+            card_ids = list(card_ids)
+            result = []
+            for i in range(0, len(card_ids), Cards.FetchChunkSize):
+                chunk = card_ids[i:i + Cards.FetchChunkSize]
+                result.extend(cur.execute(query + ' WHERE ID IN ( %s )' % ', '.join('?' * len(chunk)), chunk))
+        cur.close()
+        return result
+
+
+    def updateSchedules(self, schedules):
+        """Writes scheduling state of many cards in one transaction.
+        Each row of schedules is a tuple in order of Cards.ScheduleColumns.
+        """
+        schedules = list(schedules)
+        if schedules:
+            self.updateScheduleArrays(Cards.ScheduleColumns, zip(*schedules))
+
+
+    def getScheduleArrays(self, columns=ScheduleColumns, card_ids=None, sqlwhere=None, params=()):
+        """Returns given schedule columns of many cards as a list of compact
+        arrays, rows are ordered by id.
+        Params: card_ids limits rows to given cards, sqlwhere is an optional
+        SQL condition with params bound to it. Selected columns must not be
+        NULL.
+        """
+        self.checkDbOpen()
+        self.flush()
+        for column in columns:
+            assert column in Cards.ScheduleColumns, "Unknown schedule column %s" % column
+        where = []
+        cur = self.db.cursor()
+        if card_ids is not None:
+            cur.execute('CREATE TEMP TABLE IF NOT EXISTS TSCHEDULE_IDS ( ID INTEGER PRIMARY KEY )')
+            cur.execute('DELETE FROM TSCHEDULE_IDS')
+            cur.executemany('INSERT OR IGNORE INTO TSCHEDULE_IDS VALUES ( ? )', ((card_id,) for card_id in card_ids))
+            where.append('ID IN ( SELECT ID FROM TSCHEDULE_IDS )')
+        if sqlwhere:
+            where.append('( %s )' % sqlwhere)
+        query = 'SELECT %s FROM TCARDS' % ', '.join(columns)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        # rows are transposed into columns, garbage collector would scan the
+        # growing lists again and again while nothing is freed
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            rows = cur.execute(query + ' ORDER BY ID', params).fetchall()
+            values = zip(*rows) or [()] * len(columns)
+            del rows
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if card_ids is not None:
+            cur.execute('DELETE FROM TSCHEDULE_IDS')
+        cur.close()
+        return [array(Cards.ScheduleTypes[column], value) for column, value in zip(columns, values)]
+
+
+    def updateScheduleArrays(self, columns, values):
+        """Writes given schedule columns of many cards in one transaction.
+        Params: columns must start with ID, values is a list of sequences
+        (lists or arrays) in order of columns.
+        """
+        self.checkDbOpen()
+        self.flush()
+        assert columns[0] == 'ID', "First updated column must be ID"
+        for column in columns:
+            assert column in Cards.ScheduleColumns, "Unknown schedule column %s" % column
+        count = len(values[0])
+        if count == 0:
+            return
+        # SCORE of cached cards changes
+        if count < len(self.cache):
+            for card_id in values[0]:
+                self.cache.remove(card_id)
+        else:
+            self.cache.clear()
+        query = 'UPDATE TCARDS SET %s WHERE ID = ?' % ', '.join('%s = ?' % column for column in columns[1:])
+        rebuild = 'NEXT_REVIEW' in columns and count >= Cards.BulkIndexRows
+        with self.transaction():
+            cur = self.db.cursor()
+            if rebuild:
+                cur.execute('DROP INDEX IF EXISTS XI_TCARDS_NEXT_REVIEW')
+            cur.executemany(query, izip(*(tuple(values[1:]) + (values[0],))))
+            if rebuild:
+                cur.execute('CREATE INDEX XI_TCARDS_NEXT_REVIEW ON TCARDS ( NEXT_REVIEW, ID )')
+            cur.close()
+
+
     def existsCard(self, card_id):
         """Returns True if given card_id exists in database."""
         self.checkDbOpen()
@@ -275,45 +1193,55 @@ class Cards(object):
     def deleteCard(self, card_id):
         """Deletes a card from database given it's id"""
         self.checkDbOpen()
-        cur = self.db.cursor()
-
-        cur.execute(r'''DELETE FROM TCARDS WHERE ID = ? ''', (card_id,))
-        assert cur.rowcount == 1, "Problem when updating card = %s" % card_id
-        cur.close()
-        self.db.commit()
+        self._pending.pop(card_id, None)
+        self.cache.remove(card_id)
+        with self.transaction():
+            cur = self.db.cursor()
+            cur.execute(r'''DELETE FROM TCARDS WHERE ID = ? ''', (card_id,))
+            assert cur.rowcount == 1, "Problem when updating card = %s" % card_id
+            cur.close()
 
 
     def deleteAllCards(self):
         """Deletes all cards from database"""
         self.checkDbOpen()
-        cur = self.db.cursor()
-
-        cur.execute(r'''DELETE FROM TCARDS''')
-        cur.close()
-        self.db.commit()
+        self._pending.clear()
+        self.cache.clear()
+        with self.transaction():
+            cur = self.db.cursor()
+            cur.execute(r'''DELETE FROM TCARDS''')
+            cur.close()
 
 
 
     def updateCard(self, card):
-        """Updates a card in database using it's id and other fields. """
+        """Updates a card in database using it's id and other fields.
+        In write-behind mode the card is only cached until flush().
+        """
         self.checkDbOpen()
-        cur = self.db.cursor()
-        cur.execute(r'''UPDATE TCARDS
-                          SET QUESTION    =  ?
-                          , ANSWER        =  ?
-                          , QUESTION_HINT =  ?
-                          , ANSWER_HINT   =  ?
-                          , SCORE         =  ?
-                          WHERE ID        =  ?
-                    ''', (card.question,
-                          card.answer,
-                          card.question_hint,
-                          card.answer_hint,
-                          card.score,
-                          card.id))
-        assert cur.rowcount == 1, "Problem when updating card %s" % card.id
-        cur.close()
-        self.db.commit()
+        if self.writebehind and not self.inTransaction():
+            self._pending[card.id] = card
+            self.cache.put(card)
+            return
+        self._pending.pop(card.id, None)
+        with self.transaction():
+            cur = self.db.cursor()
+            cur.execute(r'''UPDATE TCARDS
+                              SET QUESTION    =  ?
+                              , ANSWER        =  ?
+                              , QUESTION_HINT =  ?
+                              , ANSWER_HINT   =  ?
+                              , SCORE         =  ?
+                              WHERE ID        =  ?
+                        ''', (card.question,
+                              card.answer,
+                              card.question_hint,
+                              card.answer_hint,
+                              card.score,
+                              card.id))
+            assert cur.rowcount == 1, "Problem when updating card %s" % card.id
+            cur.close()
+        self.cache.put(card)
 
 
     def getCardsCount(self):
@@ -330,6 +1258,7 @@ class Cards(object):
     def logCards(self, sqlwhere='', max=None):
         """Helper function for logging cards with given sqlwhere condition."""
         self.checkDbOpen()
+        self.flush()
         cur = self.db.cursor()
         if sqlwhere.strip() != '':
             sqlwhere = 'WHERE %s' % sqlwhere
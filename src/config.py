@@ -41,7 +41,11 @@ class Config(object):
         self._settings = QSettings(QSettings.IniFormat, QSettings.UserScope, 'Mentor', 'mentor')
 
         # const settings - don't change
-        self.DB_VERSION             = '01'
+        self.DB_VERSION             = '03'
+
+        # database settings
+        # one of performance profiles defined in cards.Cards.Profiles
+        self.DB_PROFILE             = 'interactive'
 
         # program command-line parameters
         self.DEBUG                  = False
@@ -53,12 +57,14 @@ class Config(object):
         """Loads user settings from user settings file"""
         self.DEBUG = self._settings.value('debug', QVariant(self.DEBUG)).toBool()
         self.VERBOSE = self._settings.value('verbose', QVariant(self.VERBOSE)).toBool()
+        self.DB_PROFILE = str(self._settings.value('Db/profile', QVariant(self.DB_PROFILE)).toString())
 
 
     def save(self):
         """Saves user settings to user settings file"""
         self._settings.setValue('debug', QVariant(self.DEBUG))
         self._settings.setValue('verbose', QVariant(self.VERBOSE))
+        self._settings.setValue('Db/profile', QVariant(self.DB_PROFILE))
 
 
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Adam Folmert <afolmert@gmail.com>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+#
+#
+"""This is module for language corpus files used by probe.
+
+Corpus file is a binary export of word frequency database made by freq tool.
+It holds words with their frequency levels sorted by word, so that a word is
+found by binary search in the memory mapped file. Nothing is read into memory
+at start and processes using the same corpus share it in page cache.
+
+File layout, all numbers are little-endian unsigned 32 bit:
+    magic, number of words
+    index entries: word offset in data, word size, level
+    data: words encoded in utf-8
+"""
+
+import release
+import mmap
+import struct
+
+__version__ = release.version
+
+
+
+Magic = 'PRBCORP1'
+Header = struct.Struct('<8sI')
+Entry = struct.Struct('<III')
+
+
+def isCorpusFile(path):
+    """Returns True if file at path is a corpus file."""
+    try:
+        file = open(path, 'rb')
+    except IOError:
+        return False
+    try:
+        return file.read(len(Magic)) == Magic
+    finally:
+        file.close()
+
+
+def writeCorpus(fname, words):
+    """Writes corpus file from (word, level) pairs."""
+    entries = []
+    for word, level in words:
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        entries.append((word, level))
+    # words are compared as bytes in lookups
+    entries.sort()
+    file = open(fname, 'wb')
+    try:
+        file.write(Header.pack(Magic, len(entries)))
+        offset = 0
+        for word, level in entries:
+            file.write(Entry.pack(offset, len(word), level))
+            offset += len(word)
+        for word, level in entries:
+            file.write(word)
+    finally:
+        file.close()
+
+
+
+class Corpus(object):
+    """Memory mapped corpus file.
+    If level is given, words in corpus are only those at this level or
+    lower, i.e. the most frequent ones.
+    """
+
+    def __init__(self, path, level=None):
+        self.path = path
+        self.level = level
+        file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        magic, self._count = Header.unpack_from(self._map, 0)
+        if magic != Magic:
+            self._map.close()
+            raise ValueError, "Not a corpus file: %s" % path
+        self._data = Header.size + Entry.size * self._count
+
+
+    def close(self):
+        self._map.close()
+
+
+    def __len__(self):
+        return self._count
+
+
+    def _entry(self, i):
+        """Returns word and level at given position in index."""
+        offset, size, level = Entry.unpack_from(self._map, Header.size + Entry.size * i)
+        start = self._data + offset
+        return self._map[start:start + size], level
+
+
+    def getLevel(self, word):
+        """Returns level of word or None if it is not in corpus."""
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            key, level = self._entry(middle)
+            if key < word:
+                low = middle + 1
+            elif key > word:
+                high = middle
+            else:
+                return level
+        return None
+
+
+    def __contains__(self, word):
+        level = self.getLevel(word)
+        return level is not None and (self.level is None or level <= self.level)
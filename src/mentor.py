@@ -58,6 +58,7 @@ from config import gui_config as config
 from models import CardModel, DrillModel
 from cards import Card
 from views import CardContentView, CardMainView, CardGridView
+from workers import QAImportWorker, QAExportWorker, SearchWorker, WorkerProgressDialog
 
 
 # generate mentor_rc if does not exist
@@ -157,6 +158,12 @@ class DrillWindow(QDialog):
         self.currentCard = self.model.selectNextCard()
         self.cardView.displayCard(self.currentCard, True, False)
 
+    def loadCardIds(self, card_ids):
+        """Loads cards with given ids to model, cards are read from deck."""
+        self.model.addCardIds(card_ids)
+        self.currentCard = self.model.selectNextCard()
+        self.cardView.displayCard(self.currentCard, True, False)
+
     def on_btnNext_clicked(self):
         self.currentCard = self.model.selectNextCard()
         self.cardView.displayCard(self.currentCard, True, False)
@@ -298,6 +305,9 @@ class OptionsDialog(QDialog):
 class MainWindow(QMainWindow):
     """Central window for the Mentor app"""
 
+    # search starts after this many miliseconds without typing
+    SearchDelay = 20
+
     def __init__(self, parent = None):
         QMainWindow.__init__(self, parent)
 
@@ -309,6 +319,10 @@ class MainWindow(QMainWindow):
         # items panel
         self._cardModel = CardModel()
         self._cardModelIndex = QModelIndex()  # current index for card model
+        # search as you type, see txtSearch_textChanged
+        self._searchWorker = None
+        self._searchGeneration = None
+        self._searching = False
 
         self.setWindowTitle("Mentor")
         self.setWindowIcon(QIcon(QPixmap(":/images/mentor.png")))
@@ -336,6 +350,20 @@ class MainWindow(QMainWindow):
         self.gridView = CardGridView(self)
         self.gridView.setModel(self._cardModel)
 
+        self.txtSearch = QLineEdit(self)
+        self.txtSearch.setToolTip(tr("Show only cards containing given words"))
+        self._searchTimer = QTimer(self)
+        self._searchTimer.setSingleShot(True)
+        self.connect(self._searchTimer, SIGNAL('timeout()'), self._startSearch)
+        self.connect(self.txtSearch, SIGNAL('textChanged(const QString &)'), self.txtSearch_textChanged)
+
+        self.gridPane = QWidget(self)
+        gridLayout = QVBoxLayout(self.gridPane)
+        gridLayout.setMargin(0)
+        gridLayout.setSpacing(2)
+        gridLayout.addWidget(self.txtSearch)
+        gridLayout.addWidget(self.gridView)
+
         self.contentView = CardContentView(self)
         self.contentView.setModel(self._cardModel)
 
@@ -343,7 +371,7 @@ class MainWindow(QMainWindow):
         self.splitter = QSplitter(Qt.Horizontal)
         self.splitter.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
-        self.splitter.addWidget(self.gridView)
+        self.splitter.addWidget(self.gridPane)
         self.splitter.addWidget(self.contentView)
         self.splitter.setSizes([200, 500])
 
@@ -369,12 +397,70 @@ class MainWindow(QMainWindow):
                         SIGNAL('clicked(QModelIndex)'), \
                         self.gridView_activated)
 
+        # sorted grid shows all cards again
+        self.connect(self.gridView.horizontalHeader(), SIGNAL('sortIndicatorChanged(int, Qt::SortOrder)'),
+                     self.gridView_sortIndicatorChanged)
         self.connect(self, SIGNAL('cardModelIndexChanged'), self.gridView_cardModelIndexChanged)
         self.connect(self, SIGNAL('cardModelIndexChanged'), self.contentView.currentChanged)
 
 
 
 
+    def txtSearch_textChanged(self, text):
+        # search waits for a pause in typing
+        self._searchTimer.start(MainWindow.SearchDelay)
+
+
+    def _startSearch(self):
+        model = self.cardModel()
+        if not model.isActive():
+            return
+        query = unicode(self.txtSearch.text()).strip()
+        if not query:
+            self._searchGeneration = None
+            if self._searching:
+                self._searching = False
+                self.setCardModelIndex(QModelIndex())
+                model.showAllCards()
+                self.setCardModelIndex(model.index(0, 0))
+            return
+        if self._searchWorker is None:
+            self._searchWorker = SearchWorker(model.filepath(), self)
+            self.connect(self._searchWorker, SIGNAL('found'), self._searchFound)
+            self._searchWorker.start()
+        # worker reads only what is written
+        model.flush()
+        self._searchGeneration = self._searchWorker.search(query)
+
+
+    def _searchFound(self, generation, ids, first):
+        # results of stale queries still queued are dropped
+        if generation != self._searchGeneration:
+            return
+        model = self.cardModel()
+        if first:
+            self._searching = True
+            self.setCardModelIndex(QModelIndex())
+            model.showCardIds(ids)
+            self.setCardModelIndex(model.index(0, 0))
+        else:
+            model.appendCardIds(ids)
+
+
+    def _resetSearch(self):
+        """Stops search worker and clears search, must be called before
+        the deck is closed."""
+        self._searchTimer.stop()
+        if self._searchWorker is not None:
+            self._searchWorker.stop()
+            self._searchWorker = None
+        self._searchGeneration = None
+        self._searching = False
+        self.txtSearch.blockSignals(True)
+        self.txtSearch.clear()
+        self.txtSearch.blockSignals(False)
+
+
     def cardModel(self):
         return self._cardModel
 
@@ -1038,6 +1124,7 @@ class MainWindow(QMainWindow):
         # to clean all other views
         # I must redesign the model/view thing
         self.setCardModelIndex(QModelIndex())
+        self._resetSearch()
         self.cardModel().close()
         try:
             self.cardModel().open(fname)
@@ -1061,6 +1148,7 @@ class MainWindow(QMainWindow):
         # all other views - it must be run before closing cardModel
         # I must redesign the model/view thing
         self.setCardModelIndex(QModelIndex())
+        self._resetSearch()
         self.cardModel().close()
         try:
             # we want to overwrite
@@ -1086,6 +1174,9 @@ class MainWindow(QMainWindow):
 
 
     def qApp_aboutToQuit(self):
+        self._resetSearch()
+        # write edits still waiting for flush timer
+        self.cardModel().flush()
         if self.isMaximized():
             config.GUI_MAXIMIZED = True
         else:
@@ -1110,6 +1201,7 @@ class MainWindow(QMainWindow):
 
     def on_actCloseDeck_triggered(self):
         self.setCardModelIndex(QModelIndex())
+        self._resetSearch()
         self.cardModel().close()
         self._refreshAppState()
 
@@ -1180,8 +1272,18 @@ class MainWindow(QMainWindow):
         # TODO Option if want to clear existing or append
         fname = QFileDialog.getOpenFileName(self, \
             tr("Import Q&A file"), ".", tr("Q&A files (*.*)"))
-        if fname:
-            self.cardModel().importQAFile(str(fname))
+        if fname and self.cardModel().isActive():
+            # views save edits and pending edits are written before worker starts
+            self.setCardModelIndex(QModelIndex())
+            self._resetSearch()
+            self.cardModel().flush()
+            worker = QAImportWorker(self.cardModel().filepath(), str(fname), True)
+            WorkerProgressDialog(worker, tr("Importing Q&A file..."), self).run()
+            if worker.error:
+                show_info(tr("Problem importing file %1:\n%2").arg(fname).arg(worker.error))
+            # deck is changed only if import succeeded
+            if worker.result is not None:
+                self.cardModel().refresh(not worker.clean)
             self.setCardModelIndex(self.cardModel().index(0, 0))
             self._refreshAppState()
 
@@ -1195,7 +1297,14 @@ class MainWindow(QMainWindow):
         pass
 
     def on_actExportQA_triggered(self):
-        pass
+        fname = QFileDialog.getSaveFileName(self, \
+            tr("Export Q&A file"), ".", tr("Q&A files (*.*)"))
+        if fname and self.cardModel().isActive():
+            self.cardModel().flush()
+            worker = QAExportWorker(self.cardModel().filepath(), str(fname))
+            WorkerProgressDialog(worker, tr("Exporting Q&A file..."), self).run()
+            if worker.error:
+                show_info(tr("Problem exporting file %1:\n%2").arg(fname).arg(worker.error))
 
     def on_actExportXML_triggered(self):
         pass
@@ -1220,24 +1329,17 @@ class MainWindow(QMainWindow):
 
     def on_actFinalDrill_triggered(self):
         dialog = DrillWindow(self)
-
-        # FIXME
-        # load cards from model
-        # should it work that way?
-        # should model be more general (and have other operations?) or be
-        # dedicated to browsing list only ?
-        # maybe all operations should be done on the database level
-        # and models only for browsing lists
-        cards = []
-        for row in range(self.cardModel().rowCount()):
-            idx = self.cardModel().index(row, 0)
-            card = self.cardModel().data(idx, Qt.UserRole)
-            cards.append(card)
-
-        dialog.loadCards(cards)
+        dialog.model.setDeck(self.cardModel().cards)
+        # drill holds only ids, cards are read when shown
+        # cards are drilled in grid order and filter
+        self.cardModel().flush()
+        dialog.loadCardIds(self.cardModel().cardIds())
 
         dialog.exec_()
 
+    def gridView_sortIndicatorChanged(self, column, order):
+        self._resetSearch()
+
     def gridView_currentChanged(self, current, previous):
         self.setCardModelIndex(current)
 
@@ -31,10 +31,15 @@ __version__ = release.version
 
 
 import sys
+import time
+import heapq
+from array import array
+from itertools import islice
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
-from cards import Card, Cards
-from utils import isstring, log
+from cards import Card, Cards, readQACards
+from scheduler import Scheduler
+from utils import isstring, log, nvl
 from utils_qt import tr
 
 
@@ -44,9 +49,40 @@ class CardModel(QAbstractItemModel):
     class InvalidIndexError(Exception): pass
     class ModelNotActiveError(Exception): pass
 
+    # card fields displayed in following columns
+    DisplayColumns = ('QUESTION', 'ANSWER', 'QUESTION_HINT', 'ANSWER_HINT', 'SCORE')
+    # number of cards kept in memory, a few screens of rows
+    CacheSize = 2048
+    # edits are written to database after this many miliseconds of quiet
+    FlushDelay = 1000
+    # number of card ids loaded in one block when populating rows
+    FetchSize = 1000
+    # number of cards inserted at once when importing
+    ImportBatchSize = 1000
+
     def __init__(self, parent=None):
         QAbstractListModel.__init__(self, parent)
-        self.cards = Cards()
+        self.cards = Cards(CardModel.CacheSize)
+        self.cards.setWriteBehind(True)
+        self._flushTimer = QTimer(self)
+        self._flushTimer.setSingleShot(True)
+        self.connect(self._flushTimer, SIGNAL('timeout()'), self.flush)
+        # ids of cards in row order, loaded in blocks by fetchMore
+        self._ids = array('l')
+        self._fetchedAll = True
+        # next block is read after this (sort key value, id) position of
+        # the last read card, added cards are not in blocks
+        self._after = None
+        self._addedIds = set()
+        self.fetchSize = CardModel.FetchSize
+        self.importBatchSize = CardModel.ImportBatchSize
+        # rows are sorted and filtered by database, see sort and setFilter
+        self._sortKey = 'ID'
+        self._descending = False
+        self._conditions = []
+        # loads remaining blocks when event loop is idle
+        self._fetchTimer = QTimer(self)
+        self.connect(self._fetchTimer, SIGNAL('timeout()'), self._fetchNext)
 
 
     def _checkIndex(self, index):
@@ -60,16 +96,27 @@ class CardModel(QAbstractItemModel):
 
     def open(self, dbpath):
         self.cards.open(str(dbpath))
+        self._loadIds()
         # FIXME why these do not work??
         self.reset()
         # ^ self.emit(SIGNAL('modelReset()'))
 
     def close(self):
         self.emit(SIGNAL('modelAboutToBeReset()'))
+        self._flushTimer.stop()
+        self._fetchTimer.stop()
         self.cards.close()
+        self._loadIds()
         self.reset()
 
 
+    def flush(self):
+        """Writes pending card edits to database."""
+        self._flushTimer.stop()
+        if self.cards.isOpen():
+            self.cards.flush()
+
+
     def filepath(self):
         """Returns path to currently open database"""
         if self.cards.isOpen():
@@ -89,10 +136,7 @@ class CardModel(QAbstractItemModel):
         if parent.isValid():
             return 0
         else:
-            if self.cards.isOpen():
-                return self.cards.getCardsCount()
-            else:
-                return 0
+            return len(self._ids)
 
 
     def columnCount(self, parent=QModelIndex()):
@@ -106,15 +150,128 @@ class CardModel(QAbstractItemModel):
 
 
     def index(self, row, column, parent=QModelIndex()):
-        if row < 0 or column < 0 or not self.cards.isOpen():
+        if row < 0 or column < 0 or row >= len(self._ids):
             return QModelIndex()
         else:
             #  returns index with given card id
-            header = self.cards.getCardHeaders('', row, row + 1)
-            if len(header) == 1:
-                return self.createIndex(row, column, int(header[0][0]))
-            else:
-                return QModelIndex()
+            return self.createIndex(row, column, self._ids[row])
+
+
+    def _loadIds(self):
+        """Reads first block of card ids, must be called when rows change in
+        database. Remaining blocks are loaded by fetchMore when the view
+        scrolls to them or in background when the event loop is idle.
+        """
+        self._ids = array('l')
+        self._after = None
+        self._addedIds = set()
+        self._fetchedAll = not self.cards.isOpen()
+        if not self._fetchedAll:
+            self._ids = self._fetchBlock()
+            self._fetchTimer.start(0)
+
+
+    def _fetchBlock(self):
+        """Reads next block of card ids, returns them."""
+        ids, self._after = self.cards.seekCardIds(self._after, self.fetchSize, self._sortKey,
+                                                  self._descending, self._conditions)
+        if len(ids) < self.fetchSize:
+            self._fetchedAll = True
+        if self._addedIds:
+            ids = array('l', [i for i in ids if i not in self._addedIds])
+        return ids
+
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sorts rows by given display column, column -1 sorts by card id.
+        Rows are read in sort order from database index, so only the ids are
+        kept in memory.
+        """
+        if column < 0 or column >= len(CardModel.DisplayColumns):
+            sortkey = 'ID'
+        else:
+            sortkey = CardModel.DisplayColumns[column]
+        descending = order == Qt.DescendingOrder
+        if (sortkey, descending) != (self._sortKey, self._descending):
+            self._sortKey = sortkey
+            self._descending = descending
+            self._reload()
+
+
+    def setFilter(self, conditions):
+        """Shows only cards matching all conditions.
+        Params: conditions is a list of (column, operator, value) filters as
+        in Cards.getCardIds, e.g. [('SCORE', '<', 3)]. Empty list shows all
+        cards.
+        """
+        self._conditions = list(conditions or [])
+        self._reload()
+
+
+    def filter(self):
+        return list(self._conditions)
+
+
+    def showCardIds(self, ids):
+        """Shows only cards with given ids, e.g. search results. Further ids
+        may be added with appendCardIds. Use showAllCards to go back."""
+        self.emit(SIGNAL('modelAboutToBeReset()'))
+        self._fetchTimer.stop()
+        self._ids = array('l', ids)
+        self._fetchedAll = True
+        self.reset()
+
+
+    def appendCardIds(self, ids):
+        """Adds rows for given card ids after the shown ones."""
+        if len(ids) > 0:
+            self.beginInsertRows(QModelIndex(), len(self._ids), len(self._ids) + len(ids) - 1)
+            self._ids.extend(ids)
+            self.endInsertRows()
+
+
+    def showAllCards(self):
+        """Shows all cards matching filter after showCardIds."""
+        self._reload()
+
+
+    def _reload(self, announced=False):
+        # edits are saved by views before reset and written before query
+        if not announced:
+            self.emit(SIGNAL('modelAboutToBeReset()'))
+        self._loadIds()
+        self.reset()
+
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._fetchedAll
+
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        self.appendCardIds(self._fetchBlock())
+
+
+    def fetchAll(self):
+        """Loads all remaining card ids."""
+        while self.canFetchMore():
+            self.fetchMore()
+
+
+    def cardIds(self):
+        """Returns ids of cards in row order, as filtered and sorted in the
+        model. Remaining blocks are loaded first."""
+        self.fetchAll()
+        return array('l', self._ids)
+
+
+    def _fetchNext(self):
+        if self.canFetchMore():
+            self.fetchMore()
+        else:
+            self._fetchTimer.stop()
+
 
     # for display role only id+question in following columns will be
     # for specific data , in the following columns
@@ -124,22 +281,28 @@ class CardModel(QAbstractItemModel):
         if role not in (Qt.DisplayRole, Qt.UserRole):
             return QVariant()
 
-        card = self.cards.getCard(index.internalId())
         if role == Qt.UserRole:
-            return card
+            return self.cards.getCard(index.internalId())
         else:
-            if index.column() == 0:
-                return QVariant('#%d %s' % (card.id, str(card.question).strip()))
-            elif index.column() == 1:
-                return QVariant('%s' % str(card.answer).strip())
-            elif index.column() == 2:
-                return QVariant('%s' % str(card.question_hint).strip())
-            elif index.column() == 3:
-                return QVariant('%s' % str(card.answer_hint).strip())
-            elif index.column() == 4:
-                return QVariant('%s' % str(card.score))
-            else:
+            column = index.column()
+            if column < 0 or column >= len(CardModel.DisplayColumns):
                 return QVariant()
+            field = CardModel.DisplayColumns[column]
+            # all columns of a row are painted together, so whole card is
+            # read once and served from cache for the other columns
+            card = self.cards.getCard(index.internalId())
+            if column == 0:
+                return QVariant(u'#%d %s' % (card.id, nvl(card.question, '').strip()))
+            elif column == 4:
+                return QVariant(u'%s' % nvl(card.score, ''))
+            else:
+                return QVariant(u'%s' % nvl(getattr(card, field.lower()), '').strip())
+
+
+    def getCards(self, indexes):
+        """Returns list of cards for given indexes fetched in one go."""
+        cards = self.cards.getCards([index.internalId() for index in indexes])
+        return cards.values()
 
 
     def flags(self, index):
@@ -180,7 +343,9 @@ class CardModel(QAbstractItemModel):
     def getNextIndex(self, index):
         """Returns next index after given or given if it's last."""
         self._checkIndex(index)
-        if index.row() == self.rowCount() - 1:
+        if index.row() == len(self._ids) - 1:
+            self.fetchMore()
+        if index.row() == len(self._ids) - 1:
             return index
         else:
             return self.index(index.row() + 1, 0)
@@ -197,32 +362,25 @@ class CardModel(QAbstractItemModel):
 
 
     def addNewCard(self):
-        """Adds a new empty card."""
-        self.emit(SIGNAL('modelAboutToBeReset()'))
-
+        """Adds a new empty card and returns its index."""
+        # new card goes after loaded rows and stays there until the model is
+        # reloaded, it is skipped when read again in later blocks
         rowid = self.cards.addCard(Card())
-        # TODO is it ok to return it here?
-        result = self.createIndex(self.cards.getCardsCount(), 0, rowid)
-
-        # cards.addCard(Card())
-        # TODO
-        # why these do not work ?
-        self.reset()
-        # self.emit(SIGNAL('modelReset()'))
-        #
-        return result
+        self._addedIds.add(rowid)
+        self.appendCardIds([rowid])
+        return self.index(len(self._ids) - 1, 0)
 
 
     def deleteCard(self, index):
         self._checkIndex(index)
-        self.emit(SIGNAL('modelAboutToBeReset()'))
-
-        self.cards.deleteCard(index.internalId())
-
-        # why these do not work??
-        self.reset()
-        # self.emit(SIGNAL('modelReset()'))
-        # cards - deleteCard  card_id
+        card_id = index.internalId()
+        row = index.row()
+        if row >= len(self._ids) or self._ids[row] != card_id:
+            row = self._ids.index(card_id)
+        self.cards.deleteCard(card_id)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self._ids[row]
+        self.endRemoveRows()
 
     # TODO question
     # how to update card if peg is somewhere else ?
@@ -231,11 +389,18 @@ class CardModel(QAbstractItemModel):
     def updateCard(self, index, question, answer):
         self._checkIndex(index)
 
-        card = Card(index.internalId(), question, answer)
+        # hints and score are not edited here and are kept
+        card = self.cards.getCard(index.internalId())
+        card = Card(card.id, unicode(question), unicode(answer),
+                    card.question_hint, card.answer_hint, card.score)
+        # written by flush timer, so typing in editor makes one write
         self.cards.updateCard(card)
+        self._flushTimer.start(CardModel.FlushDelay)
 
-        # update data in the model
-        self.emit(SIGNAL('dataChanged(QModelIndex)'), index)
+        # only the row of the card is repainted
+        self.emit(SIGNAL('dataChanged(QModelIndex, QModelIndex)'),
+                  self.index(index.row(), 0),
+                  self.index(index.row(), len(CardModel.DisplayColumns) - 1))
 
 
 
@@ -243,44 +408,64 @@ class CardModel(QAbstractItemModel):
     # between database and any more advanced algorithm
     # e.g. database importer
     # btw. they should use the same classes with the probe program
-    # TODO progress bar for importing and possibility to cancel if is a long
-    # operatoin
-    def importQAFile(self, file, clean=True):
+    def importQAFile(self, file, clean=True, progress=None):
         """Import cards from given question&answer file.
         @param file can be file name or file like object
+        @param progress is an optional callback called with number of bytes
+        read and number of cards added after each batch of cards, if it
+        returns False the import is cancelled
+        The file is read line by line and the import is done in one
+        transaction, so failed or cancelled import leaves deck unchanged.
+        Returns number of imported cards or None if cancelled.
         """
-        self.emit(SIGNAL('modelAboutToBeReset()'))
         self._checkActive()
-        if isstring(file):
+        opened = isstring(file)
+        if opened:
             file = open(file, 'rt')
         if clean:
-            self.cards.deleteAllCards()
-        prefix = ''
-        last_prefix = ''
-        card = Card()
-        for line in file.readlines():
-            if line.upper().startswith('Q:') or line.upper().startswith('A:'):
-                last_prefix = prefix
-                prefix = line[:2].upper()
-                line = line[3:]
-                # if new card then recreate
-                if prefix == 'Q:' and prefix != last_prefix:
-                    if not card.isEmpty():
-                        self.cards.addCard(card, False)
-                    card = Card()
-                if line.strip() != '':
-                    if prefix == 'Q:':
-                        card.question += line
-                    else: # prefix == a
-                        card.answer += line
-        # add last card
-        if not card.isEmpty():
-            self.cards.addCard(card)
-
-        # TODO do it in a real transaction way
-        # in case of error do a rollback
-        self.cards.commit()
-        self.reset()
+            # all rows are replaced, views save their edits first
+            self.emit(SIGNAL('modelAboutToBeReset()'))
+        # edits waiting for flush are not part of the import transaction
+        self.cards.flush()
+        read = { 'bytes' : 0 }
+        def report(count):
+            if progress is not None:
+                return progress(read['bytes'], count)
+        result = None
+        try:
+            with self.cards.transaction():
+                if clean:
+                    self.cards.deleteAllCards()
+                ids = self.cards.addCards(readQACards(file, read),
+                                          self.importBatchSize, report)
+            result = ids and ids[1] - ids[0] + 1 or 0
+        except Cards.CancelledError:
+            pass
+        finally:
+            if opened:
+                file.close()
+            if clean:
+                # reset was announced before the import
+                self.cards.cache.clear()
+                self._reload(True)
+            else:
+                self.refresh(True)
+        return result
+
+
+    def refresh(self, appended=False):
+        """Rereads cards after they were changed in database, e.g. by import
+        done with another connection. If cards were only appended, they are
+        added as new rows by fetchMore, otherwise the model is reset.
+        """
+        self.cards.cache.clear()
+        if appended and self._sortKey == 'ID' and not self._descending and not self._conditions:
+            # new cards have the highest ids
+            self._fetchedAll = False
+            self.fetchMore()
+            self._fetchTimer.start(0)
+        else:
+            self._reload()
 
 
 
@@ -289,15 +474,168 @@ class CardModel(QAbstractItemModel):
 # Right now it is just a container (stack) for a bunch of cards which get
 # randomized
 
+class DrillQueue(object):
+    """Queue of card ids in drill, position of a card is its row in model.
+    Cards are taken from the head and put at the tail, but any card may be
+    removed. Removed cards leave empty slots, which are skipped using a
+    binary indexed tree of card counts, so that a card is found by row and
+    row by card in logarithmic time. Slots are compacted when half of them
+    are empty.
+    """
+
+    def __init__(self, ids=()):
+        self._build(list(ids))
+
+
+    def _build(self, ids):
+        self._slots = ids
+        self._pos = dict((card_id, pos) for pos, card_id in enumerate(ids))
+        self._head = 0
+        # _tree[i] is the number of cards in slots i - (i & -i) to i - 1
+        self._tree = [0] + [1] * len(ids)
+        for i in xrange(1, len(self._tree)):
+            j = i + (i & -i)
+            if j < len(self._tree):
+                self._tree[j] += self._tree[i]
+
+
+    def clear(self):
+        self._build([])
+
+
+    def __len__(self):
+        return len(self._pos)
+
+
+    def __contains__(self, card_id):
+        return card_id in self._pos
+
+
+    def __iter__(self):
+        for pos in xrange(self._head, len(self._slots)):
+            if self._slots[pos] is not None:
+                yield self._slots[pos]
+
+
+    def _count(self, pos):
+        """Returns number of cards in slots before given one."""
+        count = 0
+        while pos > 0:
+            count += self._tree[pos]
+            pos &= pos - 1
+        return count
+
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self._pos)
+        if row < 0 or row >= len(self._pos):
+            raise IndexError, "Drill queue index out of range"
+        if row == 0:
+            return self._slots[self._head]
+        elif row == len(self._pos) - 1:
+            return self._slots[-1]
+        # largest slot with row cards before it
+        pos = 0
+        step = 1 << (len(self._slots).bit_length() - 1)
+        while step > 0:
+            if pos + step <= len(self._slots) and self._tree[pos + step] <= row:
+                pos += step
+                row -= self._tree[pos]
+            step >>= 1
+        return self._slots[pos]
+
+
+    def row(self, card_id):
+        """Returns row of card with given id or None if it's not in queue."""
+        pos = self._pos.get(card_id)
+        if pos is None:
+            return None
+        elif pos == self._head:
+            return 0
+        elif pos == len(self._slots) - 1:
+            return len(self._pos) - 1
+        else:
+            return self._count(pos)
+
+
+    def append(self, card_id):
+        pos = len(self._slots)
+        self._slots.append(card_id)
+        self._pos[card_id] = pos
+        i = pos + 1
+        self._tree.append(1 + self._count(pos) - self._count(i - (i & -i)))
+
+
+    def extend(self, ids):
+        ids = list(ids)
+        if len(ids) > len(self._pos):
+            self._build(list(self) + ids)
+        else:
+            for card_id in ids:
+                self.append(card_id)
+
+
+    def remove(self, card_id):
+        pos = self._pos.pop(card_id)
+        self._slots[pos] = None
+        i = pos + 1
+        while i < len(self._tree):
+            self._tree[i] -= 1
+            i += i & -i
+        # head and tail slots always hold cards
+        while self._slots and self._slots[-1] is None:
+            self._slots.pop()
+            self._tree.pop()
+        while self._head < len(self._slots) and self._slots[self._head] is None:
+            self._head += 1
+        if len(self._pos) == 0 or len(self._slots) > 2 * len(self._pos) + 32:
+            self._build(list(self))
+
+
+
 class DrillModel(QAbstractItemModel):
-    """Model for drilling cards"""
+    """Model for drilling cards.
+    The drill holds card ids only, card contents are read from deck when the
+    card is shown. The next few cards in queue are prefetched when the event
+    loop is idle, so that showing them does not wait for database.
+    """
 
     # scores
     Good, Bad = range(2)
-
-    def __init__(self, parent=None):
+    # SM-2 grades given for scores
+    Grades = { Good : 4, Bad : 1 }
+    # delays in seconds after which a failed card is shown again, each good
+    # score moves it to the next step until it leaves the drill
+    LearningSteps = (60, 600)
+    # number of cards read ahead from deck
+    PrefetchSize = 32
+
+    def __init__(self, parent=None, clock=None):
         QAbstractItemModel.__init__(self, parent)
-        self.cards = []
+        # drill queue of card ids, next card is taken from the head and put
+        # back at the tail, so the current card is always the last one
+        self.ids = DrillQueue()
+        # cards added as objects and not read from deck
+        self._cards = {}
+        # failed cards waiting to be shown again: heap of (due, seq, id)
+        # entries and dict of id -> (step, seq), entries with other seq
+        # than in the dict are stale
+        self._relearning = []
+        self._learning = {}
+        self._seq = 0
+        self.clock = clock or time.time
+        self.deck = None
+        self.scheduler = Scheduler()
+        self._prefetchTimer = QTimer(self)
+        self._prefetchTimer.setSingleShot(True)
+        self.connect(self._prefetchTimer, SIGNAL('timeout()'), self.prefetch)
+
+
+    def setDeck(self, deck):
+        """Sets Cards storage from which cards are read and in which scores
+        given in drill are scheduled."""
+        self.deck = deck
 
 
     def parent(self, index=QModelIndex()):
@@ -307,7 +645,7 @@ class DrillModel(QAbstractItemModel):
         if parent.isValid():
             return 0
         else:
-            return len(self.cards)
+            return len(self.ids)
 
     def columnCount(self, parent=QModelIndex()):
         if parent.isValid():
@@ -319,7 +657,7 @@ class DrillModel(QAbstractItemModel):
         if parent.isValid():
             return QModelIndex()
         else:
-            if row >= 0 and row < len(self.cards) and column == 0:
+            if row >= 0 and row < len(self.ids) and column == 0:
                 return self.createIndex(row, column, None)
             else:
                 return QModelIndex()
@@ -329,9 +667,9 @@ class DrillModel(QAbstractItemModel):
         if role not in (Qt.DisplayRole,):
             return QVariant()
         else:
-            if index.row() < len(self.cards):
-                card = self.cards[index.row()]
-                return QVariant("%d %s" % (card.id, card.question))
+            if index.row() < len(self.ids):
+                card = self.getCard(self.ids[index.row()])
+                return QVariant(u"%d %s" % (card.id, card.question))
             else:
                 return QVariant()
 
@@ -344,57 +682,223 @@ class DrillModel(QAbstractItemModel):
         return Qt.ItemIsEnabled | Qt.ItemIsSelectable
 
 
+    def getCard(self, card_id):
+        """Returns card in drill given it's id."""
+        card = self._cards.get(card_id)
+        if card is None:
+            card = self.deck.getCard(card_id)
+        return card
+
+
+    def prefetch(self):
+        """Reads next cards in queue from deck into its cache in one query."""
+        if self.deck is None or not self.deck.isOpen():
+            return
+        ids = [card_id for card_id in islice(self.ids, DrillModel.PrefetchSize)
+               if card_id not in self._cards and card_id not in self.deck.cache]
+        if ids:
+            self.deck.getCards(ids)
+
+
     def addCard(self, card):
-        self.emit(SIGNAL('modelAboutToBeReset()'))
-        self.cards.append(card)
-        self.reset()
+        """Adds card at the end of queue, card already in queue is ignored."""
+        if card.id in self.ids:
+            return
+        self._cards[card.id] = card
+        self._appendIds([card.id])
+
+
+    def addCardIds(self, card_ids):
+        """Adds cards with given ids at the end of queue, cards are read
+        from deck when needed."""
+        self._appendIds([card_id for card_id in card_ids if card_id not in self.ids])
+
+
+    def _appendIds(self, card_ids):
+        if len(card_ids) == 0:
+            return
+        row = len(self.ids)
+        self.beginInsertRows(QModelIndex(), row, row + len(card_ids) - 1)
+        self.ids.extend(card_ids)
+        self.endInsertRows()
+
 
     def clear(self):
-        self.emit(SIGNAL('modelAboutToBeReset()'))
-        self.cards.clear()
-        self.reset()
+        if len(self.ids) > 0:
+            self.beginRemoveRows(QModelIndex(), 0, len(self.ids) - 1)
+            self.ids.clear()
+            self.endRemoveRows()
+        self._cards.clear()
+        self._relearning = []
+        self._learning.clear()
+
+
+    def learningCount(self):
+        """Returns number of failed cards waiting to be shown again."""
+        return len(self._learning)
+
+
+    def _pushLearning(self, card_id, step):
+        """Schedules card to be shown again after given learning step."""
+        self._seq += 1
+        self._learning[card_id] = (step, self._seq)
+        due = self.clock() + DrillModel.LearningSteps[step]
+        heapq.heappush(self._relearning, (due, self._seq, card_id))
+
+
+    def _popLearning(self, force=False):
+        """Returns id of failed card which is due to be shown again or None.
+        If force is True the card due first is returned even if not yet due.
+        """
+        now = self.clock()
+        while self._relearning:
+            due, seq, card_id = self._relearning[0]
+            entry = self._learning.get(card_id)
+            if entry is None or entry[1] != seq:
+                heapq.heappop(self._relearning)
+            elif due <= now or force:
+                heapq.heappop(self._relearning)
+                # card keeps its step until it's scored again
+                self._learning[card_id] = (entry[0], None)
+                return card_id
+            else:
+                return None
+        return None
+
+
+    def hasCard(self, card):
+        return card.id in self.ids
+
+
+    def _reorder(self, order):
+        """Puts cards in given order of their current rows."""
+        self.emit(SIGNAL('layoutAboutToBeChanged()'))
+        ids = list(self.ids)
+        self.ids = DrillQueue(ids[row] for row in order)
+        # keep selection in views on the same cards
+        rows = dict((old, new) for new, old in enumerate(order))
+        for index in self.persistentIndexList():
+            if index.row() in rows:
+                self.changePersistentIndex(index, self.index(rows[index.row()], index.column()))
+        self.emit(SIGNAL('layoutChanged()'))
 
 
     def selectNextCard(self):
-        # take from the stack and put it on top
-        if len(self.cards) > 0:
-            self.emit(SIGNAL('modelAboutToBeReset()'))
-            result = self.cards[0]
-            self.cards = self.cards[1:]
-            self.cards.append(result)
-            self.reset()
-            return result
+        """Returns next card to be shown.
+        Failed cards which are due come first, then cards are taken from the
+        head of queue and put at the tail. If the queue is empty, the failed
+        card due first is shown even if not yet due.
+        """
+        card_id = self._popLearning(len(self.ids) == 0)
+        if card_id is not None:
+            self._appendIds([card_id])
+        elif len(self.ids) > 0:
+            # take from the stack and put it on top
+            card_id = self.ids[0]
+            self._requeueRow(0)
         else:
             return Card()
+        self._prefetchTimer.start(0)
+        return self.getCard(card_id)
+
+
+    def _findRow(self, card_id):
+        """Returns row of card with given id in queue or None."""
+        return self.ids.row(card_id)
+
+
+    def _takeRow(self, row):
+        """Removes card in given row from queue and returns its id."""
+        card_id = self.ids[row]
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.ids.remove(card_id)
+        self.endRemoveRows()
+        return card_id
+
+
+    def _requeueRow(self, row):
+        if row != len(self.ids) - 1:
+            self._appendIds([self._takeRow(row)])
+
 
     def removeCard(self, card):
-        try:
-            self.emit(SIGNAL('modelAboutToBeReset()'))
-            self.cards.remove(card)
-            self.reset()
-        except:
-            pass
+        row = self._findRow(card.id)
+        if row is not None:
+            self._takeRow(row)
+
+
+    def requeueCard(self, card):
+        """Moves card to the end of queue."""
+        row = self._findRow(card.id)
+        if row is not None:
+            self._requeueRow(row)
 
 
     def scoreCard(self, card, score):
-        if score == DrillModel.Good:
-            log("Card: $card will be removed from drill.")
-            self.removeCard(card)
+        """Scores card shown in drill.
+        Failed card leaves the queue and comes back after first learning step.
+        Good score moves a failed card to the next step, card which passed
+        all steps or was not failed in this drill is removed from drill.
+        Only the first answer is a review scheduled in deck, later answers
+        of a failed card only move it between learning steps.
+        """
+        if self.deck is not None and card.id is not None and card.id not in self._learning:
+            self.scheduler.reviewCard(self.deck, card.id, DrillModel.Grades[score])
+        self.removeCard(card)
+        if score == DrillModel.Bad:
+            self._pushLearning(card.id, 0)
+        else:
+            entry = self._learning.pop(card.id, None)
+            if entry is not None and entry[0] + 1 < len(DrillModel.LearningSteps):
+                self._pushLearning(card.id, entry[0] + 1)
+            else:
+                log("Card: $card will be removed from drill.")
+                self._cards.pop(card.id, None)
+
+
+    def getState(self):
+        """Returns state of drill session as a dict of plain values, which
+        can be pickled or saved as json and restored with setState.
+        """
+        learning = [(due, card_id, self._learning[card_id][0])
+                    for due, seq, card_id in self._relearning
+                    if card_id in self._learning and self._learning[card_id][1] == seq]
+        return { 'queue'    : list(self.ids),
+                 'learning' : [list(entry) for entry in sorted(learning)],
+                 # failed cards which are shown again and not scored yet
+                 'steps'    : [[card_id, entry[0]] for card_id, entry in self._learning.iteritems()
+                               if entry[1] is None] }
+
+
+    def setState(self, state):
+        """Restores drill session saved with getState.
+        Cards are read from deck set with setDeck when they are shown.
+        """
+        assert self.deck is not None, "Deck must be set to restore drill."
+        self.clear()
+        self.addCardIds(state['queue'])
+        for card_id, step in state['steps']:
+            self._learning[card_id] = (step, None)
+        for due, card_id, step in state['learning']:
+            self._seq += 1
+            self._learning[card_id] = (step, self._seq)
+            self._relearning.append((due, self._seq, card_id))
+        heapq.heapify(self._relearning)
 
 
     def shuffleCards(self):
         from random import shuffle
-        self.emit(SIGNAL('modelAboutToBeReset()'))
-        shuffle(self.cards)
-        self.reset()
+        order = range(len(self.ids))
+        shuffle(order)
+        self._reorder(order)
 
 
     def printCards(self):
         print "Printing cards..."
         sys.stdout.flush()
         i = 0
-        for card in self.cards:
-            print "%d %s\n" % (i, str(card))
+        for card_id in self.ids:
+            print "%d %s\n" % (i, str(self.getCard(card_id)))
             sys.stdout.flush()
             i += 1
         print "Done."
@@ -30,52 +30,39 @@ like Mentor or SuperMemo.
 
 from utils import log, info, enable_logging, Enumeration, error, ensure_endswith
 from config import probe_config as config
+from corpus import Corpus, isCorpusFile
 from StringIO import StringIO
+from bisect import bisect_right
+from itertools import groupby
+from operator import itemgetter
+import gc
 import re
+import string
 import sys
 import os
+import time
 import release
 
 
 __version__ = release.version
 
-# special functions
-EscapeChars = [(r'\|', '#&prbbar;'),
-               (r'\\', '#&prbbsp;'),
-               (r'\/', '#&prbslash;'),
-               (r'\{', '#&prbbrcleft;'),
-               (r'\}', '#&prbbrcright;'),
-               (r'\?', '#&prbquest;'),
-               (r'\!', '#&prbexclam;')]
-EscapePattern = r'#&prbbar;|#&prbbsp;|#&prbslash;|#&prbbrcleft;|#&prbbrcright;|#&prbquest;|#&prbexclam;'
-
-
-
-
-def escapeSpecialChars(text):
-    """Escapes special chars with custom codes.
-    This prepares text for processing.
-    """
-    # TODO This is very primite escaping and very time consuming because I read the
-    # text many times
-    # I should escape the text as I read it online in a tokenizer - whenever I
-    # encounter \ backslash, I should check the next char and return normal char
-    # instead of control char
-    for sequence, escape in EscapeChars:
-        text = text.replace(sequence, escape)
-    return text
-
-
-def unescapeSpecialChars(text):
-    """Unescapes special chars with custom codes.
-    This fixes text after processing.
-    """
-    # see escapeSpecialChars on comment how to do it the right way
-    # currently, this is symmetric to escapeSpecialChars
-    for sequence, escape in EscapeChars:
-    # obviously, I have to omit the backslash in output text
-        text = text.replace(escape, sequence[1:])
-    return text
+# special chars
+# chars which may be escaped with a backslash
+EscapeChars = '|\\/{}?!'
+# escaped chars are kept in tokenizer as these control codes, so that markup
+# patterns do not match them, and are turned back into plain chars in tokens
+EscapeCodes = dict((c, chr(i + 1)) for i, c in enumerate(EscapeChars))
+EscapeCodeRegexp = re.compile('[%s]' % ''.join(EscapeCodes.values()))
+UnescapeTable = string.maketrans(''.join([EscapeCodes[c] for c in EscapeChars]), EscapeChars)
+UnicodeUnescapeTable = dict((ord(EscapeCodes[c]), unicode(c)) for c in EscapeChars)
+
+
+def unescapeCodes(text):
+    """Returns text with escape codes turned back into plain chars."""
+    if isinstance(text, unicode):
+        return text.translate(UnicodeUnescapeTable)
+    else:
+        return text.translate(UnescapeTable)
 
 
 
@@ -141,6 +128,10 @@ class ASTOptions(object):
 class ASTObject(object):
     """The root of all AST objects."""
 
+    # most of the tree are words and blocks, their classes add no slots so
+    # they are built without a per object dict
+    __slots__ = ('parent', 'name', 'content', 'options', 'children')
+
     def __init__(self, parent=None, name="", content=""):
         self.parent = parent
         self.name = name
@@ -208,45 +199,59 @@ class ASTObject(object):
 class ASTWord(ASTObject):
     """This is a simple object consisting of text."""
 
+    __slots__ = ()
+
+    # options in the order in which addOption would add them: should the
+    # word be included in or ignored from questioning, and question and
+    # answer hint connected with the word
+    Options = (('marked', False), ('ignored', False), ('question_hint', ''), ('answer_hint', ''))
+
     def __init__(self, parent=None, content=''):
-        ASTObject.__init__(self, parent, content)
+        # words are most of the tree, so they are built without the generic
+        # initialization of ASTObject and share default options until one
+        # of them is set
+        self.parent = parent
+        self.name = content
         self.content = content
+        self.options = DefaultWordOptions
+        self.children = []
+
+
+    def setOption(self, name, value):
+        if self.options is DefaultWordOptions:
+            self.options = ASTOptions()
+            self.initOptions()
+        self.options.setOption(name, value)
 
 
     def initOptions(self):
-        self.options.clear()
-        # should the word be included in questioning
-        self.options.addOption('marked', ASTOptions.Boolean, default=False)
-        # should the word be ignored from questioning
-        self.options.addOption('ignored', ASTOptions.Boolean, default=False)
-        # question and answer hint connected with the word
-        self.options.addOption('question_hint', ASTOptions.String, default='')
-        self.options.addOption('answer_hint', ASTOptions.String, default='')
+        self.options.options = dict(ASTWord.Options)
+
+
+# options of words which have none set
+DefaultWordOptions = ASTOptions()
+DefaultWordOptions.options = dict(ASTWord.Options)
 
 
 class ASTSeparatorWord(ASTWord):
     """This is a separator class used in verbatim mode."""
-    def __init__(self, parent=None, content=''):
-        ASTObject.__init__(self, parent, content)
-        self.content = content
+    __slots__ = ()
 
 class ASTIdentWord(ASTWord):
     """This is a identifier word class used in verbatim mode."""
-    def __init__(self, parent=None, content=''):
-        ASTObject.__init__(self, parent, content)
-        self.content = content
+    __slots__ = ()
 
 class ASTPunctationWord(ASTWord):
     """This is a punctation word class used in verbatim mode."""
-    def __init__(self, parent=None, content=''):
-        ASTObject.__init__(self, parent, content)
-        self.content = content
+    __slots__ = ()
 
 
 
 class ASTBlock(ASTObject):
     """ASTBlock is a block of content. It usually consists of ASTWord objects."""
 
+    __slots__ = ()
+
     def initOptions(self):
         self.options.clear()
         self.options.addOption('ignored', ASTOptions.Boolean)
@@ -271,6 +276,8 @@ class ASTAnswerHint(ASTHint):
 class ASTCommand(ASTObject):
     """Generic AST command object."""
 
+    __slots__ = ('command',)
+
     def __init__(self, parent=None, name='', content=''):
         ASTObject.__init__(self, parent, name, content)
         self.command = None
@@ -420,10 +427,301 @@ class OutputItems(object):
 # will be a function , register parse command - or not a function
 # i will just put this file in plugins and it will read it's name and change it to command class
 # will have to provide function for parseContent returning list of child object
-ParseCommands = Enumeration('ParseCommands', ['title', 'section', 'subsection', 'tabbed', 'sentence', 'paragraph', 'definition'
+ParseCommands = Enumeration('ParseCommands', ['title', 'section', 'subsection', 'tabbed', 'sentence', 'paragraph', 'definition',
                                              'subsubsection', 'verbatim', 'code', 'pythoncode'])
 # main regexp used to search for parsed object
-ParseRegexp = re.compile("\\\\(title|section|tabbed|sentence|paragraph|definition|subsection|verbatim|code|pythoncode)(\[[^]]*\])?({[^}]*})?", re.M)
+ParseRegexp = re.compile(r"\\(title|section|tabbed|sentence|paragraph|definition|subsection|verbatim|code|pythoncode)")
+
+
+class Tokenizer(object):
+    """Reads probe file and returns its tokens in a single pass.
+    The file is read line by line, so it may be a stream. Tokens are tuples
+    (kind, text, offset) where offset is the position of the token in file.
+
+    Each command gives a Command token with its name, an Options token if
+    it has options and tokens of its content followed by an End token.
+    Content of commands which have a mode is split into Word, Marked and
+    Ignored tokens with BlockEnd token after each block, QuestionHint and
+    AnswerHint tokens go before the Marked token they belong to. Content of
+    other commands is given as a single Content token.
+    Text outside commands is read as content of the default command.
+    """
+
+    # token kinds
+    Command, Options, Content, Word, Marked, Ignored, QuestionHint, AnswerHint, BlockEnd, End = range(10)
+
+    # size of text read from file at once
+    ChunkSize = 65536
+
+    BackslashRegexp = re.compile(r'\\+')
+    GroupRegexp = re.compile(r'(\|[^\|]*\|)|(/[^/]*/)')
+    MarkedRegexp = re.compile(r'([^\?\!]*\?)?([^\?\!]*\!)?(.*)')
+    NonSpaceRegexp = re.compile(r'\S')
+
+    def __init__(self, file, modes, default='sentence'):
+        """Params: modes is a dict of (block_regexp, word_regexp) used to
+        split content of commands, see ParseClassCommand.getContentMode.
+        Params: default is the command used for text outside commands.
+        """
+        self.file = file
+        self.modes = modes
+        self.default = default
+        # text read and not tokenized yet, starting at _base position
+        self._buf = ''
+        self._base = 0
+        self._eof = False
+        # next line is read ahead as comment on it removes the newline before
+        self._next = file.readline()
+        self._source = 0
+        # offset in file of position in text is the position plus delta of
+        # the last break before it, breaks are at line starts and after each
+        # escape code, as the code stands for two chars
+        self._breaks = []
+        self._deltas = []
+
+
+    def _readLine(self, line):
+        """Returns line with comment removed and escaped chars replaced by
+        codes, and list of positions of the codes."""
+        # comment starts at % which does not follow a backslash and takes
+        # the char before it
+        k = line.find('%')
+        while k > 0 and line[k - 1] == '\\':
+            k = line.find('%', k + 1)
+        if k >= 0:
+            line = line[:max(k - 1, 0)] + (line.endswith('\n') and '\n' or '')
+        if '\\' not in line:
+            return line, None
+        result = []
+        escapes = []
+        pos = 0
+        size = 0
+        for match in Tokenizer.BackslashRegexp.finditer(line):
+            start, end = match.span()
+            count = end - start
+            char = line[end:end + 1]
+            if char == '|':
+                # escaped bar goes first, then pairs of backslashes
+                pairs, single, escaped = (count - 1) // 2, (count - 1) % 2, char
+            elif count % 2 == 1 and char and char in EscapeChars:
+                pairs, single, escaped = count // 2, 0, char
+            else:
+                pairs, single, escaped = count // 2, count % 2, None
+            size += start - pos
+            result.append(line[pos:start])
+            escapes.extend(range(size, size + pairs))
+            result.append(EscapeCodes['\\'] * pairs + '\\' * single)
+            size += pairs + single
+            pos = end
+            if escaped:
+                escapes.append(size)
+                result.append(EscapeCodes[escaped])
+                size += 1
+                pos += 1
+        result.append(line[pos:])
+        return ''.join(result), escapes
+
+
+    def _fill(self):
+        """Reads next lines into buffer, returns False at end of file."""
+        if self._eof:
+            return False
+        chunk = []
+        size = 0
+        start = self._base + len(self._buf)
+        while size < Tokenizer.ChunkSize:
+            line = self._next
+            if not line:
+                self._eof = True
+                break
+            self._next = self.file.readline()
+            text, escapes = self._readLine(line)
+            if self._next.startswith('%') and text.endswith('\n'):
+                text = text[:-1]
+            delta = self._source - start - size
+            self._breaks.append(start + size)
+            self._deltas.append(delta)
+            if escapes:
+                for k, escape in enumerate(escapes):
+                    self._breaks.append(start + size + escape + 1)
+                    self._deltas.append(delta + k + 1)
+            self._source += len(line)
+            chunk.append(text)
+            size += len(text)
+        self._buf += ''.join(chunk)
+        return size > 0
+
+
+    def _trim(self, pos):
+        """Drops tokenized text before pos, returns new position of pos."""
+        if pos < Tokenizer.ChunkSize:
+            return pos
+        # pos may be past the text read so far
+        size = min(pos, len(self._buf))
+        self._buf = self._buf[size:]
+        self._base += size
+        index = bisect_right(self._breaks, self._base) - 1
+        if index > 1024:
+            del self._breaks[:index]
+            del self._deltas[:index]
+        return pos - size
+
+
+    def _offset(self, pos):
+        """Returns offset in file of given position in buffer."""
+        pos += self._base
+        return pos + self._deltas[bisect_right(self._breaks, pos) - 1]
+
+
+    def _char(self, pos):
+        """Returns char at given position in buffer or '' at end of file."""
+        while pos >= len(self._buf) and self._fill():
+            pass
+        return self._buf[pos:pos + 1]
+
+
+    def _find(self, char, pos):
+        """Returns position of char in buffer starting from pos or -1."""
+        index = self._buf.find(char, pos)
+        while index < 0 and self._fill():
+            index = self._buf.find(char, pos)
+        return index
+
+
+    def _search(self, regexp, pos):
+        """Returns match of regexp in buffer starting from pos or None."""
+        match = regexp.search(self._buf, pos)
+        while match is None and self._fill():
+            match = regexp.search(self._buf, pos)
+        return match
+
+
+    def tokens(self):
+        """Returns generator of tokens."""
+        pos = 0
+        while True:
+            pos = self._trim(pos)
+            match = self._search(ParseRegexp, pos)
+            if match:
+                end = match.start()
+            else:
+                end = len(self._buf)
+            if Tokenizer.NonSpaceRegexp.search(self._buf, pos, end):
+                # text outside commands is content of default command, which
+                # ends at first closing brace
+                close = self._buf.find('}', pos, end)
+                if close < 0:
+                    close = end
+                for token in self._commandTokens(self.default, pos, None, (pos, close)):
+                    yield token
+            if match is None:
+                break
+            start = match.start()
+            pos = match.end()
+            options = None
+            if self._char(pos) == '[':
+                close = self._find(']', pos + 1)
+                if close >= 0:
+                    options = (pos + 1, close)
+                    pos = close + 1
+            content = None
+            if self._char(pos) == '{':
+                close = self._find('}', pos + 1)
+                if close >= 0:
+                    content = (pos + 1, close)
+                    pos = close + 1
+            for token in self._commandTokens(match.group(1), start, options, content):
+                yield token
+            # char after command is skipped
+            pos += 1
+
+
+    def _text(self, start, end):
+        return unescapeCodes(self._buf[start:end])
+
+
+    def _commandTokens(self, name, start, options, content):
+        """Returns list of tokens of command with options and content given
+        as (start, end) positions in buffer."""
+        tokens = [(Tokenizer.Command, name, self._offset(start))]
+        if options:
+            tokens.append((Tokenizer.Options, self._text(*options), self._offset(options[0])))
+        mode = self.modes.get(name)
+        if mode is None:
+            if content:
+                tokens.append((Tokenizer.Content, self._text(*content), self._offset(content[0])))
+            else:
+                tokens.append((Tokenizer.Content, None, self._offset(start)))
+        elif content and content[1] > content[0]:
+            self._contentTokens(tokens, mode, *content)
+        if content:
+            start = content[1]
+        tokens.append((Tokenizer.End, None, self._offset(start)))
+        return tokens
+
+
+    def _contentTokens(self, tokens, mode, start, end):
+        """Appends to tokens the content between given positions split in
+        blocks and words."""
+        block_regexp, word_regexp = mode
+        buf = self._buf
+        # escape codes are single chars, so text of tokens is taken from
+        # unescaped copy of content at the same positions shifted by start
+        plain = unescapeCodes(buf[start:end])
+        breaks, deltas, base = self._breaks, self._deltas, self._base
+        offset = lambda i: i + base + deltas[bisect_right(breaks, i + base) - 1]
+        # words come in order of their positions, so the last break before
+        # each word is found by stepping forward from the previous one
+        k = bisect_right(breaks, start + base) - 1
+        last = len(breaks) - 1
+        next_break = breaks[k + 1] - base if k < last else sys.maxint
+        append = tokens.append
+        Word, Marked, Ignored, BlockEnd = Tokenizer.Word, Tokenizer.Marked, Tokenizer.Ignored, Tokenizer.BlockEnd
+        group_search = Tokenizer.GroupRegexp.search
+        pos = start
+        blocks = [match.span() for match in block_regexp.finditer(buf, start, end)]
+        blocks.append((end, end))
+        for block_end, next_pos in blocks:
+            group = group_search(buf, pos, block_end)
+            while pos < block_end:
+                if group is None:
+                    words_end = block_end
+                else:
+                    words_end = group.start()
+                # words between groups
+                word_pos = pos
+                separators = [match.span() for match in word_regexp.finditer(buf, pos, words_end)]
+                separators.append((words_end, words_end))
+                for word_end, next_word in separators:
+                    word = plain[word_pos - start:word_end - start]
+                    stripped = word.strip()
+                    if stripped:
+                        word_start = word_end - len(word.lstrip())
+                        while word_start >= next_break:
+                            k += 1
+                            next_break = breaks[k + 1] - base if k < last else sys.maxint
+                        append((Word, stripped, word_start + base + deltas[k]))
+                    word_pos = next_word
+                if group is None:
+                    break
+                i, pos = group.span()
+                if group.group(1):
+                    match = Tokenizer.MarkedRegexp.match(buf, i + 1, pos - 1)
+                    question_hint, answer_hint, word = match.groups()
+                    if question_hint:
+                        # hints are given without ? and ! marks
+                        append((Tokenizer.QuestionHint, unescapeCodes(question_hint.strip())[:-1].strip(),
+                                offset(match.start(1))))
+                    if answer_hint:
+                        append((Tokenizer.AnswerHint, unescapeCodes(answer_hint.strip())[:-1].strip(),
+                                offset(match.start(2))))
+                    append((Marked, unescapeCodes(word), offset(i)))
+                else:
+                    append((Ignored, plain[i + 1 - start:pos - 1 - start], offset(i)))
+                group = group_search(buf, pos, block_end)
+            append((BlockEnd, None, offset(block_end)))
+            pos = next_pos
+
 
 
 class ParseObject(object):
@@ -441,21 +739,35 @@ class ParseCommand(ParseObject):
 
     def parse(self, text=''):
         """Parse procedure for commands."""
+        tokens = Tokenizer(StringIO(text), ParseFile().getModes()).tokens()
+        # first token is the command
+        for kind, command, offset in tokens:
+            return self.parseTokens(command, tokens)
+        error("No match found in parsing command for text = " + text)
+
+    def parseTokens(self, command, tokens):
+        """Returns ast object for command reading its tokens up to the End
+        token."""
         ast_obj = self.initAstObject()
-
-        match = re.match(ParseRegexp, text, re.M)
-        if match:
-            self.parseCommand(ast_obj, match.groups()[0])
-            self.parseOptions(ast_obj, match.groups()[1])
-            self.parseContent(ast_obj, match.groups()[2])
-            return ast_obj
-        else:
-            error("No match found in parsing command for text = " + text)
+        self.parseCommand(ast_obj, command)
+        for kind, text, offset in tokens:
+            if kind == Tokenizer.End:
+                break
+            elif kind == Tokenizer.Options:
+                self.parseOptions(ast_obj, text)
+            else:
+                self.parseContent(ast_obj, kind, text)
+        return ast_obj
 
     def initAstObject(self):
         """This is to be overriden to return the object to be returned."""
         return ASTCommand()
 
+    def getContentMode(self):
+        """Returns how the tokenizer splits content of the command.
+        None means content is given as a whole."""
+        return None
+
     def parseCommand(self, ast_obj, command):
         """Returns command from ParseCommands enumeration type."""
         log('parseCommand for command = $command')
@@ -464,18 +776,14 @@ class ParseCommand(ParseObject):
         # right now it does not do anything
         # TODO command should be enumerations which shall be returned in here
 
-    def parseContent(self, ast_obj, content):
+    def parseContent(self, ast_obj, kind, content):
         """Returns content."""
-        if len(content) > 2:
-            ast_obj.content = unescapeSpecialChars(content[1:-1])
-        else:
-            ast_obj.content = None
+        ast_obj.content = content or None
 
     def parseOptions(self, ast_obj, options):
         """This will parse options embedded in begin or option statement."""
         log("parsing options $options")
         if options != None:
-            options = options[1:-1]       # strip the [] brackets o
             options = options.split(",")
 
             for o in options:
@@ -513,7 +821,7 @@ class ParseClassCommand(ParseCommand):
         """Virtual function to be overriden in subclasses.
         This regex will be used to split content into blocks.
         Function parseContent uses this to parse content."""
-        return '[\.]+|#&prbquest;|#&prbexclam;'
+        return r'[\.]+|%s|%s' % (EscapeCodes['?'], EscapeCodes['!'])
 
     def getWordSplitRegex(self):
         """Virtual function to be overriden in subclasses.
@@ -521,36 +829,48 @@ class ParseClassCommand(ParseCommand):
         Function parseContent uses this to parse content."""
         return '[ \t\n]+'
 
+    def getContentMode(self):
+        """Content is split by the tokenizer into blocks and words."""
+        return (re.compile(self.getBlockSplitRegex()), re.compile(self.getWordSplitRegex()))
+
+
+    def parseTokens(self, command, tokens):
+        # words are added to current block, hints wait for their marked word
+        self.ast_block = ASTBlock()
+        self.hints = []
+        ast_obj = self.initAstObject()
+        self.parseCommand(ast_obj, command)
+        # plain words and block ends are most of the tokens, so they are
+        # handled here and not through parseContent
+        Word, BlockEnd, End, Options = Tokenizer.Word, Tokenizer.BlockEnd, Tokenizer.End, Tokenizer.Options
+        ast_block = self.ast_block
+        for kind, text, offset in tokens:
+            if kind == Word:
+                ast_block.children.append(ASTWord(ast_block, text))
+            elif kind == BlockEnd:
+                ast_obj.addChild(ast_block)
+                ast_block = self.ast_block = ASTBlock()
+            elif kind == End:
+                break
+            elif kind == Options:
+                self.parseOptions(ast_obj, text)
+            else:
+                self.parseContent(ast_obj, kind, text)
+        return ast_obj
+
 
     def parseMarkedContent(self, ast_block, content):
         """Parses a group of words | | which should be included in repetition.
         This group is treated as single entity.
-        Optionally it may contain question and answer hints.
+        Optionally it may contain question and answer hints, which are given
+        before by the tokenizer.
         """
         log('parseMarkedContent for block $content')
-        # strip off | | chars
-        if len(content) > 1:
-            content = content[1:-1]
-        # include block may be in format:
-        # |question hint? answer hint! text|
-        regexp = r'([^\?\!]*\?)?([^\?\!]*\!)?(.*)'
-        match = re.match(regexp, content)
-        log('parseMarkedContent match groups $match.groups()')
-        if match:
-            # add word with content
-            ast_word = ASTWord(ast_block, unescapeSpecialChars(match.groups()[2]))
-            # add hints if they exist
-            # question hint (?)
-            if match.groups()[0]:
-                hint = match.groups()[0].strip()
-                hint = unescapeSpecialChars(hint)[:-1].strip() # remove the question mark ?
-                ast_word.setOption('question_hint', hint)
-            if match.groups()[1]:
-                hint = match.groups()[1].strip()
-                hint = unescapeSpecialChars(hint)[:-1].strip() # remove the exclamation !
-                ast_word.setOption('answer_hint', hint)
-        else:
-            raise "Invalid include block - not matched! %s " % content
+        ast_word = ASTWord(ast_block, content)
+        # add hints if they exist
+        for name, hint in self.hints:
+            ast_word.setOption(name, hint)
+        self.hints = []
         ast_word.setOption('marked', True)
         ast_block.addChild(ast_word)
 
@@ -560,72 +880,35 @@ class ParseClassCommand(ParseCommand):
         The group is treated as a single entity.
         """
         log('parseIgnoredContent $content')
-        # strip ending and beginning / /
-        if len(content) > 1:
-            content = content[1:-1]
-        ast_word = ASTWord(ast_block, unescapeSpecialChars(content))
+        ast_word = ASTWord(ast_block, content)
         ast_word.setOption('ignored', True)
         ast_block.addChild(ast_word)
 
 
 
-    def parseContent(self, ast_obj, content):
-        """Parses content to ast syntax tree."""
-        log('parseContent for content $content')
-        if len(content) > 2:
-            content = content[1:-1]
-
-            # split to blocks using block seperators
-            blocks = re.split(self.getBlockSplitRegex(), content)
-            # for each block :
-            # split content looking for content groups
-            for block in blocks:
-                log('parseContent processing block: $block')
-                ast_block = ASTBlock()
-                # go through text finding
-                # find |   |    /    /    and unmarked blocks
-                # and each block process seperately
-                # unmarked blocks are between | | and / / blocks
-                marked_pattern = r'\|[^\|]*\|'
-                ignored_pattern = r'/[^/]*/'
-                regexp = re.compile('(%s)|(%s)' % (marked_pattern, ignored_pattern), re.M)
-                pos = 0
-                match = -1
-                while pos < len(block) and match:
-                    match = regexp.search(block, pos)
-                    if match:
-                        log('parseContent matches: $match.groups()')
-                        # process unmarked block between
-                        if match.start() > pos:
-                            self.parseUnmarkedContent(ast_block, block[pos:match.start()])
-                        # process include block | |
-                        if match.groups()[0]:
-                            self.parseMarkedContent(ast_block, block[match.start():match.end()])
-                        # process ignored block / /
-                        elif match.groups()[1]:
-                            self.parseIgnoredContent(ast_block, block[match.start():match.end()])
-                        else:
-                            raise "Unknown group!"
-                        pos = match.end()
-
-                if pos < len(block):
-                    self.parseUnmarkedContent(ast_block, block[pos:])
-
-                # add block to parent
-                ast_obj.addChild(ast_block)
+    def parseContent(self, ast_obj, kind, content):
+        """Parses content token to ast syntax tree."""
+        if kind == Tokenizer.Word:
+            self.parseUnmarkedContent(self.ast_block, content)
+        elif kind == Tokenizer.Marked:
+            self.parseMarkedContent(self.ast_block, content)
+        elif kind == Tokenizer.Ignored:
+            self.parseIgnoredContent(self.ast_block, content)
+        elif kind == Tokenizer.QuestionHint:
+            self.hints.append(('question_hint', content))
+        elif kind == Tokenizer.AnswerHint:
+            self.hints.append(('answer_hint', content))
+        elif kind == Tokenizer.BlockEnd:
+            # add block to parent
+            ast_obj.addChild(self.ast_block)
+            self.ast_block = ASTBlock()
 
 
     def parseUnmarkedContent(self, ast_block, content):
-        """This will parse content and result a list of words with info on marked, unmarked."""
-        log("parsing unmarked content: $content")
-        # first split text into blocks
-        # and then into words
-        # using regex as defined in functions getBlockSplitRegex and
-        words = re.split(self.getWordSplitRegex(), content)
-        for w in words:
-            if w.strip() != "":
-                ast_word = ASTWord(ast_block, unescapeSpecialChars(w.strip()))
-                ast_block.addChild(ast_word)
+        """This will parse word which is not in any group."""
+        # called for each word, so it's not logged and the word is created
+        # with its parent
+        ast_block.children.append(ASTWord(ast_block, content))
 
 
 
@@ -638,7 +921,7 @@ class ParseSentence(ParseClassCommand):
         return ASTSentence()
 
     def getBlockSplitRegex(self):
-        return '[\.]+|#&prbquest;|#&prbexclam;'
+        return r'[\.]+|%s|%s' % (EscapeCodes['?'], EscapeCodes['!'])
 
 
 class ParseParagraph(ParseClassCommand):
@@ -665,7 +948,7 @@ class ParseTabbed(ParseClassCommand):
     """This is parser the the \\tabbed class command."""
 
     def initAstObject(self):
-        return ASTSet()
+        return ASTTabbed()
 
     def getBlockSplitRegex(self):
         """Virtual function to be overriden in subclasses.
@@ -697,9 +980,8 @@ class ParseVerbatim(ParseCommand):
         """Parses block which is not in any group || or //
         All text is split to ident , punct , whitespace and entity patterns
         """
-        # I can unescape them now, because this parsing does not need special markup
+        # content comes unescaped from tokenizer, this parsing does not need special markup
         log('parse_unmarked_block $content ' )
-        content = unescapeSpecialChars(content)
         ident_pattern = r'[\w]+'
         punct_pattern = r'[^\w\s]+'
         whitespace_pattern = r'\s+'
@@ -758,87 +1040,82 @@ class ParseFile(ParseObject):
     given in the file.
     It will initiate specific import classes and keep track of the
     options.
-    TODO currently it uses a set of regexp to find the desired
-    command (similarly to how highlighting works now).
-    It does not use a full tokenizer yet.
+    The file is read by Tokenizer and each command is parsed from its
+    tokens by the parse class registered in Parsers.
     """
 
+    # parse classes for commands
+    Parsers = { 'title'      : ParseTitle,
+                'section'    : ParseSection,
+                'subsection' : ParseSubsection,
+                'tabbed'     : ParseTabbed,
+                'sentence'   : ParseSentence,
+                'definition' : ParseDefinition,
+                'paragraph'  : ParseParagraph,
+                'verbatim'   : ParseVerbatim,
+                'code'       : ParseCode,
+                'pythoncode' : ParsePythonCode }
+
 
+    # commands which set prefix of items following them
+    Headers = ('title', 'section', 'subsection')
 
-    def removeComments(self, text=''):
-        """Preprocesses given text, removes comments """
-        # remove lines beginning with $ or after not-escaped $
-        return re.sub("(?m)(^|[^\\\\])(%.*$)", "", text)
+
+    def getModes(self):
+        """Returns content modes of commands used by the tokenizer."""
+        modes = {}
+        for command, parse_class in ParseFile.Parsers.iteritems():
+            modes[command] = parse_class().getContentMode()
+        return modes
 
 
     def parse(self, text=''):
+        return self.parseStream(StringIO(text))
 
-        # preprocess the file
-        # remove the comments
-        text = self.removeComments(text)
-        text = escapeSpecialChars(text)
 
-        # initialize search#
-        root = self.initAstObject()
-        pos = 0
+    def splitSections(self, file, size=0):
+        """Returns parts of file starting at top level sections, which parsed
+        separately give the same objects as the whole file.
+        Parts are tuples (start, end, headers), where start and end are
+        offsets in file and headers are ast objects of Headers commands in
+        the part. Parts are at least size long, but the last one, which has
+        end None.
+        """
+        # content of all commands is read as a whole, which is fast
+        tokens = Tokenizer(file, {}).tokens()
+        start = 0
+        headers = []
+        for kind, command, offset in tokens:
+            if command == 'section' and offset - start >= max(size, 1):
+                yield start, offset, headers
+                start, headers = offset, []
+            if command in ParseFile.Headers:
+                headers.append(ParseFile.Parsers[command]().parseTokens(command, tokens))
+            else:
+                for kind, text, offset in tokens:
+                    if kind == Tokenizer.End:
+                        break
+        yield start, None, headers
 
-        match = -1
-        while match and pos < len(text):
-            match = ParseRegexp.search(text, pos)
-            if match:
-                # text which is not enclosed by any class will be processed with a
-                # default class
-                # if match is after our current position
-                # then parse in-between text with default parse class
-                if match.start() > pos:
-                    subtext = text[pos:match.start()]
-                    if re.sub('\s', '', subtext) != '':
-                        parse_obj = ParseSentence()
-                        ast_obj = parse_obj.parse(r'\[]{' + subtext + r'}')
-                        root.addChild(ast_obj)
-                # parse what's in match with
-                # corresponding class
-                command = match.groups()[0]
-                if command == 'title':
-                    parse_obj = ParseTitle()
-                elif command == 'section':
-                    parse_obj = ParseSection()
-                elif command == 'subsection':
-                    parse_obj = ParseSubsection()
-                elif command == 'subsubsection':
-                    parse_obj = ParseSubsubsection()
-                elif command == 'tabbed':
-                    parse_obj = ParseTabbed()
-                elif command == 'sentence':
-                    parse_obj = ParseSentence()
-                elif command == 'definition':
-                    parse_obj = ParseDefinition()
-                elif command == 'paragraph':
-                    parse_obj = ParseParagraph()
-                elif command == 'verbatim':
-                    parse_obj = ParseVerbatim()
-                elif command == 'code':
-                    parse_obj = ParseCode()
-                elif command == 'pythoncode':
-                    parse_obj = ParsePythonCode()
-                else:
-                    raise "Unknown command '%s' encountered." % command
-
-                subtext = text[match.start():match.end()]
-                ast_obj = parse_obj.parse(subtext)
-                root.addChild(ast_obj)
-                # pos now points after last match
-                pos = match.end() + 1
-
-        # surround the last block with default command
-        if pos < len(text):
-            subtext = text[pos:]
-            if re.sub('\s', '', subtext):
-                log('Found non-marked text: $subtext' )
-                parse_obj = ParseSentence()
-                ast_obj = parse_obj.parse(r'\sentence[]{' + subtext + r'}')
-                root.addChild(ast_obj)
-#
+
+    def parseStream(self, file):
+        """Parses probe file read from given stream."""
+        root = self.initAstObject()
+        # text which is not enclosed by any class is given by tokenizer as
+        # content of the default class
+        tokens = Tokenizer(file, self.getModes()).tokens()
+        # ast objects refer to their parents, so garbage collector would scan
+        # the growing tree again and again while nothing is freed
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for kind, command, offset in tokens:
+                assert kind == Tokenizer.Command, "Unexpected token at %d" % offset
+                parse_obj = ParseFile.Parsers[command]()
+                root.addChild(parse_obj.parseTokens(command, tokens))
+        finally:
+            if gc_enabled:
+                gc.enable()
         return root
 
 # Parser classes }}}
@@ -870,8 +1147,10 @@ class QAExporter(Exporter):
         """Exports given items to output in 'question and answer' style."""
         if output is None:
             f = sys.stdout
-        else:
+        elif isinstance(output, basestring):
             f = open(output, "wt")
+        else:
+            f = output
         # print items
         for item in items.items:
             # print question
@@ -904,7 +1183,7 @@ class QAExporter(Exporter):
                 f.write('a: %s!\n' % item.answer_hint)
 
             f.write('\n')
-        if output is not None:
+        if isinstance(output, basestring):
             f.close()
 
 
@@ -927,11 +1206,17 @@ class MentorExporter(Exporter):
 
 class Processor(object):
 
+    # files bigger than this are split in parts of about this size, which are
+    # processed in parallel
+    PartSize = 1 << 20
+
+    # words ignored in lang corpus for (corpus db, ignore level), they are read
+    # once as looking up each word in db would scan the whole corpus, or are
+    # looked up in corpus file exported by freq tool
+    IgnoredWords = {}
+
     def __init__(self):
-        # used for lang corpus db
-        # in ignored words for set class
-        self.corpus_db = None
-        self.corpus_db_cache = {}
+        pass
 
 
     def buildQuestion(self, words, hidenth, verbatim=False):
@@ -964,67 +1249,75 @@ class Processor(object):
         return "".join(result)
 
 
+    def getIgnoredWords(self):
+        """Returns set of words ignored at current level in lang corpus."""
+        key = (unicode(config.LANG_CORPUS_DB), config.LANG_CORPUS_IGNORE_LVL)
+        words = Processor.IgnoredWords.get(key)
+        if words is None and isCorpusFile(key[0]):
+            words = Corpus(key[0], key[1])
+            Processor.IgnoredWords[key] = words
+        elif words is None:
+            import sqlite3
+            db = sqlite3.connect(key[0])
+            try:
+                cursor = db.execute('SELECT WORD FROM TFREQ WHERE POSITION_LVL <= ?', (key[1],))
+                words = frozenset([row[0] for row in cursor])
+            finally:
+                db.close()
+            Processor.IgnoredWords[key] = words
+        return words
+
+
     def isWordIgnored(self, word):
         """Returns true if corpus is used and word is ignored at current level."""
         if config.LANG_CORPUS_USED:
-            word = word.strip().lower()
-            if self.corpus_db_cache.has_key(word):
-                return self.corpus_db_cache[word]
-            else:
-                import sqlite3
-                if self.corpus_db is None:
-                    self.corpus_db = sqlite3.connect(config.LANG_CORPUS_DB)
-                # initially set to not-ignored
-                self.corpus_db_cache[word] = False
-                cursor = self.corpus_db.cursor()
-                # if is found under current ignore level then is set to True
-                for row in cursor.execute('SELECT WORD FROM TFREQ WHERE POSITION_LVL <= ?', (config.LANG_CORPUS_IGNORE_LVL,)):
-                    self.corpus_db_cache[row[0]] = True
-                cursor.close()
-                return self.corpus_db_cache[word] #
+            return word.strip().lower() in self.getIgnoredWords()
         else:
             return False
 
 
-    def process(self, input, output=None):
-        """Processes input file and export output file.
-
-        Utilizes input classes like Parser and output like Exporter
-        Uses OutputItems objects to build OutputItems
+    def splitInput(self, input):
+        """Returns parts of input file which can be processed separately as
+        tuples (start, end, state), see process.
+        Small files are not split and have a single part None."""
+        if os.path.getsize(input) < Processor.PartSize:
+            yield None
+            return
+        state = self.initState(input)
+        # offsets are counted in bytes read and used to seek, so the file is
+        # read without newline translation
+        finput = open(input, 'rb')
+        try:
+            for start, end, headers in ParseFile().splitSections(finput, Processor.PartSize):
+                # headers were read without newline translation too
+                yield start, end, [prefix.replace('\r\n', '\n') for prefix in state]
+                # headers of part give the prefix for next parts
+                self.buildItems(headers, state, OutputItems())
+        finally:
+            finput.close()
+
+
+    def initState(self, input):
+        """Returns prefix state at the beginning of input file: title,
+        section, subsection and subsubsection."""
+        return [os.path.basename(os.path.splitext(input)[0]), '', '', '']
+
+
+    def buildItems(self, objs, state, items):
+        """Adds items generated from ast objects to items.
+        Prefix of items is taken from state, which is updated by title and
+        section objects.
         """
-
-        # parse tree
-        finput = open(input, 'rt')
-        fcontent = finput.read()
-        finput.close()
-        parser = ParseFile()
-        ast_tree = parser.parse(fcontent)
-
-        # process parse tree to create OutputItems structure
-        # is this step necessary ??
-
-        # items
-        # initialize variables
-        title         = os.path.basename(os.path.splitext(input)[0])
-        section       = ''
-        subsection    = ''
-        subsubsection = ''
-        prefix        = '' # prefix used
-        items         = OutputItems()
-
-        if config.DEBUG:
-            print str(ast_tree)
-
-        for obj in ast_tree.children:
-            prefix = self.buildPrefix(title, section, subsection, subsubsection)
+        for obj in objs:
+            prefix = self.buildPrefix(*state)
             if type(obj) is ASTTitle:
-                title = obj.content
+                state[0] = obj.content
             elif type(obj) is ASTSection:
-                section = obj.content
+                state[1] = obj.content
             elif type(obj) is ASTSubsection:
-                subsection = obj.content
+                state[2] = obj.content
             elif type(obj) is ASTSubsubsection:
-                subsubsection = obj.content
+                state[3] = obj.content
             # process each class command
             # by generating output items from its ast child items
             elif isinstance(obj, ASTClassCommand):
@@ -1051,16 +1344,72 @@ class Processor(object):
                         items.addItem(item)
 
 
-        # now export items using exporter
-        exporter = QAExporter()
-        exporter.exportFile(items, output=None)
+    def process(self, input, output=None, part=None):
+        """Processes input file and export output file.
+
+        Utilizes input classes like Parser and output like Exporter
+        Uses OutputItems objects to build OutputItems
+        If part is given, only this part of file returned by splitInput is
+        processed.
+        """
+
+        # parse tree
+        parser = ParseFile()
+        if part is None:
+            finput = open(input, 'rt')
+            state = self.initState(input)
+            ast_tree = parser.parseStream(finput)
+        else:
+            # part is read at byte offsets given by splitInput, newlines are
+            # translated as in text mode
+            finput = open(input, 'rb')
+            start, end, state = part
+            state = list(state)
+            finput.seek(start)
+            text = finput.read(-1 if end is None else end - start)
+            ast_tree = parser.parse(text.replace('\r\n', '\n'))
+        finput.close()
+
+        # items
+        items = OutputItems()
+
+        if config.DEBUG:
+            print str(ast_tree)
 
+        self.buildItems(ast_tree.children, state, items)
 
         # now export items using exporter
         exporter = QAExporter()
+        exporter.exportFile(items, output=output)
 
 
 
+
+def initWorker(debug):
+    """Initializes pool worker process with settings of main process."""
+    config.DEBUG = debug
+    enable_logging(debug)
+
+
+def splitInputs(inputs):
+    """Returns tasks for processPart, input files are split in parts."""
+    processor = Processor()
+    for index, input in enumerate(inputs):
+        for part in processor.splitInput(input):
+            yield index, input, part
+
+
+def processPart(task):
+    """Processes part of input file given as (index, input, part), returns
+    index, output and processing time.
+    It is used to process files in pool worker processes."""
+    index, input, part = task
+    start = time.time()
+    output = StringIO()
+    Processor().process(input, output, part)
+    return index, output.getvalue(), time.time() - start
+
+
 # }}} Processor classes
 
 
@@ -1081,6 +1430,8 @@ def main():
                       help="run a a simulation only")
     parser.add_option("-t", "--test", action="store_true", dest="test", default=False,
                       help="runs a series of tests")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=1,
+                      help="process files in given number of processes")
 
     opts, args = parser.parse_args(sys.argv[1:])
     # apply to config
@@ -1093,13 +1444,15 @@ def main():
     if config.TEST:
         # import path from tests
         # sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), "tests"))
-        from tests import test_utils, test_probe, test_cards, test_models
+        from tests import test_utils, test_probe, test_corpus, test_cards, test_models, test_scheduler
         import unittest
         # do I need it?
         suite = unittest.TestSuite([test_utils.suite(),
                                     test_probe.suite(),
+                                    test_corpus.suite(),
                                     test_cards.suite(),
-                                    test_models.suite()])
+                                    test_models.suite(),
+                                    test_scheduler.suite()])
         runner = unittest.TextTestRunner(verbosity=2)
         runner.run(suite)
         sys.exit()
@@ -1117,11 +1470,34 @@ def main():
  
 
 
-    processor = Processor()
+    start = time.time()
+    if opts.jobs > 1:
+        # files and parts of big files are processed in parallel, but their
+        # output is written in order of input
+        import multiprocessing
+        pool = multiprocessing.Pool(opts.jobs, initWorker, (config.DEBUG,))
+        try:
+            results = pool.imap(processPart, splitInputs(args))
+            for index, parts in groupby(results, itemgetter(0)):
+                seconds = 0
+                for index, output, part_seconds in parts:
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+                    seconds += part_seconds
+                sys.stderr.write('%s: %.3fs\n' % (args[index], seconds))
+        finally:
+            pool.terminate()
+    else:
+        # output is written as it's exported
+        processor = Processor()
+        for input in args:
+            file_start = time.time()
+            processor.process(input, sys.stdout)
+            if config.VERBOSE:
+                sys.stderr.write('%s: %.3fs\n' % (input, time.time() - file_start))
+    if config.VERBOSE or opts.jobs > 1:
+        sys.stderr.write('Processed %d files in %.3fs\n' % (len(args), time.time() - start))
 
-    for input in args:
-        processor.process(input)
- 
 
 
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-2 -*-
+#
+# Copyright (C) 2007 Adam Folmert <afolmert@gmail.com>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+#
+#
+"""This is module for scheduling card repetitions.
+
+It implements the SM-2 algorithm: after each review the card gets a grade 0-5,
+grades 3 and above pass. Passed cards are repeated after 1 day, 6 days and then
+after the previous interval multiplied by the card easiness factor (ease).
+Failed cards start over from the 1 day interval. Ease is adjusted by the grade
+after every review and never drops below 1.3.
+
+Reviews can be computed one by one or for a whole deck at once. The latter
+uses NumPy arrays if NumPy is installed.
+"""
+
+import release
+import time
+from array import array
+from cards import Cards
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__version__ = release.version
+
+
+class Scheduler(object):
+    """SM-2 scheduler working on scheduling state stored in Cards.
+    Scheduling state is a tuple in order of Cards.ScheduleColumns:
+    (id, next_review, interval, ease, repetitions, lapses, score)
+    """
+
+    MinEase = 1.3
+    PassGrade = 3
+    MaxGrade = 5
+    SecondsPerDay = 24 * 60 * 60
+
+
+    def review(self, schedule, grade, now=None):
+        """Returns new scheduling state of a card after review with given grade."""
+        if now is None:
+            now = int(time.time())
+        card_id, next_review, interval, ease, repetitions, lapses, score = schedule
+        if grade >= Scheduler.PassGrade:
+            if repetitions == 0:
+                interval = 1
+            elif repetitions == 1:
+                interval = 6
+            else:
+                interval = round(interval * ease)
+            repetitions += 1
+        else:
+            interval = 1
+            repetitions = 0
+            lapses += 1
+        q = Scheduler.MaxGrade - grade
+        ease = max(Scheduler.MinEase, ease + 0.1 - q * (0.08 + q * 0.02))
+        next_review = now + int(interval * Scheduler.SecondsPerDay)
+        return (card_id, next_review, float(interval), ease, repetitions, lapses, grade)
+
+
+    def reviewArrays(self, interval, ease, repetitions, lapses, grades, now):
+        """Vectorized version of review working on NumPy arrays.
+        Returns tuple of arrays (next_review, interval, ease, repetitions, lapses).
+        """
+        passed = grades >= Scheduler.PassGrade
+        # floor(x + 0.5) rounds halves up like round() in review does
+        new_interval = numpy.where(repetitions == 0, 1.0,
+                       numpy.where(repetitions == 1, 6.0, numpy.floor(interval * ease + 0.5)))
+        new_interval = numpy.where(passed, new_interval, 1.0)
+        new_repetitions = numpy.where(passed, repetitions + 1, 0)
+        new_lapses = lapses + (~passed).astype(lapses.dtype)
+        q = Scheduler.MaxGrade - grades
+        new_ease = numpy.maximum(Scheduler.MinEase, ease + 0.1 - q * (0.08 + q * 0.02))
+        next_review = now + (new_interval * Scheduler.SecondsPerDay).astype(numpy.int64)
+        return next_review, new_interval, new_ease, new_repetitions, new_lapses
+
+
+    def reviewMany(self, schedules, grades, now=None):
+        """Returns new scheduling states of cards reviewed with given grades.
+        Params: schedules and grades are sequences of the same length.
+        """
+        if now is None:
+            now = int(time.time())
+        if numpy is None or len(schedules) == 0:
+            return [self.review(schedule, grade, now) for schedule, grade in zip(schedules, grades)]
+        columns = [list(column) for column in zip(*schedules)]
+        return zip(*self.reviewColumns(columns, grades, now))
+
+
+    def reviewColumns(self, columns, grades, now):
+        """Returns new scheduling state of many cards as list of columns.
+        Params: columns are sequences in order of Cards.ScheduleColumns, SCORE
+        may be left out. Returned columns are lists.
+        """
+        if numpy is None:
+            schedules = [schedule + (None,) for schedule in zip(*columns[:6])]
+            return map(list, zip(*self.reviewMany(schedules, grades, now))) or [[] for column in Cards.ScheduleColumns]
+        def column(i, dtype):
+            # compact arrays of Cards are shared without copying
+            if isinstance(columns[i], array) and columns[i].typecode == numpy.dtype(dtype).char:
+                return numpy.frombuffer(columns[i], dtype)
+            return numpy.asarray(columns[i], dtype)
+        grades = numpy.asarray(grades, numpy.float64)
+        next_review, interval, ease, repetitions, lapses = self.reviewArrays(
+            column(2, numpy.float64),
+            column(3, numpy.float64),
+            column(4, numpy.int64),
+            column(5, numpy.int64),
+            grades, now)
+        return [list(columns[0]),
+                next_review.tolist(),
+                interval.tolist(),
+                ease.tolist(),
+                repetitions.tolist(),
+                lapses.tolist(),
+                grades.astype(numpy.int64).tolist()]
+
+
+    def reviewCard(self, cards, card_id, grade, now=None):
+        """Reviews card with given id in Cards storage and saves new state."""
+        schedules = cards.getSchedules([card_id])
+        if len(schedules) == 0:
+            raise Cards.DataNotFoundError, "Card not found = %d " % card_id
+        schedule = self.review(schedules[0], grade, now)
+        cards.updateSchedules([schedule])
+        return schedule
+
+
+    def reviewCards(self, cards, grades, now=None):
+        """Reviews many cards in Cards storage at once.
+        Params: grades is a dict of grades keyed by card id.
+        Returns number of reviewed cards.
+        """
+        if now is None:
+            now = int(time.time())
+        with cards.transaction():
+            columns = cards.getScheduleArrays(Cards.ScheduleColumns[:6], grades.keys())
+            grades = map(grades.__getitem__, columns[0])
+            cards.updateScheduleArrays(Cards.ScheduleColumns, self.reviewColumns(columns, grades, now))
+        return len(grades)
+
+
+    def backfill(self, cards, now=None):
+        """Creates schedules for cards which were graded but never scheduled.
+        This is for decks created before cards had scheduling state: their
+        SCORE is taken as the grade of a review made at given time.
+        Returns number of scheduled cards.
+        """
+        if now is None:
+            now = int(time.time())
+        with cards.transaction():
+            columns = cards.getScheduleArrays(Cards.ScheduleColumns,
+                sqlwhere="NEXT_REVIEW = 0 AND REPETITIONS = 0"
+                         " AND typeof(SCORE) IN ('integer', 'real') AND SCORE BETWEEN 0 AND ?",
+                params=(Scheduler.MaxGrade,))
+            cards.updateScheduleArrays(Cards.ScheduleColumns, self.reviewColumns(columns, columns[6], now))
+        return len(columns[0])
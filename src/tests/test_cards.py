@@ -22,8 +22,15 @@
 This is a test file for cards module.
 """
 
+import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
-from cards import Cards, Card
+from array import array
+from cards import Cards, Card, readQACards, writeQACards
+from StringIO import StringIO
+from config import gui_config as config
 from utils import log
 
 
@@ -38,6 +45,33 @@ class TestCard(unittest.TestCase):
         card2 = Card(None, 'ala', 'ma', 'ala2', 'dupa3', 1)
         self.assertEqual(card1, card2)
 
+    def test_fields(self):
+        # fields are kept as given, not converted to strings
+        card = Card('7', u'pytanie', 'odpowiedź')
+        self.assertEqual((card.id, card.question, card.answer, card.score), (7, u'pytanie', 'odpowiedź', None))
+        self.assertEqual(str(card), str((7, u'pytanie', 'odpowiedź', '', '', None)))
+        self.assertFalse(hasattr(card, '__dict__'))
+
+
+class TestQAFile(unittest.TestCase):
+
+    def test_readWriteQACards(self):
+        cards = [Card(None, 'one\n', 'eins\n'),
+                 Card(None, 'two\nlines\n', 'zwei\n'),
+                 Card(None, '', 'no question\n'),
+                 Card(None, u'pytanie\n', u'odpowied\u017a\n')]
+        file = StringIO()
+        writeQACards(cards, file)
+        file.seek(0)
+        read = { 'bytes' : 0 }
+        result = list(readQACards(file, read))
+        self.assertEqual([(c.question, c.answer) for c in result],
+                         [('one\n', 'eins\n'),
+                          ('two\nlines\n', 'zwei\n'),
+                          ('', 'no question\n'),
+                          ('pytanie\n', u'odpowied\u017a\n'.encode('utf-8'))])
+        self.assertEqual(read['bytes'], len(file.getvalue()))
+
 
 class TestCards(unittest.TestCase):
 
@@ -61,6 +95,56 @@ class TestCards(unittest.TestCase):
         self.assertEqual(card2, card2a)
 
 
+    def test_addCards(self):
+        id1 = self.cards.addCard(Card(None, 'one', 'eins'))
+        progress = []
+        cards = (Card(None, 'q%d' % i, 'a%d' % i) for i in range(25))
+        result = self.cards.addCards(cards, batch_size=10, progress=progress.append)
+        # ids follow the existing ones and progress is reported per batch
+        self.assertEqual(result, (id1 + 1, id1 + 25))
+        self.assertEqual(progress, [10, 20, 25])
+        self.assertEqual(self.cards.getCardsCount(), 26)
+        self.assertEqual(self.cards.getCard(id1 + 25), Card(id1 + 25, 'q24', 'a24'))
+        # adding nothing returns no range
+        self.assertEqual(self.cards.addCards([]), None)
+        # cancelled adding is rolled back
+        cards = (Card(None, 'q%d' % i, 'a%d' % i) for i in range(25))
+        self.assertRaises(Cards.CancelledError, self.cards.addCards, cards, 10, lambda count: count < 20)
+        self.assertEqual(self.cards.getCardsCount(), 26)
+
+
+    def test_getCards(self):
+        ids = [self.cards.addCard(Card(None, 'q%d' % i, 'a%d' % i, 'qh', 'ah', i)) for i in range(1200)]
+        # requested order is kept across fetch chunks, missing ids are omitted
+        wanted = [ids[1100], ids[3], 99999, ids[600], ids[0]]
+        cards = self.cards.getCards(wanted)
+        self.assertEqual(cards.keys(), [ids[1100], ids[3], ids[600], ids[0]])
+        self.assertEqual(cards[ids[3]], self.cards.getCard(ids[3]))
+        # projection fetches only given columns and always the id
+        cards = self.cards.getCards([ids[5]], ['question'])
+        self.assertEqual(cards[ids[5]], Card(ids[5], 'q5'))
+        self.assertRaises(AssertionError, self.cards.getCards, [ids[5]], ['NOSUCHCOLUMN'])
+
+
+    def test_getCardIds(self):
+        ids = [self.cards.addCard(Card(None, 'q%d' % i)) for i in range(5)]
+        self.cards.deleteCard(ids[2])
+        self.assertEqual(list(self.cards.getCardIds()), ids[:2] + ids[3:])
+        # blocks of ids
+        self.assertEqual(list(self.cards.getCardIds(None, 2)), ids[:2])
+        self.assertEqual(list(self.cards.getCardIds(ids[1], 2)), ids[3:])
+        # sorted and filtered blocks
+        self.cards.updateCard(Card(ids[0], 'q9'))
+        self.assertEqual(list(self.cards.getCardIds(sortkey='question')), ids[1:2] + ids[3:] + ids[:1])
+        self.assertEqual(list(self.cards.getCardIds(ids[3], 2, 'question', True)), [ids[1]])
+        self.assertEqual(list(self.cards.getCardIds(conditions=[('question', '>=', 'q3'), ('SCORE', 'IS NULL', None)])),
+                         [ids[0], ids[3], ids[4]])
+        self.cards.addCard(Card(None, 'q_%'))
+        self.assertEqual(len(self.cards.getCardIds(conditions=[('QUESTION', 'CONTAINS', '_%')])), 1)
+        self.assertRaises(AssertionError, self.cards.getCardIds, conditions=[('QUESTION; DROP', '=', 1)])
+        self.assertRaises(AssertionError, self.cards.getCardIds, conditions=[('QUESTION', 'OR 1 =', 1)])
+
+
     def test_getCardCount(self):
         self.cards.addCard(Card(None, 'co', 'tutaj'))
         self.cards.addCard(Card(None, 'ale', 'fajnie'))
@@ -151,6 +235,328 @@ class TestCards(unittest.TestCase):
 
 
 
+    def test_seekCardHeaders(self):
+        questions = ['c', 'a', 'b', 'a', 'c', 'b', 'a']
+        ids = [self.cards.addCard(Card(None, q, '', '', '', None)) for q in questions]
+        # pages by id
+        self.assertEqual(self.cards.seekCardHeaders(limit=2), [(ids[0], 'c'), (ids[1], 'a')])
+        self.assertEqual(self.cards.seekCardHeaders(after_id=ids[1], limit=2), [(ids[2], 'b'), (ids[3], 'a')])
+        self.assertEqual(self.cards.seekCardHeaders(before_id=ids[3], limit=2), [(ids[1], 'a'), (ids[2], 'b')])
+        self.assertEqual(len(self.cards.seekCardHeaders(after_id=ids[2])), 4)
+        # walking all pages by question gives the same order as full sort
+        order = [(ids[i], questions[i]) for i in sorted(range(len(ids)), key=lambda i: (questions[i], ids[i]))]
+        self.assertEqual(self.cards.seekCardHeaders(sortkey='question'), order)
+        result = []
+        page = self.cards.seekCardHeaders(limit=3, sortkey='question')
+        while page:
+            result.extend(page)
+            page = self.cards.seekCardHeaders(after_id=page[-1][0], limit=3, sortkey='question')
+        self.assertEqual(result, order)
+        # and backwards
+        result = []
+        page = self.cards.seekCardHeaders(before_id=order[-1][0], limit=2, sortkey='question')
+        while page:
+            result = page + result
+            page = self.cards.seekCardHeaders(before_id=page[0][0], limit=2, sortkey='question')
+        self.assertEqual(result, order[:-1])
+        # null keys sort first
+        self.cards.db.execute('UPDATE TCARDS SET QUESTION = NULL WHERE ID = ?', (ids[4],))
+        page = self.cards.seekCardHeaders(limit=2, sortkey='question')
+        self.assertEqual(page[0][0], ids[4])
+        self.assertEqual(self.cards.seekCardHeaders(after_id=ids[4], sortkey='question'), [o for o in order if o[0] != ids[4]])
+        self.assertEqual(self.cards.seekCardHeaders(before_id=order[0][0], sortkey='question')[0][0], ids[4])
+        # filter and invalid params
+        self.assertEqual(self.cards.seekCardHeaders(after_id=ids[0], sqlwhere="QUESTION = 'b'"), [(ids[2], 'b'), (ids[5], 'b')])
+        self.assertRaises(AssertionError, self.cards.seekCardHeaders, ids[0], ids[1])
+        self.assertRaises(Cards.DataNotFoundError, self.cards.seekCardHeaders, 12345, None, None, 'question')
+
+
+    def test_seekCardIds(self):
+        questions = ['c', None, 'b', 'a', 'c', None, 'a']
+        ids = [self.cards.addCard(Card(None, q)) for q in questions]
+        for descending in (False, True):
+            order = sorted(range(len(ids)), key=lambda i: (questions[i], ids[i]), reverse=descending)
+            result = []
+            block, position = self.cards.seekCardIds(None, 3, 'question', descending)
+            while block:
+                result.extend(block)
+                self.assertEqual(position, (questions[order[len(result) - 1]], block[-1]))
+                block, position = self.cards.seekCardIds(position, 3, 'question', descending)
+            self.assertEqual(result, [ids[i] for i in order])
+        # position needs no card
+        self.cards.deleteCard(ids[2])
+        self.assertEqual(list(self.cards.seekCardIds(('b', ids[2]), None, 'question')[0]), [ids[0], ids[4]])
+        self.assertEqual(list(self.cards.seekCardIds(('b', ids[2]), None, 'question', True)[0]),
+                         [ids[6], ids[3], ids[5], ids[1]])
+        self.assertEqual(self.cards.seekCardIds((None, ids[5]), 2, 'question', True), (array('l', [ids[1]]), (None, ids[1])))
+        self.assertEqual(self.cards.seekCardIds((None, ids[1]), 2, 'question', True), (array('l'), (None, ids[1])))
+        self.assertEqual(list(self.cards.seekCardIds((ids[2], ids[2]), conditions=[('QUESTION', 'IS NOT NULL', None)])[0]),
+                         [ids[3], ids[4], ids[6]])
+
+
+
+    def test_transaction(self):
+        id1 = self.cards.addCard(Card(None, 'one', 'eins'))
+        # changes in block are committed together
+        with self.cards.transaction():
+            id2 = self.cards.addCard(Card(None, 'two', 'zwei'))
+            self.cards.updateCard(Card(id1, 'one!', 'eins!'))
+            self.assertTrue(self.cards.inTransaction())
+        self.assertFalse(self.cards.inTransaction())
+        self.assertEqual(self.cards.getCardsCount(), 2)
+        # exception rolls back whole block
+        try:
+            with self.cards.transaction():
+                self.cards.deleteCard(id1)
+                self.cards.deleteCard(id1)
+        except AssertionError:
+            pass
+        self.assertTrue(self.cards.existsCard(id1))
+        self.assertFalse(self.cards.inTransaction())
+        # nested block is a savepoint rolled back on its own
+        with self.cards.transaction():
+            self.cards.deleteCard(id2)
+            try:
+                with self.cards.transaction():
+                    self.cards.deleteAllCards()
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertTrue(self.cards.existsCard(id1))
+        self.assertFalse(self.cards.existsCard(id2))
+        self.assertEqual(self.cards.getCard(id1), Card(id1, 'one!', 'eins!'))
+        # uncommited addCard is left open until commit or rollback
+        id3 = self.cards.addCard(Card(None, 'three', 'drei'), False)
+        self.assertTrue(self.cards.inTransaction())
+        self.cards.rollback()
+        self.assertFalse(self.cards.existsCard(id3))
+
+
+    def test_failedCommit(self):
+        # transaction stays active if commit fails
+        path = os.path.join(tempfile.mkdtemp(), 'test.mcd')
+        try:
+            self.cards.open(path, pragmas={ 'journal_mode' : 'DELETE', 'busy_timeout' : 0 })
+            reader = sqlite3.connect(path, isolation_level=None)
+            reader.execute('BEGIN')
+            reader.execute('SELECT COUNT(*) FROM TCARDS').fetchone()
+            card_id = self.cards.addCard(Card(None, 'q', 'a'), False)
+            self.assertRaises(sqlite3.OperationalError, self.cards.commit)
+            self.assertTrue(self.cards.inTransaction())
+            reader.execute('COMMIT')
+            reader.close()
+            self.cards.commit()
+            self.assertFalse(self.cards.inTransaction())
+            self.assertTrue(self.cards.existsCard(card_id))
+        finally:
+            self.cards.close()
+            shutil.rmtree(os.path.dirname(path))
+
+
+    def test_concurrentAddCards(self):
+        # other connection can't start writing while ids are assigned
+        path = os.path.join(tempfile.mkdtemp(), 'test.mcd')
+        other = Cards()
+        try:
+            self.cards.open(path)
+            other.open(path, pragmas={ 'busy_timeout' : 0 })
+            with self.cards.transaction():
+                self.assertRaises(sqlite3.OperationalError, other.addCards, [Card(None, 'r', 'b')])
+                self.assertEqual(self.cards.addCards([Card(None, 'q', 'a')]), (1, 1))
+            self.assertEqual(other.addCards([Card(None, 'r', 'b')]), (2, 2))
+        finally:
+            other.close()
+            self.cards.close()
+            shutil.rmtree(os.path.dirname(path))
+
+
+    def test_cache(self):
+        ids = [self.cards.addCard(Card(None, 'q%d' % i, 'a%d' % i)) for i in range(3)]
+        self.cards.setCacheSize(2)
+        self.cards.getCard(ids[0])
+        self.cards.getCard(ids[1])
+        self.cards.getCard(ids[0])
+        # least recently used card is evicted
+        self.cards.getCard(ids[2])
+        self.assertTrue(ids[0] in self.cards.cache)
+        self.assertFalse(ids[1] in self.cards.cache)
+        stats = self.cards.cacheStats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['count']), (1, 3, 1, 2))
+        # updates and deletes are seen through cache
+        self.cards.updateCard(Card(ids[0], 'q0!', 'a0!'))
+        self.assertEqual(self.cards.getCard(ids[0]).question, 'q0!')
+        self.cards.deleteCard(ids[2])
+        self.assertRaises(Cards.DataNotFoundError, self.cards.getCard, ids[2])
+        # rolled back changes do not stay in cache
+        try:
+            with self.cards.transaction():
+                self.cards.updateCard(Card(ids[0], 'lost', 'lost'))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.cards.getCard(ids[0]).question, 'q0!')
+
+
+    def test_writeBehind(self):
+        card_id = self.cards.addCard(Card(None, 'q', 'a'))
+        self.cards.setCacheSize(10)
+        self.cards.setWriteBehind(True)
+        for i in range(5):
+            self.cards.updateCard(Card(card_id, 'q' * i, 'a'))
+        self.assertEqual(self.cards.cacheStats()['pending'], 1)
+        self.assertEqual(self.cards.getCard(card_id).question, 'qqqq')
+        self.assertEqual(self.cards.getCards([card_id], ['QUESTION'])[card_id].question, 'qqqq')
+        self.assertEqual(self.cards.cacheStats()['pending'], 0)
+        # pending cards are written on close
+        self.cards.updateCard(Card(card_id, 'last', 'a'))
+        path = os.path.join(tempfile.mkdtemp(), 'test.mcd')
+        try:
+            self.cards.open(path)
+            card_id = self.cards.addCard(Card(None, 'q', 'a'))
+            self.cards.updateCard(Card(card_id, 'last', 'a'))
+            self.cards.close()
+            self.cards.open(path)
+            self.assertEqual(self.cards.getCard(card_id).question, 'last')
+        finally:
+            self.cards.close()
+            shutil.rmtree(os.path.dirname(path))
+
+
+    def test_getDueCards(self):
+        ids = [self.cards.addCard(Card(None, 'q%d' % i, 'a%d' % i)) for i in range(5)]
+        # new cards are due at once
+        self.assertEqual(self.cards.getDueCards(1000), ids)
+        for card_id, next_review in zip(ids, [3000, 2000, 500, 2000, 9000]):
+            self.cards.db.execute('UPDATE TCARDS SET NEXT_REVIEW = ? WHERE ID = ?', (next_review, card_id))
+        self.assertEqual(self.cards.getDueCards(1000), [ids[2]])
+        self.assertEqual(self.cards.getDueCards(3000), [ids[2], ids[1], ids[3], ids[0]])
+        self.assertEqual(self.cards.getDueCards(3000, 2), [ids[2], ids[1]])
+        # current time by default
+        self.assertEqual(self.cards.getDueCards(), [ids[2], ids[1], ids[3], ids[0], ids[4]])
+
+
+    def test_scheduleArrays(self):
+        self.cards.cache.resize(10)
+        ids = [self.cards.addCard(Card(None, 'q%d' % i, 'a%d' % i, '', '', i)) for i in range(5)]
+        card = self.cards.getCard(ids[1])
+        columns = self.cards.getScheduleArrays(('ID', 'INTERVAL', 'SCORE'), [ids[3], ids[1], 12345])
+        self.assertEqual([column.typecode for column in columns], ['l', 'd', 'd'])
+        self.assertEqual(map(list, columns), [[ids[1], ids[3]], [0.0, 0.0], [1.0, 3.0]])
+        columns = self.cards.getScheduleArrays(('ID',), sqlwhere='SCORE BETWEEN ? AND ?', params=(2, 3))
+        self.assertEqual(map(list, columns), [[ids[2], ids[3]]])
+        self.assertEqual(map(list, self.cards.getScheduleArrays(('ID', 'EASE'), [])), [[], []])
+        # large updates rebuild the NEXT_REVIEW index
+        bulk_rows = Cards.BulkIndexRows
+        try:
+            for Cards.BulkIndexRows in (100, 2):
+                self.cards.updateScheduleArrays(('ID', 'NEXT_REVIEW', 'SCORE'),
+                    [[ids[1], ids[3]], [3000, 2000], [4, 5]])
+                self.assertEqual(self.cards.getDueCards(2500), [ids[0], ids[2], ids[4], ids[3]])
+        finally:
+            Cards.BulkIndexRows = bulk_rows
+        self.assertEqual(self.cards.getSchedules([ids[1]]), [(ids[1], 3000, 0.0, 2.5, 0, 0, 4)])
+        # cached card is updated
+        self.assertEqual(self.cards.getCard(ids[1]).score, 4)
+        self.assertEqual(self.cards.db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'XI_TCARDS_NEXT_REVIEW'").fetchone(), (1,))
+
+
+    def test_searchCards(self):
+        id1 = self.cards.addCard(Card(None, 'the quick brown fox', 'der schnelle braune Fuchs'))
+        id2 = self.cards.addCard(Card(None, 'a brown bear', 'ein brauner Baer', 'animal'))
+        id3 = self.cards.addCard(Card(None, 'fox and bear', 'Fuchs und Baer'))
+        self.assertTrue(self.cards.fulltext)
+        self.assertEqual(set(self.cards.searchCards('brown')), set([(id1, 'the quick brown fox'), (id2, 'a brown bear')]))
+        self.assertEqual(self.cards.searchCards('brown fox'), [(id1, 'the quick brown fox')])
+        # words are matched as prefixes in all texts
+        self.assertEqual([r[0] for r in self.cards.searchCards('anim')], [id2])
+        self.assertEqual(len(self.cards.searchCards('fuchs', 1)), 1)
+        self.assertEqual(len(self.cards.searchCards('fuchs', 10, 1)), 1)
+        # query syntax is not interpreted
+        self.assertEqual(self.cards.searchCards('"fox" OR'), [])
+        self.assertEqual(self.cards.searchCards('  '), [])
+        # index follows updates and deletes
+        self.cards.updateCard(Card(id1, 'the quick red fox', 'der schnelle rote Fuchs'))
+        self.cards.deleteCard(id2)
+        self.assertEqual(self.cards.searchCards('brown'), [])
+        self.assertEqual(self.cards.searchCards('red'), [(id1, 'the quick red fox')])
+        # plain scan gives the same matches
+        self.cards.fulltext = False
+        self.assertEqual(self.cards.searchCards('fox'), [(id1, 'the quick red fox'), (id3, 'fox and bear')])
+
+
+    def test_searchCardIds(self):
+        ids = [self.cards.addCard(Card(None, 'fox %d' % i, 'bear')) for i in range(6)]
+        self.cards.addCard(Card(None, 'cat', 'bear'))
+        for fulltext in (True, False):
+            self.cards.fulltext = fulltext
+            self.assertEqual(list(self.cards.searchCardIds('fox')), ids)
+            # blocks in id order
+            self.assertEqual(list(self.cards.searchCardIds('fox bear', None, 4)), ids[:4])
+            self.assertEqual(list(self.cards.searchCardIds('fox', ids[3], 4)), ids[4:])
+            # search in given cards only
+            self.assertEqual(list(self.cards.searchCardIds('fox', ids[1], 2, ids[::2])), ids[2:5:2])
+            self.assertEqual(list(self.cards.searchCardIds(' ')), [])
+            self.assertEqual(list(self.cards.searchCardIds('fox', None, -5, ids)), ids)
+        # wildcards are matched literally in plain scan
+        id1 = self.cards.addCard(Card(None, '50% off', 'a_b'))
+        self.cards.addCard(Card(None, '500 off', 'axb'))
+        self.assertEqual(list(self.cards.searchCardIds('0%')), [id1])
+        self.assertEqual(list(self.cards.searchCardIds('a_b')), [id1])
+
+
+    def test_upgradeDb(self):
+        # database in the first version is upgraded when opened
+        dbdir = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(dbdir, 'old.mcd')
+            db = sqlite3.connect(dbpath)
+            db.execute('CREATE TABLE TCARDS (ID INTEGER PRIMARY KEY, QUESTION TEXT, ANSWER TEXT, QUESTION_HINT TEXT, ANSWER_HINT TEXT, SCORE NUMERIC)')
+            db.execute('CREATE TABLE TVERSION (VERSION TEXT)')
+            db.execute("INSERT INTO TVERSION (VERSION) VALUES ('01')")
+            db.execute("INSERT INTO TCARDS (QUESTION, ANSWER) VALUES ('old', 'alt')")
+            db.execute("INSERT INTO TCARDS (QUESTION, ANSWER, SCORE) VALUES ('new', 'neu', 'None')")
+            db.commit()
+            db.close()
+            cards = Cards()
+            cards.open(dbpath)
+            self.assertEqual(cards.getCard(1), Card(1, 'old', 'alt', None, None, None))
+            self.assertEqual(cards.getCard(2).score, None)
+            self.assertEqual(cards.getDueCards(0), [1, 2])
+            self.assertEqual(cards.db.execute('SELECT VERSION FROM TVERSION').fetchall(), [(config.DB_VERSION,)])
+            cards.close()
+            # unknown version cannot be opened
+            db = sqlite3.connect(dbpath)
+            db.execute("UPDATE TVERSION SET VERSION = 'XX'")
+            db.commit()
+            db.close()
+            self.assertRaises(Cards.CannotOpenDatabaseError, cards.open, dbpath)
+        finally:
+            shutil.rmtree(dbdir)
+
+
+    def test_openProfile(self):
+        # in-memory database gets default profile without WAL
+        self.assertEqual(self.cards.profile, 'interactive')
+        self.assertEqual(self.cards.getPragmas()['journal_mode'], 'memory')
+        # file database with profile and overriden setting
+        dbdir = tempfile.mkdtemp()
+        try:
+            cards = Cards()
+            cards.open(os.path.join(dbdir, 'test.mcd'), 'bulk-import', {'busy_timeout' : 1234})
+            pragmas = cards.getPragmas()
+            self.assertEqual(cards.profile, 'bulk-import')
+            self.assertEqual(pragmas['journal_mode'], 'wal')
+            self.assertEqual(pragmas['synchronous'], 0)
+            self.assertEqual(pragmas['cache_size'], -200000)
+            self.assertEqual(pragmas['busy_timeout'], 1234)
+            cards.close()
+            self.assertEqual(cards.profile, None)
+        finally:
+            shutil.rmtree(dbdir)
+        self.assertRaises(AssertionError, Cards().open, ':memory:', 'nosuchprofile')
+
+
+
     # TODO
     # write a model using cards
     # a list control
@@ -165,5 +571,6 @@ class TestCards(unittest.TestCase):
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestCard))
+    suite.addTest(unittest.makeSuite(TestQAFile))
     suite.addTest(unittest.makeSuite(TestCards))
     return suite
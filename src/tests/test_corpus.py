@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Adam Folmert <afolmert@gmail.com>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+#
+#
+"""
+This is a test file for corpus module.
+"""
+
+import os
+import tempfile
+import unittest
+from corpus import Corpus, writeCorpus, isCorpusFile
+
+
+class TestCorpus(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp('.corpus')
+        os.close(fd)
+        writeCorpus(self.fname, [(u'the', 1), (u'of', 1), (u'house', 2), (u'ż\xf3łw', 2),
+                                 (u'probe', 3)])
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+
+    def test_getLevel(self):
+        corpus = Corpus(self.fname)
+        self.assertEqual(len(corpus), 5)
+        self.assertEqual([corpus.getLevel(w) for w in ('of', 'the', 'house', u'ż\xf3łw', 'probe')],
+                         [1, 1, 2, 2, 3])
+        self.assertEqual([corpus.getLevel(w) for w in ('', 'a', 'ho', 'houses', 'zzz')],
+                         [None, None, None, None, None])
+        corpus.close()
+
+
+    def test_level(self):
+        corpus = Corpus(self.fname, 2)
+        self.assertEqual(['the' in corpus, 'house' in corpus, 'probe' in corpus, 'cat' in corpus],
+                         [True, True, False, False])
+        corpus.close()
+
+
+    def test_isCorpusFile(self):
+        self.assertEqual(isCorpusFile(self.fname), True)
+        self.assertEqual(isCorpusFile(__file__), False)
+        self.assertEqual(isCorpusFile(self.fname + '.missing'), False)
+        self.assertRaises(ValueError, Corpus, __file__)
+
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCorpus))
+    return suite
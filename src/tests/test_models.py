@@ -24,7 +24,8 @@
 
 from PyQt4.QtCore import *
 import unittest
-from models import CardModel
+from models import CardModel, DrillModel, DrillQueue
+from cards import Card, Cards
 from utils import log
 from StringIO import StringIO
 
@@ -34,18 +35,35 @@ class DummyView(QObject):
         QObject.__init__(self, parent)
         self.model = None
         self.got_reset = False
-        self.got_dataChanged = False
+        self.got_resets = 0
+        self.got_aboutToBeResets = 0
+        self.got_dataChanged = None
+        self.got_inserted = None
+        self.got_removed = None
 
     def setModel(self, model):
         self.model = model
         self.connect(self.model, SIGNAL('modelReset()'), self.on_reset)
-        self.connect(self.model, SIGNAL('dataChanged(QModelIndex)'), self.on_dataChanged)
+        self.connect(self.model, SIGNAL('modelAboutToBeReset()'), self.on_aboutToBeReset)
+        self.connect(self.model, SIGNAL('dataChanged(QModelIndex, QModelIndex)'), self.on_dataChanged)
+        self.connect(self.model, SIGNAL('rowsInserted(QModelIndex, int, int)'), self.on_inserted)
+        self.connect(self.model, SIGNAL('rowsRemoved(QModelIndex, int, int)'), self.on_removed)
 
     def on_reset(self):
         self.got_reset = True
+        self.got_resets += 1
 
-    def on_dataChanged(self, index):
-        self.got_dataChanged = True
+    def on_aboutToBeReset(self):
+        self.got_aboutToBeResets += 1
+
+    def on_dataChanged(self, topLeft, bottomRight):
+        self.got_dataChanged = (topLeft.row(), bottomRight.row())
+
+    def on_inserted(self, parent, start, end):
+        self.got_inserted = (start, end)
+
+    def on_removed(self, parent, start, end):
+        self.got_removed = (start, end)
 
 
 
@@ -136,6 +154,16 @@ class TestCardModel(unittest.TestCase):
         self.assertRaises(CardModel.InvalidIndexError, self.model.data, idx)
 
 
+    def test_getCards(self):
+        self.model.addNewCard()
+        self.model.addNewCard()
+        self.model.updateCard(self.model.index(1, 0), 'second', 'zwei')
+        cards = self.model.getCards([self.model.index(1, 0), self.model.index(0, 0)])
+        self.assertEqual(len(cards), 2)
+        self.assertEqual(cards[0].question, 'second')
+        self.assertEqual(cards[1].question, '')
+
+
     def test_previousNextIndex(self):
         # previous index on empty index
         self.model.addNewCard()
@@ -150,34 +178,41 @@ class TestCardModel(unittest.TestCase):
 
     def test_addNewCard(self):
         # test if adding new card generates a proper signal
-        self.assertEqual(self.view.got_reset, False)
-        self.model.addNewCard()
         self.model.addNewCard()
         self.model.addNewCard()
-        self.assertEqual(self.view.got_reset, True)
+        index = self.model.addNewCard()
+        self.assertEqual(index.row(), 2)
+        self.assertEqual(self.view.got_inserted, (2, 2))
+        self.assertEqual(self.view.got_reset, False)
+        # remaining blocks are not loaded and new card is not read again
+        self.model.fetchSize = 2
+        self.model.setFilter([])
+        index = self.model.addNewCard()
+        self.assertEqual((index.row(), index.internalId()), (2, 4))
+        self.assertEqual(self.view.got_inserted, (2, 2))
+        self.model.fetchAll()
+        self.assertEqual([self.model.index(row, 0).internalId() for row in range(4)], [1, 2, 4, 3])
+        self.assertEqual(self.model.rowCount(), 4)
 
 
     def test_deleteCard(self):
         # test if deleting card generates a proper signal
         # add 2 cards
-        self.assertEqual(self.view.got_reset, False)
         self.model.addNewCard()
         self.model.addNewCard()
-        self.assertEqual(self.view.got_reset, True)
-        # reset view
-        self.view.got_reset = False
-        # delete first
-        index = self.model.index(0, 0)
+        # delete second
+        index = self.model.index(1, 0)
         self.model.deleteCard(index)
         # did it generate signal ?
-        self.assertEqual(self.view.got_reset, True)
+        self.assertEqual(self.view.got_removed, (1, 1))
 
         # delete again
-        self.view.got_reset = False
+        self.view.got_removed = None
         index = self.model.index(0, 0)
         self.model.deleteCard(index)
         # did it generate signal?
-        self.assertEqual(self.view.got_reset, True)
+        self.assertEqual(self.view.got_removed, (0, 0))
+        self.assertEqual(self.view.got_reset, False)
 
         # row count should be 0 now
         self.assertEqual(self.model.rowCount(), 0)
@@ -192,12 +227,13 @@ class TestCardModel(unittest.TestCase):
 
     def test_updateCard(self):
         self.model.addNewCard()
-        idx = self.model.index(0, 0)
+        self.model.addNewCard()
+        idx = self.model.index(1, 0)
 
         self.model.updateCard(idx, 'testquestion', 'testanswer')
 
-        # test if got signal
-        self.assertEqual(self.view.got_dataChanged, True)
+        # test if got signal for the row only
+        self.assertEqual(self.view.got_dataChanged, (1, 1))
 
         # test if data is correct
         data = self.model.data(idx, Qt.UserRole)
@@ -206,6 +242,81 @@ class TestCardModel(unittest.TestCase):
         self.assertEqual(data.answer, 'testanswer')
 
 
+    def test_sort(self):
+        for q in ['b', 'c', 'a']:
+            index = self.model.addNewCard()
+            self.model.updateCard(index, q, '')
+        self.model.fetchSize = 2
+        self.model.sort(0, Qt.DescendingOrder)
+        self.assertTrue(self.view.got_reset)
+        self.model.fetchAll()
+        self.assertEqual([self.model.data(self.model.index(row, 0), Qt.UserRole).question
+                          for row in range(3)], ['c', 'b', 'a'])
+        # filter keeps sort order
+        self.model.setFilter([('QUESTION', '!=', 'b')])
+        self.model.fetchAll()
+        self.assertEqual(self.model.rowCount(), 2)
+        self.assertEqual(self.model.data(self.model.index(0, 0), Qt.UserRole).question, 'c')
+        # ids of rows are given in the same order, e.g. for drill
+        self.model.setFilter([('QUESTION', '!=', 'c')])
+        self.assertTrue(self.model.canFetchMore())
+        self.assertEqual([self.model.cards.getCard(i).question for i in self.model.cardIds()], ['b', 'a'])
+        self.assertFalse(self.model.canFetchMore())
+        self.model.setFilter([])
+        self.model.sort(-1)
+        self.model.fetchAll()
+        self.assertEqual(self.model.data(self.model.index(0, 0), Qt.UserRole).question, 'b')
+
+
+    def test_fetchMore(self):
+        for i in range(5):
+            self.model.addNewCard()
+        self.model.fetchSize = 2
+        self.model.setFilter([])
+        # first block is shown after reload
+        self.assertEqual(self.model.rowCount(), 2)
+        self.assertEqual(self.model.index(0, 0).internalId(), 1)
+        self.assertTrue(self.model.canFetchMore())
+        self.model.fetchMore()
+        self.assertEqual(self.view.got_inserted, (2, 3))
+        self.model.fetchMore()
+        self.assertEqual([self.model.index(row, 0).internalId() for row in range(5)], [1, 2, 3, 4, 5])
+        self.assertFalse(self.model.canFetchMore())
+
+
+    def test_fetchMoreChangedAnchor(self):
+        ids = []
+        for q in ['e', 'a', 'd', 'b', 'c', 'f']:
+            index = self.model.addNewCard()
+            self.model.updateCard(index, q, '')
+            ids.append(index.internalId())
+        self.model.fetchSize = 2
+        self.model.sort(0)
+        self.assertEqual([self.model.index(row, 0).internalId() for row in range(2)], [ids[1], ids[3]])
+        # next block follows the last read row even if its card was deleted
+        self.model.cards.deleteCard(ids[3])
+        self.model.fetchMore()
+        self.assertEqual([self.model.index(row, 0).internalId() for row in range(2, 4)], [ids[4], ids[2]])
+        # or moved by an edit
+        self.model.cards.updateCard(Card(ids[2], 'a', ''))
+        self.model.fetchAll()
+        self.assertEqual([self.model.index(row, 0).internalId() for row in range(4, 6)], [ids[0], ids[5]])
+
+
+    def test_showCardIds(self):
+        ids = [self.model.addNewCard().internalId() for i in range(4)]
+        self.model.showCardIds(ids[1:3])
+        self.assertTrue(self.view.got_reset)
+        self.assertEqual(self.model.rowCount(), 2)
+        self.assertFalse(self.model.canFetchMore())
+        self.model.appendCardIds(ids[3:])
+        self.assertEqual(self.view.got_inserted, (2, 2))
+        self.assertEqual(self.model.index(2, 0).internalId(), ids[3])
+        self.model.showAllCards()
+        self.model.fetchAll()
+        self.assertEqual(self.model.rowCount(), 4)
+
+
     def test_importQAFile(self):
         #
         # test if clean actually cleans the file
@@ -221,6 +332,8 @@ a: answer2""")
 
         self.model.importQAFile(qa, True)
         self.assertEqual(self.model.rowCount(), 2)
+        # rows are reset once
+        self.assertEqual((self.view.got_aboutToBeResets, self.view.got_resets), (1, 1))
         idx = self.model.index(0, 0)
         card1 = self.model.data(self.model.index(0, 0), Qt.UserRole)
         self.assertEqual(card1.question, 'question1\n')
@@ -231,6 +344,19 @@ a: answer2""")
         self.assertEqual(card2.answer, 'answer2')
 
 
+        # cancelled import leaves deck unchanged
+        qa = StringIO(''.join('q: question%d\na: answer%d\n' % (i, i) for i in range(50)))
+        progress = []
+        def cancel(bytes, cards):
+            progress.append((bytes, cards))
+            return cards < 20
+        self.model.importBatchSize = 10
+        self.assertEqual(self.model.importQAFile(qa, True, cancel), None)
+        self.assertEqual(self.model.rowCount(), 2)
+        self.assertEqual([cards for bytes, cards in progress], [10, 20])
+        self.assertTrue(0 < progress[0][0] < progress[1][0])
+
+
         # test import on closed model
         self.model.close()
         self.assertRaises(CardModel.ModelNotActiveError, self.model.importQAFile, 'sample')
@@ -238,7 +364,161 @@ a: answer2""")
 
 
 
+class TestDrillModel(unittest.TestCase):
+
+    def setUp(self):
+        self.model = DrillModel()
+        self.view = DummyView()
+        self.view.setModel(self.model)
+        self.cards = [Card(i, 'q%d' % i, 'a%d' % i) for i in range(5)]
+        for card in self.cards:
+            self.model.addCard(card)
+
+
+    def test_selectNextCard(self):
+        # next card is taken from the head and put back at the tail
+        self.assertTrue(self.model.selectNextCard() is self.cards[0])
+        self.assertTrue(self.model.selectNextCard() is self.cards[1])
+        self.assertEqual(list(self.model.ids), [2, 3, 4, 0, 1])
+        self.assertEqual(self.model.rowCount(), 5)
+
+
+    def test_removeCard(self):
+        card = self.model.selectNextCard()
+        self.model.removeCard(card)
+        self.assertEqual(self.view.got_removed, (4, 4))
+        self.assertFalse(self.model.hasCard(card))
+        # card equal by fields but not in queue is not removed
+        self.model.removeCard(Card(99, 'q1', 'a1'))
+        self.model.removeCard(self.cards[3])
+        self.assertEqual(list(self.model.ids), [1, 2, 4])
+        # rows of cards after removed ones move up
+        self.assertEqual(self.view.got_removed, (2, 2))
+        self.assertEqual([self.model.ids[row] for row in range(3)], [1, 2, 4])
+        self.assertEqual(self.model._findRow(4), 2)
+        self.model.clear()
+        self.assertEqual(self.model.rowCount(), 0)
+
+
+    def test_queue(self):
+        # cards are found by row and rows by card after slots are compacted
+        queue = DrillQueue(range(100))
+        expected = range(100)
+        for i in range(150):
+            card_id = expected.pop(0)
+            queue.remove(card_id)
+            if i % 3:
+                queue.append(card_id)
+                expected.append(card_id)
+            if i % 7 == 0:
+                queue.remove(expected.pop(len(expected) // 2))
+        self.assertEqual(list(queue), expected)
+        self.assertEqual([queue[row] for row in range(len(queue))], expected)
+        self.assertEqual([queue.row(card_id) for card_id in expected], range(len(expected)))
+        self.assertEqual(queue.row(expected.pop(0) - 1000), None)
+
+
+    def test_relearning(self):
+        now = [1000]
+        self.model = DrillModel(clock=lambda: now[0])
+        for card in self.cards[:3]:
+            self.model.addCard(card)
+        card = self.model.selectNextCard()
+        self.model.scoreCard(card, DrillModel.Bad)
+        self.assertEqual(self.model.learningCount(), 1)
+        self.assertEqual(self.model.rowCount(), 2)
+        # failed card comes back after first learning step
+        self.assertEqual(self.model.selectNextCard().id, 1)
+        now[0] += DrillModel.LearningSteps[0]
+        self.assertTrue(self.model.selectNextCard() is card)
+        # good score moves it to next step, then it leaves the drill
+        self.model.scoreCard(card, DrillModel.Good)
+        self.assertEqual(self.model.learningCount(), 1)
+        now[0] += DrillModel.LearningSteps[1] - 1
+        self.assertEqual(self.model.selectNextCard().id, 2)
+        now[0] += 1
+        self.assertTrue(self.model.selectNextCard() is card)
+        self.model.scoreCard(card, DrillModel.Good)
+        self.assertEqual(self.model.learningCount(), 0)
+        self.assertEqual(list(self.model.ids), [1, 2])
+
+
+    def test_scoreCard(self):
+        deck = Cards()
+        deck.open(':memory:')
+        card_id = deck.addCard(Card(None, 'q', 'a'))
+        self.model = DrillModel(clock=lambda: 1000)
+        self.model.setDeck(deck)
+        self.model.addCardIds([card_id])
+        card = self.model.selectNextCard()
+        self.model.scoreCard(card, DrillModel.Bad)
+        schedule = deck.getSchedules([card_id])[0]
+        self.assertEqual(schedule[4:], (0, 1, DrillModel.Grades[DrillModel.Bad]))
+        # answers of failed card are not reviewed again
+        for score in (DrillModel.Bad, DrillModel.Good, DrillModel.Good):
+            self.assertEqual(self.model.selectNextCard().id, card_id)
+            self.model.scoreCard(card, score)
+        self.assertEqual(deck.getSchedules([card_id])[0], schedule)
+        self.assertEqual(self.model.rowCount() + self.model.learningCount(), 0)
+        deck.close()
+
+
+    def test_state(self):
+        now = [1000]
+        self.model = DrillModel(clock=lambda: now[0])
+        deck = Cards()
+        deck.open(':memory:')
+        ids = [deck.addCard(Card(None, 'q%d' % i, 'a%d' % i)) for i in range(4)]
+        for card in deck.getCards(ids).values():
+            self.model.addCard(card)
+        self.model.scoreCard(self.model.selectNextCard(), DrillModel.Bad)
+        self.model.scoreCard(self.model.selectNextCard(), DrillModel.Bad)
+        now[0] += DrillModel.LearningSteps[0]
+        self.model.selectNextCard()
+        state = self.model.getState()
+        self.assertEqual(state['queue'], [ids[2], ids[3], ids[0]])
+        self.assertEqual(state['learning'], [[1000 + DrillModel.LearningSteps[0], ids[1], 0]])
+        self.assertEqual(state['steps'], [[ids[0], 0]])
+        # restored drill goes on the same way
+        model = DrillModel(clock=lambda: now[0])
+        model.setDeck(deck)
+        model.setState(state)
+        self.assertEqual(model.getState(), state)
+        self.assertEqual(model.selectNextCard().id, ids[1])
+        deck.close()
+
+
+    def test_lazyCards(self):
+        deck = Cards()
+        deck.open(':memory:')
+        deck.setCacheSize(100)
+        ids = [deck.addCard(Card(None, 'q%d' % i, 'a%d' % i)) for i in range(50)]
+        model = DrillModel()
+        model.setDeck(deck)
+        model.addCardIds(ids)
+        model.addCardIds(ids[:2])
+        self.assertEqual(model.rowCount(), 50)
+        self.assertEqual(len(deck.cache), 0)
+        self.assertEqual(model.selectNextCard().question, 'q0')
+        # next cards are read ahead in one query
+        model.prefetch()
+        misses = deck.cacheStats()['misses']
+        for i in range(1, DrillModel.PrefetchSize):
+            self.assertEqual(model.selectNextCard().id, ids[i])
+        self.assertEqual(deck.cacheStats()['misses'], misses)
+        self.assertEqual(model.data(model.index(49, 0)).toString(), u'%d q%d' % (ids[31], 31))
+        deck.close()
+
+
+    def test_requeueCard(self):
+        self.model.requeueCard(self.cards[2])
+        self.assertEqual(list(self.model.ids), [0, 1, 3, 4, 2])
+        self.assertEqual(self.view.got_inserted, (4, 4))
+
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestCardModel))
+    suite.addTest(unittest.makeSuite(TestDrillModel))
     return suite
@@ -23,7 +23,15 @@
 This is a test file for probe module.
 """
 
+import os
+import sqlite3
+import tempfile
 import unittest
+from StringIO import StringIO
+from probe import Tokenizer, ParseFile, ParseCommands, Processor, processPart, ASTSection, ASTSentence, ASTParagraph, \
+                  ASTCode, ASTTabbed, ASTDefinition
+from corpus import writeCorpus
+from config import probe_config as config
 
 class TestArithmetics(unittest.TestCase):
 
@@ -35,8 +43,260 @@ class TestArithmetics(unittest.TestCase):
 
 
 
+
+class TestTokenizer(unittest.TestCase):
+
+    def tokenize(self, text, chunk=Tokenizer.ChunkSize):
+        size = Tokenizer.ChunkSize
+        Tokenizer.ChunkSize = chunk
+        try:
+            return list(Tokenizer(StringIO(text), ParseFile().getModes()).tokens())
+        finally:
+            Tokenizer.ChunkSize = size
+
+
+    def test_command(self):
+        self.assertEqual(self.tokenize('\\section[sec2]{One}\n'),
+                         [(Tokenizer.Command, 'section', 0),
+                          (Tokenizer.Options, 'sec2', 9),
+                          (Tokenizer.Content, 'One', 15),
+                          (Tokenizer.End, None, 18)])
+
+
+    def test_content(self):
+        tokens = self.tokenize('\\sentence{a |why? b| /c/. d}')
+        self.assertEqual(tokens[1:-1],
+                         [(Tokenizer.Word, 'a', 10),
+                          (Tokenizer.QuestionHint, 'why', 13),
+                          (Tokenizer.Marked, ' b', 12),
+                          (Tokenizer.Ignored, 'c', 21),
+                          (Tokenizer.BlockEnd, None, 24),
+                          (Tokenizer.Word, 'd', 26),
+                          (Tokenizer.BlockEnd, None, 27)])
+
+
+    def test_tabbed(self):
+        # lines are blocks and tabs or commas split words
+        tokens = self.tokenize('\\tabbed{one\tjeden\ntwo, dwa}')
+        self.assertEqual([(kind, token) for kind, token, offset in tokens],
+                         [(Tokenizer.Command, 'tabbed'),
+                          (Tokenizer.Word, 'one'), (Tokenizer.Word, 'jeden'), (Tokenizer.BlockEnd, None),
+                          (Tokenizer.Word, 'two'), (Tokenizer.Word, 'dwa'), (Tokenizer.BlockEnd, None),
+                          (Tokenizer.End, None)])
+
+
+    def test_definition(self):
+        tokens = self.tokenize('\\definition{What is |it|. An answer}')
+        self.assertEqual([(kind, token) for kind, token, offset in tokens],
+                         [(Tokenizer.Command, 'definition'),
+                          (Tokenizer.Word, 'What'), (Tokenizer.Word, 'is'), (Tokenizer.Marked, 'it'),
+                          (Tokenizer.BlockEnd, None),
+                          (Tokenizer.Word, 'An'), (Tokenizer.Word, 'answer'), (Tokenizer.BlockEnd, None),
+                          (Tokenizer.End, None)])
+
+
+    def test_escapes(self):
+        # offsets point to the source text with backslashes
+        tokens = self.tokenize('\\sentence{a\\|b \\\\ \\/c\\/ \\x d}')
+        words = [(token, offset) for kind, token, offset in tokens if kind == Tokenizer.Word]
+        self.assertEqual(words, [('a|b', 10), ('\\', 15), ('/c/', 18), ('\\x', 24), ('d', 27)])
+
+
+    def test_comments(self):
+        text = 'a 50\\% b % comment\n% line\n\\section{S}'
+        tokens = self.tokenize(text)
+        words = [(token, offset) for kind, token, offset in tokens if kind == Tokenizer.Word]
+        # backslash does not escape percent, but it is not a comment
+        self.assertEqual(words, [('a', 0), ('50\\%', 2), ('b', 7)])
+        self.assertEqual(tokens[-3], (Tokenizer.Command, 'section', text.index('\\section')))
+
+
+    def test_stream(self):
+        # commands and content may span chunks read from stream
+        text = ''.join(['\\section{S%d}\n\\sentence{w%d %% c\nx\\|%d.}\n' % (i, i, i) for i in range(100)])
+        self.assertEqual(self.tokenize(text, 16), self.tokenize(text))
+        tokens = self.tokenize(text, 16)
+        self.assertEqual(len([t for t in tokens if t[0] == Tokenizer.Command]), 200)
+        for kind, token, offset in tokens:
+            if kind == Tokenizer.Command:
+                self.assertEqual(text[offset:offset + len(token) + 1], '\\' + token)
+            elif kind == Tokenizer.Word and token.startswith('w'):
+                self.assertEqual(text[offset:offset + len(token)], token)
+
+
+
+class TestParseFile(unittest.TestCase):
+
+    def test_parse(self):
+        root = ParseFile().parse('\\section{One}\n'
+                                 '\\sentence{|a? b!word| and /this/. Next}\n'
+                                 '\\code{x \\{1\\}}\n'
+                                 'trailing |text|\n')
+        self.assertEqual([type(c) for c in root.children], [ASTSection, ASTSentence, ASTCode, ASTSentence])
+        self.assertEqual(root.children[0].content, 'One')
+        self.assertEqual(root.children[2].content, 'x {1}')
+        blocks = root.children[1].children
+        self.assertEqual([[w.content for w in b.children] for b in blocks], [['word', 'and', 'this'], ['Next']])
+        word = blocks[0].children[0]
+        self.assertEqual(word.getOption('marked'), True)
+        self.assertEqual(word.getOption('question_hint'), 'a')
+        self.assertEqual(word.getOption('answer_hint'), 'b')
+        self.assertEqual(blocks[0].children[2].getOption('ignored'), True)
+        self.assertEqual(root.children[3].children[0].children[1].getOption('marked'), True)
+        # words share default options until one is set
+        self.assertEqual(blocks[0].children[1].getOption('marked'), False)
+        self.assertEqual(root.children[3].children[0].children[0].getOption('marked'), False)
+        self.assertFalse(hasattr(word, '__dict__'))
+
+
+    def test_classCommands(self):
+        root = ParseFile().parse('\\tabbed{one\tjeden}\n\\definition{A. b}\n')
+        self.assertEqual([type(c) for c in root.children], [ASTTabbed, ASTDefinition])
+        self.assertEqual([c.command for c in root.children],
+                         [ParseCommands.tabbed, ParseCommands.definition])
+        self.assertEqual([w.content for w in root.children[0].children[0].children], ['one', 'jeden'])
+        self.assertEqual([[w.content for w in b.children] for b in root.children[1].children], [['A'], ['b']])
+
+
+    def test_paragraph(self):
+        # text between commands is parsed as sentence
+        root = ParseFile().parse('\\paragraph[ask=all]{A? b}\nloose\n\\section{S}')
+        self.assertEqual([type(c) for c in root.children], [ASTParagraph, ASTSentence, ASTSection])
+        self.assertEqual(root.children[0].getOption('ask'), 'all')
+        self.assertEqual([w.content for w in root.children[1].children[0].children], ['loose'])
+
+
+
+class TestProcessor(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dbpath = tempfile.mkstemp('.db')
+        os.close(fd)
+        db = sqlite3.connect(self.dbpath)
+        db.execute('CREATE TABLE TFREQ (WORD TEXT, OCCUR NUMBER, POSITION NUMBER, POSITION_LVL NUMBER)')
+        db.executemany('INSERT INTO TFREQ (WORD, POSITION_LVL) VALUES (?, ?)',
+                       [('the', 1), ('of', 1), ('house', 2), ('probe', 3)])
+        db.commit()
+        db.close()
+        self.settings = (config.LANG_CORPUS_USED, config.LANG_CORPUS_DB, config.LANG_CORPUS_IGNORE_LVL)
+        config.LANG_CORPUS_USED = True
+        config.LANG_CORPUS_DB = self.dbpath
+        config.LANG_CORPUS_IGNORE_LVL = 2
+
+    def tearDown(self):
+        config.LANG_CORPUS_USED, config.LANG_CORPUS_DB, config.LANG_CORPUS_IGNORE_LVL = self.settings
+        for key in Processor.IgnoredWords.keys():
+            if key[0] == self.dbpath:
+                del Processor.IgnoredWords[key]
+        os.remove(self.dbpath)
+
+
+    def test_isWordIgnored(self):
+        processor = Processor()
+        self.assertEqual([processor.isWordIgnored(w) for w in ('The ', 'house', 'probe', 'cat')],
+                         [True, True, False, False])
+        # corpus is read once for all processors
+        db = sqlite3.connect(self.dbpath)
+        db.execute('DELETE FROM TFREQ')
+        db.commit()
+        db.close()
+        self.assertEqual(Processor().isWordIgnored('of'), True)
+        # other level is read separately
+        config.LANG_CORPUS_IGNORE_LVL = 3
+        self.assertEqual(processor.isWordIgnored('of'), False)
+        config.LANG_CORPUS_USED = False
+        self.assertEqual(processor.isWordIgnored('the'), False)
+
+
+    def test_isWordIgnoredCorpus(self):
+        # words are looked up in corpus file exported from db
+        fname = self.dbpath + '.corpus'
+        db = sqlite3.connect(self.dbpath)
+        writeCorpus(fname, db.execute('SELECT WORD, POSITION_LVL FROM TFREQ'))
+        db.close()
+        config.LANG_CORPUS_DB = fname
+        try:
+            processor = Processor()
+            self.assertEqual([processor.isWordIgnored(w) for w in ('The ', 'house', 'probe', 'cat')],
+                             [True, True, False, False])
+            Processor.IgnoredWords.pop((fname, 2)).close()
+        finally:
+            os.remove(fname)
+
+
+    def test_processPart(self):
+        fd, fname = tempfile.mkstemp('.prb')
+        os.write(fd, '\\section{S}\n\\sentence[ask=marked]{A |cat| sat.}\n')
+        os.close(fd)
+        try:
+            index, output, seconds = processPart((1, fname, None))
+        finally:
+            os.remove(fname)
+        title = os.path.basename(os.path.splitext(fname)[0])
+        self.assertEqual((index, output), (1, 'q: %s: S:  A [...] sat\na: cat\n\n' % title))
+
+
+    def test_splitInput(self):
+        # parts processed separately give the same output as whole file
+        fd, fname = tempfile.mkstemp('.prb')
+        os.write(fd, 'loose |text|.\n\\title{T}\\section{Glued} |a|.\n'
+                     '\\section{A}\n\\sentence{|b| % \\section{Comment}\n|c|.}\n'
+                     '\\code{\\section{Code}}\n\\\\section{Escaped} |d|\n'
+                     '\\subsection{Sub}|e|\n\\title{U}\n\\section{B}\n|f|\n')
+        os.close(fd)
+        processor = Processor()
+        size = Processor.PartSize
+        Processor.PartSize = 1
+        try:
+            whole = StringIO()
+            processor.process(fname, whole)
+            parts = list(processor.splitInput(fname))
+            output = StringIO()
+            for part in parts:
+                processor.process(fname, output, part)
+        finally:
+            Processor.PartSize = size
+            os.remove(fname)
+        title = os.path.basename(os.path.splitext(fname)[0])
+        self.assertEqual([state for start, end, state in parts],
+                         [[title, '', '', ''], ['T', '', '', ''], ['U', 'A', 'Sub', '']])
+        self.assertEqual(output.getvalue(), whole.getvalue())
+
+
+    def test_splitInputNewlines(self):
+        # parts start at byte offsets of sections and are read as text
+        text = '\\title{T\nU}\n\\section{A}\n|a| % x\n\\section{B}\n|b|.\n\\section{C\nD}\n|c|\n'
+        fnames = []
+        for newline in ('\n', '\r\n'):
+            fd, fname = tempfile.mkstemp('.prb')
+            os.write(fd, text.replace('\n', newline))
+            os.close(fd)
+            fnames.append(fname)
+        processor = Processor()
+        size = Processor.PartSize
+        Processor.PartSize = 1
+        try:
+            whole = StringIO()
+            processor.process(fnames[0], whole)
+            parts = list(processor.splitInput(fnames[1]))
+            output = StringIO()
+            for part in parts:
+                processor.process(fnames[1], output, part)
+        finally:
+            Processor.PartSize = size
+            for fname in fnames:
+                os.remove(fname)
+        data = text.replace('\n', '\r\n')
+        self.assertEqual([data[start:start + 10] for start, end, state in parts[1:]],
+                         ['\\section{A', '\\section{B', '\\section{C'])
+        self.assertEqual(output.getvalue(), whole.getvalue())
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestArithmetics))
+    suite.addTest(unittest.makeSuite(TestTokenizer))
+    suite.addTest(unittest.makeSuite(TestParseFile))
+    suite.addTest(unittest.makeSuite(TestProcessor))
     return suite
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007 Adam Folmert <afolmert@gmail.com>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+#
+"""
+This is a test file for scheduler module.
+"""
+
+import unittest
+import scheduler
+from scheduler import Scheduler
+from cards import Cards, Card
+
+Day = Scheduler.SecondsPerDay
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def test_review(self):
+        schedule = (1, 0, 0.0, 2.5, 0, 0, None)
+        # passed reviews go 1, 6 and then interval times ease days
+        schedule = self.scheduler.review(schedule, 5, 1000)
+        self.assertEqual(schedule[:3], (1, 1000 + Day, 1.0))
+        self.assertAlmostEqual(schedule[3], 2.6)
+        schedule = self.scheduler.review(schedule, 4, 2000)
+        self.assertEqual(schedule[1:3], (2000 + 6 * Day, 6.0))
+        self.assertAlmostEqual(schedule[3], 2.6)
+        schedule = self.scheduler.review(schedule, 3, 3000)
+        self.assertEqual(schedule[1:3], (3000 + 16 * Day, 16.0))
+        self.assertEqual(schedule[4:], (3, 0, 3))
+        # failed review starts over and counts a lapse
+        schedule = self.scheduler.review(schedule, 1, 4000)
+        self.assertEqual(schedule[1:3], (4000 + Day, 1.0))
+        self.assertEqual(schedule[4:], (0, 1, 1))
+        # ease never drops below minimum
+        for i in range(10):
+            schedule = self.scheduler.review(schedule, 0, 5000)
+        self.assertEqual(schedule[3], Scheduler.MinEase)
+
+
+    def test_reviewMany(self):
+        schedules = [(i, 0, float(i % 7), 1.3 + (i % 5) * 0.3, i % 4, i % 3, None) for i in range(200)]
+        grades = [i % 6 for i in range(200)]
+        expected = [self.scheduler.review(s, g, 1000) for s, g in zip(schedules, grades)]
+        result = self.scheduler.reviewMany(schedules, grades, 1000)
+        self.assertEqual(len(result), len(expected))
+        for r, e in zip(result, expected):
+            self.assertEqual(r[0:3], e[0:3])
+            self.assertAlmostEqual(r[3], e[3])
+            self.assertEqual(r[4:], e[4:])
+        # pure python path gives the same result
+        numpy = scheduler.numpy
+        try:
+            scheduler.numpy = None
+            self.assertEqual(self.scheduler.reviewMany(schedules, grades, 1000), expected)
+        finally:
+            scheduler.numpy = numpy
+
+
+    def test_reviewCards(self):
+        self.check_reviewCards()
+        # pure python path gives the same result
+        numpy = scheduler.numpy
+        try:
+            scheduler.numpy = None
+            self.check_reviewCards()
+        finally:
+            scheduler.numpy = numpy
+
+
+    def check_reviewCards(self):
+        cards = Cards()
+        cards.open(':memory:')
+        ids = [cards.addCard(Card(None, 'q%d' % i, 'a%d' % i, '', '', i)) for i in range(7)]
+        # single card
+        self.scheduler.reviewCard(cards, ids[0], 4, 1000)
+        self.assertEqual(cards.getDueCards(1000 + Day - 1, 1), [ids[1]])
+        self.assertRaises(Cards.DataNotFoundError, self.scheduler.reviewCard, cards, 12345, 4)
+        # many cards
+        self.assertEqual(self.scheduler.reviewCards(cards, {ids[1] : 1, ids[2] : 5}, 1000), 2)
+        self.assertEqual(cards.getSchedules([ids[2]])[0][1:], (1000 + Day, 1.0, 2.6, 1, 0, 5))
+        # backfill schedules the rest using their score as grade
+        # except card with score 6 which is not a grade
+        self.assertEqual(self.scheduler.backfill(cards, 2000), 3)
+        self.assertEqual(cards.getDueCards(1000 + Day), [ids[6], ids[0], ids[1], ids[2]])
+        cards.close()
+
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestScheduler))
+    return suite
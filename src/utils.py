@@ -615,7 +615,10 @@ def enable_logging(enable=True):
 
 def debug(aMesg):
     """Prints a debug message to logger."""
-    logging.debug(itpl(str(aMesg)))
+    # interpolation is slow and debug is called in inner loops, so it is
+    # skipped when the message would not be shown
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(itpl(str(aMesg)))
 
 def warn(aMesg):
     """Prints a warning message to logger."""
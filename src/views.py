@@ -72,6 +72,7 @@ class AbstractCardView(QAbstractItemView):
     def __init__(self, parent=None):
         QAbstractItemView.__init__(self, parent)
         self._dirty = False
+        self._updatingModel = False
         # self.setSelectionModel(QAbstractItemView.SingleSelection)
         # these control what it looks for
 
@@ -89,12 +90,23 @@ class AbstractCardView(QAbstractItemView):
         self.connect(model, SIGNAL('modelAboutToBeReset()'), self.saveChanges)
 
 
-    def dataChanged(self, index):
-        # TODO do this only if index is the one as currently used
-        # TODO how to check whether this is the model
-        if index == self.getCurrentIndex():
+    def dataChanged(self, topLeft, bottomRight):
+        # changes made by this view are already displayed
+        if self._updatingModel:
+            return
+        index = self.getCurrentIndex()
+        if index is not None and index.isValid() \
+            and topLeft.row() <= index.row() <= bottomRight.row():
             self._updateView(self.model(), index)
 
+
+    def rowsAboutToBeRemoved(self, parent, start, end):
+        # edits of a card being deleted are dropped
+        index = self.getCurrentIndex()
+        if index is not None and index.isValid() and start <= index.row() <= end:
+            self.setDirty(False)
+        QAbstractItemView.rowsAboutToBeRemoved(self, parent, start, end)
+
     def dirty(self):
         return self._dirty
 
@@ -398,7 +410,9 @@ class CardGridView(QTableView):
 
     def __init__(self, parent=None):
         QTableView.__init__(self, parent)
-        self.setSortingEnabled(False)
+        # model sorts in database, no sort indicator keeps the id order
+        self.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.setSortingEnabled(True)
         self.setShowGrid(False)
         self.setSelectionMode(QAbstractItemView.NoSelection)
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
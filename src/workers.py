@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-2 -*-
+#
+# Copyright (C) 2007 Adam Folmert <afolmert@gmail.com>
+#
+# This file is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+#
+#
+"""This is the module for long running jobs on a deck, like import and export.
+
+Jobs run in a background thread with their own database connection, so that
+the GUI stays responsive. Progress is reported with signals, which are queued
+to the GUI thread.
+"""
+
+
+import release
+__author__  = '%s <%s>' % \
+              ( release.authors['afolmert'][0], release.authors['afolmert'][1])
+
+__license__ = release.license
+__version__ = release.version
+
+
+import os
+import sys
+import threading
+from array import array
+from sqlite3 import OperationalError
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+from cards import Cards, readQACards, writeQACards
+from utils import log
+from utils_qt import tr
+
+
+
+class CardsWorker(QThread):
+    """Base class for jobs run on a deck in a background thread.
+    Subclasses implement work(cards) which gets Cards opened on the deck with
+    the bulk-import profile and call reportProgress as they go.
+    After the thread finishes, result, error and cancelled tell how it went.
+    """
+
+    def __init__(self, dbpath, parent=None):
+        QThread.__init__(self, parent)
+        assert dbpath and dbpath != ':memory:', "Worker needs a deck file."
+        self.dbpath = dbpath
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self._cancel = False
+
+
+    def cancel(self):
+        """Asks the job to stop, it is rolled back at next progress report."""
+        self._cancel = True
+
+
+    def reportProgress(self, value, maximum, text):
+        """Emits progress signal, returns False if the job should stop."""
+        self.emit(SIGNAL('progress(int, int, QString)'), value, maximum, text)
+        return not self._cancel
+
+
+    def run(self):
+        # sqlite connections cannot be shared between threads
+        cards = Cards()
+        try:
+            try:
+                cards.open(self.dbpath, 'bulk-import')
+                self.result = self.work(cards)
+            finally:
+                cards.close()
+        except Cards.CancelledError:
+            self.cancelled = True
+        except:
+            log(sys.exc_info())
+            self.error = str(sys.exc_info()[1])
+
+
+    def work(self, cards):
+        # to be overridden
+        pass
+
+
+
+class QAImportWorker(CardsWorker):
+    """Imports cards from question&answer file.
+    Import is done in one transaction, so cancelled or failed import leaves
+    the deck unchanged. Result is number of imported cards.
+    """
+
+    # number of cards inserted at once
+    BatchSize = 5000
+
+    def __init__(self, dbpath, fname, clean=True, parent=None):
+        CardsWorker.__init__(self, dbpath, parent)
+        self.fname = fname
+        self.clean = clean
+
+
+    def work(self, cards):
+        # progress is counted in KiB so that it fits in int for big files
+        size = os.path.getsize(self.fname) / 1024
+        read = { 'bytes' : 0 }
+        def report(count):
+            return self.reportProgress(read['bytes'] / 1024, size,
+                                       tr('Imported %1 cards...').arg(count))
+        file = open(self.fname, 'rt')
+        try:
+            with cards.transaction():
+                if self.clean:
+                    cards.deleteAllCards()
+                ids = cards.addCards(readQACards(file, read), QAImportWorker.BatchSize, report)
+        finally:
+            file.close()
+        return ids and ids[1] - ids[0] + 1 or 0
+
+
+
+class QAExportWorker(CardsWorker):
+    """Exports all cards to question&answer file.
+    Cancelled or failed export removes the file. Result is number of exported
+    cards.
+    """
+
+    # number of cards read at once
+    BatchSize = 5000
+
+    def __init__(self, dbpath, fname, parent=None):
+        CardsWorker.__init__(self, dbpath, parent)
+        self.fname = fname
+
+
+    def work(self, cards):
+        total = cards.getCardsCount()
+        count = 0
+        last_id = None
+        file = open(self.fname, 'wt')
+        try:
+            while True:
+                ids = cards.getCardIds(last_id, QAExportWorker.BatchSize)
+                if len(ids) == 0:
+                    break
+                writeQACards(cards.getCards(ids).itervalues(), file)
+                count += len(ids)
+                last_id = ids[-1]
+                if not self.reportProgress(count, total, tr('Exported %1 cards...').arg(count)):
+                    raise Cards.CancelledError, "Export cancelled"
+        except:
+            file.close()
+            os.remove(self.fname)
+            raise
+        file.close()
+        return count
+
+
+
+class SearchWorker(QThread):
+    """Searches cards as the user types in a background thread.
+    The thread keeps its own connection open and runs only the newest query
+    given with search, a query still running when a new one comes is
+    interrupted. Matching ids are emitted in blocks with the signal
+    found(generation, ids, first) where generation is the number returned by
+    search and first tells that the block starts new results.
+    Without full-text index each query scans all cards, so a query which
+    extends the previous one searches only in its results.
+    """
+
+    # first block is small so that it is shown at once
+    FirstBlockSize = 500
+    BlockSize = 20000
+
+    def __init__(self, dbpath, parent=None):
+        QThread.__init__(self, parent)
+        assert dbpath and dbpath != ':memory:', "Worker needs a deck file."
+        self.dbpath = dbpath
+        self._lock = threading.Condition()
+        self._query = None
+        self._generation = 0
+        self._stop = False
+        self._cards = None
+        # last query with complete results, used for narrowing
+        self._last = None
+
+
+    def search(self, query):
+        """Starts search for given text, returns its generation."""
+        self._lock.acquire()
+        try:
+            self._query = unicode(query)
+            self._generation += 1
+            if self._cards is not None and self._cards.isOpen():
+                # stale query stops at once, interrupt is safe from any thread
+                self._cards.db.interrupt()
+            self._lock.notify()
+            return self._generation
+        finally:
+            self._lock.release()
+
+
+    def stop(self):
+        """Stops the thread and waits for it."""
+        self._lock.acquire()
+        try:
+            self._stop = True
+            if self._cards is not None and self._cards.isOpen():
+                self._cards.db.interrupt()
+            self._lock.notify()
+        finally:
+            self._lock.release()
+        self.wait()
+
+
+    def _isStale(self, generation):
+        return self._stop or generation != self._generation
+
+
+    def run(self):
+        cards = Cards()
+        try:
+            cards.open(self.dbpath)
+        except:
+            log(sys.exc_info())
+            return
+        self._cards = cards
+        try:
+            while True:
+                self._lock.acquire()
+                try:
+                    while self._query is None and not self._stop:
+                        self._lock.wait()
+                    if self._stop:
+                        break
+                    query, generation = self._query, self._generation
+                    self._query = None
+                finally:
+                    self._lock.release()
+                try:
+                    self._search(cards, query, generation)
+                except OperationalError:
+                    # interrupted by newer query or stop, or interrupt came
+                    # late and hit this query, which is then run again
+                    self._lock.acquire()
+                    if not self._isStale(generation) and self._query is None:
+                        self._query = query
+                    self._lock.release()
+        finally:
+            self._cards = None
+            cards.close()
+
+
+    def _narrows(self, cards, query):
+        """Returns True if results of query are among results of last query."""
+        if self._last is None or cards.fulltext:
+            # full-text words are matched as prefixes only if long enough, so
+            # a longer query may match more, besides each block is an index
+            # seek which is not made faster by narrowing
+            return False
+        words, last = query.split(), self._last[0].split()
+        # plain scan matches substrings, so longer words match less
+        return len(last) > 0 and len(words) >= len(last) \
+               and words[:len(last) - 1] == last[:-1] \
+               and last[-1] in words[len(last) - 1]
+
+
+    def _search(self, cards, query, generation):
+        ids = array('l')
+        if self._narrows(cards, query):
+            candidates = self._last[1]
+            # results of shorter query are searched block by block
+            start, size = 0, SearchWorker.FirstBlockSize
+            while start < len(candidates):
+                block = cards.searchCardIds(query, card_ids=candidates[start:start + size])
+                if self._isStale(generation):
+                    return
+                self.emit(SIGNAL('found'), generation, block, start == 0)
+                ids.extend(block)
+                start += size
+                size = SearchWorker.BlockSize
+            if len(candidates) == 0:
+                self.emit(SIGNAL('found'), generation, ids, True)
+        else:
+            after_id, size = None, SearchWorker.FirstBlockSize
+            while True:
+                block = cards.searchCardIds(query, after_id, size)
+                if self._isStale(generation):
+                    return
+                self.emit(SIGNAL('found'), generation, block, after_id is None)
+                ids.extend(block)
+                if len(block) < size:
+                    break
+                after_id, size = block[-1], SearchWorker.BlockSize
+        self._last = (query, ids)
+
+
+
+class WorkerProgressDialog(QProgressDialog):
+    """Modal progress dialog for a worker with a Cancel button."""
+
+    def __init__(self, worker, label, parent=None):
+        QProgressDialog.__init__(self, label, tr("Cancel"), 0, 0, parent)
+        self.worker = worker
+        self.setWindowModality(Qt.WindowModal)
+        self.setAutoReset(False)
+        self.setAutoClose(False)
+        self.setMinimumDuration(0)
+        self.connect(worker, SIGNAL('progress(int, int, QString)'), self.setProgress)
+        self.connect(worker, SIGNAL('finished()'), self.accept)
+        self.connect(self, SIGNAL('canceled()'), worker.cancel)
+
+
+    def setProgress(self, value, maximum, text):
+        self.setMaximum(maximum)
+        self.setValue(value)
+        self.setLabelText(text)
+
+
+    def run(self):
+        """Starts the worker and shows progress until it finishes."""
+        self.worker.start()
+        self.exec_()
+        # cancelled dialog closes before worker stops
+        self.worker.wait()
+        return self.worker
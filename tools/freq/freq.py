@@ -20,16 +20,22 @@
 This is a script for managing word freq database.
 
 It allows import of new text files and freq files. Also displaying of existing files.
-The freq database is stored in sqlite file.
+The freq database is stored in sqlite file. It can be exported to corpus file
+which is used by probe to look up words without the database.
 """
 
 __version__ = "0.0.01"
 
+import os
 import sqlite3
 from misc import enable_logging, log
 import sys
 import re
 
+# corpus file format is kept in probe sources
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+from corpus import writeCorpus
+
 
 
 class FreqDatabase(object):
@@ -110,6 +116,16 @@ class FreqDatabase(object):
             cur2.close()
 
 
+    def export_corpus(self, fname):
+        """Exports words with their position levels to corpus file."""
+        cur = self.connection.cursor()
+        try:
+            cur.execute('SELECT WORD, POSITION_LVL FROM TFREQ WHERE POSITION_LVL IS NOT NULL')
+            writeCorpus(fname, cur)
+        finally:
+            cur.close()
+
+
     def commit_database(self):
         self.connection.commit()
 
@@ -131,6 +147,7 @@ Commands:
   print                 prints database contents
   import                import a file (use with -t and -f options)
   show                  shows frequencies of words used in a file (use with -t options)
+  export                exports database to corpus file used by probe (use with -o option)
 
 Options:
   -h, --help            show this help message and exit
@@ -145,6 +162,8 @@ Options:
   -l LIMIT, --limit=LIMIT
                         limit printing results to count; used with print
                         command.
+  -o FILE, --output=FILE
+                        specifies a corpus file; used with export command
 """
 
 
@@ -217,6 +236,13 @@ def import_freq_file(db, fname):
     print "Imported %d words from file %s." % (cnt, fname)
 
 
+def export_corpus_file(db, fname):
+    """Exports database to corpus file."""
+    msg("Exporting words to file %s..." % fname)
+    db.export_corpus(fname)
+    print "Exported words to file %s." % fname
+
+
 def main():
     """This is the main program."""
     from optparse import OptionParser
@@ -239,6 +265,8 @@ def main():
                       help="run a a simulation only")
     parser.addOption("-l", "--limit", action="store", type="int", dest="limit", default=100,
                       help="limit printing results to count; used with print command.")
+    parser.addOption("-o", "--output", action="store", dest="output",
+                      metavar="FILE", help="specifies a corpus file; used with export command")
 
     opts, args = parser.parse_args(sys.argv[1:])
 
@@ -270,6 +298,11 @@ def main():
             show_text_file(db, opts.text)
         else:
             print "No text file specified. Use -t option."
+    elif command == 'EXPORT':
+        if opts.output:
+            export_corpus_file(db, opts.output)
+        else:
+            print "No corpus file specified. Use -o option."
     else:
         print "Unknown command %s " % command
 